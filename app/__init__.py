@@ -6,39 +6,87 @@ from app.mqtt_client import init_mqtt
 from config import Config
 from app.iotelligence.routes import bp_ai
 from app.iotelligence.worker import init as init_ai_worker
+from app.ingest import init as init_ingest
+from app.ingest_lanes import init as init_ingest_lanes
+from app import analytics, archive, hot_tier, metrics, packed_json, partitions, purge, registry, sqlite_maint, writer
+from app.db import (add_missing_columns, all_tables, configure_binds, engine_for, init_binds,
+                    init_read_split, init_sqlite_pragmas)
 from sqlalchemy import text   # <<< importante para ejecutar SQL nativo
 from flask_jwt_extended import JWTManager
 
-def create_app():
+def create_app(config_object=Config):
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_object)
 
     # (Opcional) ver la zona horaria detectada
     print(f"[TZ] Usando zona horaria: {app.config.get('BACKEND_TZ', 'America/Caracas')}")
 
+    configure_binds(app)   # bind "telemetry": misma BD o TELEMETRY_DATABASE_URI
     db.init_app(app)
     JWTManager(app)
     app.register_blueprint(bp)
     app.register_blueprint(bp_ai)  # IoTelligence comparte la misma URL
 
     with app.app_context():
+        init_binds(app)
+        if db.engine.dialect.name == "sqlite":
+            # ⚡ WAL, synchronous... por conexión y por BD (SQLITE_PRAGMAS / TELEMETRY_SQLITE_PRAGMAS)
+            try:
+                init_sqlite_pragmas(app)
+            except Exception as e:
+                print(f"[DB] No se pudieron aplicar los PRAGMA: {e}")
+
         db.create_all()
+        # create_all no añade columnas ni índices nuevos a tablas ya existentes
+        add_missing_columns()
+        for table in all_tables():
+            for idx in table.indexes:
+                idx.create(bind=engine_for(table), checkfirst=True)
+
+        if db.engine.dialect.name == "sqlite":
+            # SELECTs de los demás hilos por conexiones query_only (DB_READ_SPLIT)
+            init_read_split(app)
+        else:
+            # PostgreSQL: particiones mensuales de estado_log / accion_log
+            partitions.init(app)
+            print(f"[DB] {db.engine.dialect.name} (pool={db.engine.pool.size()})")
 
-        # ⚡ Activar WAL y mejorar concurrencia en SQLite
-        try:
-            db.session.execute(text("PRAGMA journal_mode=WAL;"))
-            db.session.execute(text("PRAGMA synchronous=NORMAL;"))
-            db.session.commit()
-            print("[DB] WAL activado (journal_mode=WAL, synchronous=NORMAL)")
-        except Exception as e:
-            print(f"[DB] No se pudo activar WAL: {e}")
+        # Diccionarios de compresión de las columnas JSON (antes de leer dispositivos)
+        packed_json.init(app)
 
-    # Inicializa MQTT
-    init_mqtt(app)
+        # Registro en memoria de dispositivos (lookups sin SELECT en caminos calientes)
+        registry.load()
+        metrics.load()
 
     # <<< INICIALIZA EL WORKER DE IA (para jobs batch con app_context)
     init_ai_worker(app, max_workers=2)
 
+    # Escritor único de la BD: ingesta, alta/PUT/reclamo, reglas y archivador le envían intenciones
+    writer.init(app)
+
+    # Últimas horas de cada métrica en memoria (Gorilla); se alimenta tras cada commit del escritor
+    hot_tier.init(app)
+
+    # Escritor write-behind de la ingesta (antes de MQTT para no perder mensajes)
+    init_ingest(app)
+    init_ingest_lanes(app)
+
+    # Retención: EstadoLog/AccionLog antiguos -> segmentos comprimidos (ARCHIVE_ENABLED)
+    archive.init(app)
+
+    # Purga en segundo plano del histórico de dispositivos eliminados (tombstone)
+    purge.init(app)
+
+    # SQLite: checkpoints del WAL por tamaño e incremental_vacuum en ventanas de inactividad
+    sqlite_maint.init(app)
+
+    # Analítica de flota con DuckDB (opcional): pool propio, conexión perezosa y solo lectura
+    analytics.init(app)
+
+    # Inicializa MQTT (MQTT_ENABLED=False: p.ej. benchmark que inyecta mensajes directamente)
+    if app.config.get("MQTT_ENABLED", True):
+        init_mqtt(app)
+
     # Manejadores globales de errores
     @app.errorhandler(404)
     def not_found_error(error):
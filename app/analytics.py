@@ -0,0 +1,410 @@
+# app/analytics.py
+"""
+Analítica de flota con DuckDB embebido (opcional: `pip install duckdb`).
+
+Preguntas de toda la flota (medias por habitación y hora en 90 días, top de
+dispositivos con más anomalías...) no caben en el ORM. Aquí se responden con
+un DuckDB en memoria que:
+  - adjunta en SOLO LECTURA la BD principal y la de telemetría (extensión
+    `sqlite` de DuckDB, o `postgres` si DATABASE_URL es PostgreSQL);
+  - lee los segmentos archivados (`ARCHIVE_DIR/estado/<id>/<AAAA-MM>.jsonl.*`)
+    con `read_json`, descartando ficheros por mes/dispositivo antes de abrirlos.
+
+Solo se ejecutan informes parametrizados de `REPORTS` (nada de SQL libre). Los
+informes usan las tablas estrechas (metric_sample, metric_rollup,
+accion_log.evento): es más barato que abrir el JSON de cada fila de log.
+
+No bloquea la ingesta: las lecturas SQLite en WAL no esperan al escritor, las
+consultas corren en un pool propio (ANALYTICS_MAX_WORKERS, DuckDB con
+ANALYTICS_THREADS hilos y ANALYTICS_MEMORY_LIMIT) y se interrumpen al pasar
+ANALYTICS_TIMEOUT_S. Sin red, la extensión `sqlite` debe estar ya instalada
+(ANALYTICS_EXTENSION_DIR); si no, solo quedan los informes del archivo.
+"""
+from __future__ import annotations
+import glob, os, threading, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import Flask
+
+from app import archive, metrics
+from app.db import TELEMETRY, db
+
+try:
+    import duckdb
+except Exception:   # dependencia opcional
+    duckdb = None
+
+class AnalyticsError(Exception):
+    """Error de parámetros o de disponibilidad (status HTTP en `status`)."""
+    def __init__(self, msg: str, status: int = 400):
+        super().__init__(msg)
+        self.status = status
+
+_app: Flask | None = None
+_con = None
+_con_lock = threading.Lock()
+_aliases: Dict[str, str] = {}    # "main"/"tel" -> alias adjunto en DuckDB (appdb / teldb)
+_attach_error: Optional[str] = None
+_pool: Optional[ThreadPoolExecutor] = None
+_slots: Optional[threading.BoundedSemaphore] = None
+_stats_lock = threading.Lock()
+_stats: Dict[str, Any] = {"queries": 0, "errors": 0, "timeouts": 0, "rejected": 0, "last_ms": 0.0, "max_ms": 0.0}
+
+def init(app: Flask) -> None:
+    """Prepara el pool de consultas; la conexión DuckDB se abre en la primera consulta."""
+    global _app, _pool, _slots
+    _app = app
+    if _pool is not None or duckdb is None or not app.config.get("ANALYTICS_ENABLED", True):
+        return
+    workers = max(1, int(app.config.get("ANALYTICS_MAX_WORKERS", 2)))
+    _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Analytics")
+    _slots = threading.BoundedSemaphore(workers + int(app.config.get("ANALYTICS_MAX_QUEUED", 4)))
+
+def stop() -> None:
+    global _con
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    with _con_lock:
+        if _con is not None:
+            _con.close()
+            _con = None
+
+def available() -> bool:
+    return _pool is not None
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        out = dict(_stats)
+    out.update(available=available(), attached=sorted(set(_aliases.values())), attach_error=_attach_error)
+    return out
+
+def _count(**kw) -> None:
+    with _stats_lock:
+        for k, v in kw.items():
+            _stats[k] = _stats.get(k, 0) + v
+
+# =========================
+# Conexión DuckDB
+# =========================
+def _attach_spec(engine) -> Tuple[str, str]:
+    """(cadena de conexión, TYPE) para ATTACH a partir del engine de SQLAlchemy."""
+    url = engine.url
+    if engine.dialect.name == "sqlite":
+        return url.database, "sqlite"
+    if engine.dialect.name == "postgresql":
+        return url.set(drivername="postgresql").render_as_string(hide_password=False), "postgres"
+    raise AnalyticsError(f"dialecto no soportado por DuckDB: {engine.dialect.name}", 503)
+
+def _connect():
+    """Conexión DuckDB compartida (cada consulta usa su propio cursor). Requiere app context."""
+    global _con, _attach_error
+    with _con_lock:
+        if _con is not None:
+            return _con
+        cfg = _app.config
+        config = {"threads": int(cfg.get("ANALYTICS_THREADS", 2)),
+                  "memory_limit": str(cfg.get("ANALYTICS_MEMORY_LIMIT", "512MB"))}
+        if cfg.get("ANALYTICS_EXTENSION_DIR"):
+            config["extension_directory"] = cfg["ANALYTICS_EXTENSION_DIR"]
+        con = duckdb.connect(":memory:", config=config)
+        _aliases.clear()
+        _attach_error = None
+        seen: Dict[str, str] = {}
+        try:
+            for role, key in (("appdb", None), ("teldb", TELEMETRY)):
+                spec, kind = _attach_spec(db.engines[key])
+                if spec not in seen:
+                    con.execute(f"INSTALL {kind}; LOAD {kind};")
+                    con.execute(f"ATTACH '{spec.replace(chr(39), chr(39) * 2)}' AS {role} (TYPE {kind}, READ_ONLY)")
+                    seen[spec] = role
+                _aliases["main" if key is None else "tel"] = seen[spec]
+        except Exception as e:
+            # Sin extensión (p.ej. sin red): solo los informes sobre el archivo
+            _aliases.clear()
+            _attach_error = str(e).splitlines()[0]
+            print(f"[ANALYTICS] BD no adjuntada: {_attach_error}")
+        _con = con
+        print(f"[ANALYTICS] DuckDB {duckdb.__version__} (adjuntas: {sorted(set(_aliases.values())) or '-'})")
+        return _con
+
+# =========================
+# Parámetros
+# =========================
+def _p_int(lo: int, hi: int) -> Callable[[str], int]:
+    def conv(raw: str) -> int:
+        v = int(raw)
+        if not lo <= v <= hi:
+            raise ValueError(f"fuera de rango [{lo}, {hi}]")
+        return v
+    return conv
+
+def _p_float(lo: float, hi: float) -> Callable[[str], float]:
+    def conv(raw: str) -> float:
+        v = float(raw)
+        if not lo <= v <= hi:
+            raise ValueError(f"fuera de rango [{lo}, {hi}]")
+        return v
+    return conv
+
+def _p_str(raw: str) -> str:
+    raw = raw.strip()
+    if not raw or len(raw) > 100:
+        raise ValueError("vacío o demasiado largo")
+    return raw
+
+_REQUIRED = object()
+
+def _params(report: Dict[str, Any], args: Dict[str, str]) -> Dict[str, Any]:
+    out = {}
+    for name, (conv, default, doc) in report["params"].items():
+        raw = args.get(name)
+        if raw is None or raw == "":
+            if default is _REQUIRED:
+                raise AnalyticsError(f"falta el parámetro '{name}' ({doc})")
+            out[name] = default
+            continue
+        try:
+            out[name] = conv(raw)
+        except ValueError as e:
+            raise AnalyticsError(f"parámetro '{name}' inválido: {e}")
+    return out
+
+def _since(days: int) -> datetime:
+    return datetime.utcnow() - timedelta(days=days)
+
+# =========================
+# Informes
+# =========================
+def _room_hourly(p: Dict[str, Any]) -> Tuple[Optional[str], list]:
+    mid = metrics.metric_id(p["metric"])
+    if mid is None:
+        return None, []   # métrica nunca vista
+    sql = """
+        SELECT r.bucket AS hora, d.habitacion_id, h.nombre AS habitacion,
+               sum(r.sum) / sum(r.count) AS avg, min(r.min) AS min, max(r.max) AS max,
+               sum(r.count) AS muestras, count(DISTINCT r.device_id) AS dispositivos
+        FROM {tel}.metric_rollup r
+        JOIN {main}.dispositivo d ON d.id = r.device_id AND d.eliminado_at IS NULL
+        LEFT JOIN {main}.habitacion h ON h.id = d.habitacion_id
+        WHERE r.metric_id = ? AND r.res = 3600 AND r.bucket >= ?
+          AND (? IS NULL OR d.habitacion_id = ?)
+        GROUP BY ALL
+        ORDER BY hora, d.habitacion_id
+    """
+    return sql, [mid, _since(p["days"]), p["room"], p["room"]]
+
+def _top_anomalies(p: Dict[str, Any]) -> Tuple[Optional[str], list]:
+    mid = metrics.metric_id(p["metric"])
+    if mid is None:
+        return None, []   # métrica nunca vista
+    sql = """
+        WITH s AS (
+            SELECT device_id, value,
+                   avg(value) OVER w AS mu, stddev_pop(value) OVER w AS sd
+            FROM {tel}.metric_sample
+            WHERE metric_id = ? AND ts >= ?
+            WINDOW w AS (PARTITION BY device_id)
+        )
+        SELECT s.device_id AS dispositivo_id, d.serial_number, d.nombre,
+               count(*) FILTER (WHERE s.sd > 0 AND abs(s.value - s.mu) > ? * s.sd) AS anomalias,
+               count(*) AS muestras, any_value(s.mu) AS media, any_value(s.sd) AS desviacion
+        FROM s
+        JOIN {main}.dispositivo d ON d.id = s.device_id AND d.eliminado_at IS NULL
+        GROUP BY ALL
+        ORDER BY anomalias DESC, muestras DESC
+        LIMIT ?
+    """
+    return sql, [mid, _since(p["days"]), p["z"], p["limit"]]
+
+def _device_daily(p: Dict[str, Any]) -> Tuple[Optional[str], list]:
+    mid = metrics.metric_id(p["metric"])
+    if mid is None:
+        return None, []   # métrica nunca vista
+    # Desviación del día combinando el m2 de cada hora (Chan), sin sum de cuadrados
+    sql = """
+        WITH h AS (
+            SELECT date_trunc('day', r.bucket) AS dia, r.device_id, r.count AS n, r.min, r.max, r.sum AS s,
+                   coalesce(r.m2, greatest(r.sumsq - r.sum * r.sum / r.count, 0)) AS m2,
+                   sum(r.sum) OVER d / sum(r.count) OVER d AS mu
+            FROM {tel}.metric_rollup r
+            WHERE r.metric_id = ? AND r.res = 3600 AND r.bucket >= ? AND r.count > 0
+              AND (? IS NULL OR r.device_id = ?)
+            WINDOW d AS (PARTITION BY date_trunc('day', r.bucket), r.device_id)
+        )
+        SELECT dia, device_id AS dispositivo_id, sum(s) / sum(n) AS avg, min(min) AS min, max(max) AS max,
+               sqrt(greatest(sum(m2 + n * pow(s / n - mu, 2)) / sum(n), 0)) AS std,
+               sum(n) AS muestras
+        FROM h
+        GROUP BY ALL
+        ORDER BY dia, dispositivo_id
+    """
+    return sql, [mid, _since(p["days"]), p["device"], p["device"]]
+
+def _events_daily(p: Dict[str, Any]) -> Tuple[str, list]:
+    sql = """
+        SELECT date_trunc('day', timestamp) AS dia, evento, count(*) AS eventos,
+               count(DISTINCT dispositivo_id) AS dispositivos
+        FROM {tel}.accion_log
+        WHERE timestamp >= ?
+        GROUP BY ALL
+        ORDER BY dia, eventos DESC
+    """
+    return sql, [_since(p["days"])]
+
+def _archive_files(table: str, device: Optional[int], since: date, until: date) -> List[str]:
+    """Segmentos del archivo en el rango de meses (poda por nombre, sin abrirlos)."""
+    lo, hi = since.strftime("%Y-%m"), until.strftime("%Y-%m")
+    dev = str(device) if device is not None else "*"
+    out = []
+    for ext in archive._EXTS:
+        for path in glob.glob(os.path.join(archive._base_dir, table, dev, "*" + ext)):
+            month = os.path.basename(path)[: -len(ext)]
+            if lo <= month <= hi:
+                out.append(path)
+    return sorted(out)
+
+def _archive_daily(p: Dict[str, Any]) -> Tuple[Optional[str], list]:
+    until = datetime.utcnow()
+    since = until - timedelta(days=p["days"])
+    files = _archive_files("estado", p["device"], since, until)
+    if not files:
+        return None, []
+    listing = ", ".join("'" + f.replace("'", "''") + "'" for f in files)
+    # Un lote re-archivado tras una caída puede repetir ids: se quedan una vez
+    sql = f"""
+        WITH a AS (
+            SELECT DISTINCT ON (dispositivo_id, id) dispositivo_id, id, timestamp,
+                   TRY_CAST(json_extract(parametros, ?) AS DOUBLE) AS v
+            FROM (
+                SELECT CAST(regexp_extract(filename, '[/\\\\](\\d+)[/\\\\][^/\\\\]+$', 1) AS INTEGER) AS dispositivo_id,
+                       id, timestamp, parametros
+                FROM read_json([{listing}], format = 'newline_delimited', filename = true,
+                               columns = {{'id': 'BIGINT', 'estado': 'VARCHAR', 'parametros': 'JSON',
+                                           'timestamp': 'TIMESTAMP'}})
+            )
+            WHERE timestamp >= ?
+        )
+        SELECT date_trunc('day', timestamp) AS dia, dispositivo_id,
+               avg(v) AS avg, min(v) AS min, max(v) AS max, count(v) AS muestras, count(*) AS filas
+        FROM a
+        GROUP BY ALL
+        ORDER BY dia, dispositivo_id
+    """
+    return sql, [p["metric"], since]
+
+REPORTS: Dict[str, Dict[str, Any]] = {
+    "room_hourly_avg": {
+        "doc": "Media/min/max por habitación y hora de una métrica (rollups 1h).",
+        "build": _room_hourly, "needs_db": True,
+        "params": {"metric": (_p_str, _REQUIRED, "nombre de la métrica"),
+                   "days": (_p_int(1, 3650), 7, "días hacia atrás"),
+                   "room": (_p_int(1, 2**31), None, "solo esta habitacion_id")},
+    },
+    "top_anomalies": {
+        "doc": "Dispositivos con más muestras a más de `z` desviaciones de su propia media.",
+        "build": _top_anomalies, "needs_db": True,
+        "params": {"metric": (_p_str, _REQUIRED, "nombre de la métrica"),
+                   "days": (_p_int(1, 365), 7, "días hacia atrás"),
+                   "z": (_p_float(0.5, 20.0), 3.0, "umbral en desviaciones"),
+                   "limit": (_p_int(1, 1000), 20, "dispositivos")},
+    },
+    "device_daily": {
+        "doc": "Estadísticos diarios de una métrica por dispositivo (rollups 1h).",
+        "build": _device_daily, "needs_db": True,
+        "params": {"metric": (_p_str, _REQUIRED, "nombre de la métrica"),
+                   "days": (_p_int(1, 3650), 30, "días hacia atrás"),
+                   "device": (_p_int(1, 2**31), None, "solo este dispositivo_id")},
+    },
+    "events_daily": {
+        "doc": "Eventos de AccionLog por día y tipo.",
+        "build": _events_daily, "needs_db": True,
+        "params": {"days": (_p_int(1, 3650), 30, "días hacia atrás")},
+    },
+    "archive_daily": {
+        "doc": "Estadísticos diarios de una métrica leídos de los segmentos archivados de EstadoLog.",
+        "build": _archive_daily, "needs_db": False,
+        "params": {"metric": (_p_str, _REQUIRED, "clave de `parametros`"),
+                   "days": (_p_int(1, 3650), 365, "días hacia atrás"),
+                   "device": (_p_int(1, 2**31), None, "solo este dispositivo_id")},
+    },
+}
+
+def reports() -> Dict[str, Any]:
+    """Catálogo para GET /analytics/reports."""
+    return {name: {"doc": r["doc"],
+                   "params": {k: {"default": None if d is _REQUIRED else d, "required": d is _REQUIRED, "doc": doc}
+                              for k, (_, d, doc) in r["params"].items()}}
+            for name, r in REPORTS.items()}
+
+# =========================
+# Ejecución
+# =========================
+def _json_value(v: Any) -> Any:
+    if isinstance(v, datetime):
+        return v.isoformat() + "Z"
+    if isinstance(v, date):
+        return v.isoformat()
+    return v
+
+def _execute(app: Flask, name: str, params: Dict[str, Any], holder: Dict[str, Any]) -> Dict[str, Any]:
+    with app.app_context():
+        report = REPORTS[name]
+        con = _connect()
+        if report["needs_db"] and not _aliases:
+            raise AnalyticsError(f"BD no adjuntada en DuckDB: {_attach_error}", 503)
+        sql, args = report["build"](params)
+        if sql is None:
+            return {"columns": [], "rows": []}
+        if report["needs_db"]:
+            sql = sql.format(**_aliases)   # {main} / {tel} -> BD adjuntas
+        cur = con.cursor()
+        holder["cursor"] = cur
+        try:
+            cur.execute(sql, args)
+            cols = [d[0] for d in cur.description]
+            rows = [[_json_value(v) for v in row] for row in cur.fetchall()]
+        finally:
+            cur.close()
+        return {"columns": cols, "rows": rows}
+
+def run(name: str, args: Dict[str, str]) -> Dict[str, Any]:
+    """Ejecuta un informe en el pool de analítica. Lanza AnalyticsError (con status HTTP)."""
+    if not available():
+        raise AnalyticsError("analítica no disponible (instala `duckdb` y ANALYTICS_ENABLED)", 503)
+    if name not in REPORTS:
+        raise AnalyticsError(f"informe desconocido: {name}", 404)
+    params = _params(REPORTS[name], args)
+    if not _slots.acquire(blocking=False):
+        _count(rejected=1)
+        raise AnalyticsError("analítica ocupada, reintenta", 429)
+    holder: Dict[str, Any] = {}
+    t0 = time.perf_counter()
+    try:
+        fut = _pool.submit(_execute, _app, name, params, holder)
+    except RuntimeError:
+        _slots.release()
+        raise AnalyticsError("analítica detenida", 503)
+    fut.add_done_callback(lambda _: _slots.release())   # el hueco se libera al terminar de verdad
+    try:
+        out = fut.result(timeout=float(_app.config.get("ANALYTICS_TIMEOUT_S", 30)))
+    except FutureTimeout:
+        _count(timeouts=1)
+        cur = holder.get("cursor")
+        if cur is not None:
+            cur.interrupt()
+        raise AnalyticsError("la consulta superó ANALYTICS_TIMEOUT_S", 504)
+    except AnalyticsError:
+        _count(errors=1)
+        raise
+    except Exception as e:
+        _count(errors=1)
+        raise AnalyticsError(f"error en DuckDB: {e}", 500)
+    ms = (time.perf_counter() - t0) * 1000.0
+    with _stats_lock:
+        _stats["queries"] += 1
+        _stats["last_ms"] = round(ms, 2)
+        _stats["max_ms"] = max(_stats["max_ms"], round(ms, 2))
+    out.update(report=name, params={k: _json_value(v) for k, v in params.items()}, ms=round(ms, 2))
+    return out
@@ -0,0 +1,276 @@
+# app/archive.py
+"""
+Retención y archivo por niveles de `EstadoLog` / `AccionLog`.
+
+Un hilo en segundo plano mueve por lotes las filas más antiguas que
+ARCHIVE_ESTADO_AFTER_DAYS / ARCHIVE_ACCION_AFTER_DAYS a segmentos comprimidos
+append-only, uno por dispositivo y mes:
+
+    ARCHIVE_DIR/<tabla>/<dispositivo_id>/<AAAA-MM>.jsonl.zst   (zstd si está `zstandard`)
+    ARCHIVE_DIR/<tabla>/<dispositivo_id>/<AAAA-MM>.jsonl.gz    (gzip como alternativa)
+
+Cada lote se añade como un frame/miembro nuevo (ambos formatos admiten
+concatenación), se hace fsync y SOLO después se borran las filas de la BD.
+Si el proceso cae entre ambos pasos el lote se vuelve a archivar; el lector
+descarta ids repetidos. `index.json` por dispositivo guarda filas y rango
+temporal por mes para paginar sin descomprimir.
+
+API de lectura (transparente para /dispositivos/<id>/logs y el Excel):
+  read_range(tabla, dispositivo_id, since, until, newest_first)
+  archived_count(tabla, dispositivo_id)
+"""
+from __future__ import annotations
+import gzip, io, json, os, shutil, threading, time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from flask import Flask
+
+from app import deltas, partitions, writer
+from app.db import db
+from app.models import AccionLog, EstadoLog
+
+try:
+    import zstandard
+except Exception:   # dependencia opcional
+    zstandard = None
+
+TABLES = {"estado": EstadoLog, "accion": AccionLog}
+_EXTS = (".jsonl.zst", ".jsonl.gz")
+
+_base_dir = "instance/archive"
+_codec = "gzip"
+_thread: Optional[threading.Thread] = None
+_stop = threading.Event()
+_io_lock = threading.Lock()   # appends e index.json (un escritor por proceso)
+_stats_lock = threading.Lock()
+_stats: Dict[str, Any] = {"runs": 0, "archived_estado": 0, "archived_accion": 0, "last_run_s": 0.0, "errors": 0}
+
+def init(app: Flask) -> None:
+    """Configura rutas/códec y arranca el hilo archivador si ARCHIVE_ENABLED (idempotente)."""
+    global _base_dir, _codec, _thread
+    _base_dir = app.config.get("ARCHIVE_DIR") or os.path.join(app.instance_path, "archive")
+    want = (app.config.get("ARCHIVE_CODEC") or "zstd").lower()
+    _codec = "zstd" if (want == "zstd" and zstandard is not None) else "gzip"
+    if not app.config.get("ARCHIVE_ENABLED", False) or _thread is not None:
+        return
+    _thread = threading.Thread(target=_loop, args=(app,), name="Archiver", daemon=True)
+    _thread.start()
+    print(f"[ARCHIVE] activo (dir={_base_dir}, codec={_codec}, "
+          f"estado>{app.config.get('ARCHIVE_ESTADO_AFTER_DAYS', 90)}d, "
+          f"accion>{app.config.get('ARCHIVE_ACCION_AFTER_DAYS', 365)}d)")
+
+def stop() -> None:
+    _stop.set()
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        return dict(_stats, codec=_codec, dir=_base_dir)
+
+# =========================
+# Segmentos
+# =========================
+def _dev_dir(table: str, dev_id: int) -> str:
+    return os.path.join(_base_dir, table, str(int(dev_id)))
+
+def _compress(raw: bytes) -> Tuple[bytes, str]:
+    if _codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(raw), ".jsonl.zst"
+    return gzip.compress(raw, compresslevel=6), ".jsonl.gz"
+
+def _open_segment(path: str):
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"segmento zstd sin 'zstandard' instalado: {path}")
+        fh = open(path, "rb")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True), encoding="utf-8")
+    return gzip.open(path, "rt", encoding="utf-8")
+
+def _segments(table: str, dev_id: int) -> Dict[str, List[str]]:
+    """mes 'AAAA-MM' -> rutas de segmento (puede haber .zst y .gz si cambió el códec)."""
+    d = _dev_dir(table, dev_id)
+    out: Dict[str, List[str]] = {}
+    if not os.path.isdir(d):
+        return out
+    for name in os.listdir(d):
+        for ext in _EXTS:
+            if name.endswith(ext):
+                out.setdefault(name[: -len(ext)], []).append(os.path.join(d, name))
+    return out
+
+def _load_index(table: str, dev_id: int) -> Dict[str, Dict[str, Any]]:
+    p = os.path.join(_dev_dir(table, dev_id), "index.json")
+    try:
+        with open(p, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_index(table: str, dev_id: int, idx: Dict[str, Dict[str, Any]]) -> None:
+    p = os.path.join(_dev_dir(table, dev_id), "index.json")
+    tmp = p + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(idx, f, sort_keys=True)
+    os.replace(tmp, p)
+
+def _row_dict(table: str, r) -> Dict[str, Any]:
+    if table == "estado":
+        return {"id": r.id, "estado": r.estado, "parametros": r.parametros or {},
+                "timestamp": r.timestamp.isoformat()}
+    return {"id": r.id, "evento": r.evento, "detalle": r.detalle or {}, "actor": r.actor,
+            "timestamp": r.timestamp.isoformat()}
+
+def _append(table: str, dev_id: int, month: str, rows: List[Dict[str, Any]]) -> None:
+    d = _dev_dir(table, dev_id)
+    os.makedirs(d, exist_ok=True)
+    raw = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in rows).encode("utf-8")
+    blob, ext = _compress(raw)
+    path = os.path.join(d, month + ext)
+    with open(path, "ab") as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    idx = _load_index(table, dev_id)
+    m = idx.setdefault(month, {"rows": 0, "min_ts": rows[0]["timestamp"], "max_ts": rows[0]["timestamp"]})
+    m["rows"] += len(rows)
+    m["min_ts"] = min([m["min_ts"]] + [r["timestamp"] for r in rows])
+    m["max_ts"] = max([m["max_ts"]] + [r["timestamp"] for r in rows])
+    _save_index(table, dev_id, idx)
+
+def purge_device(dev_id: int) -> int:
+    """Borra los segmentos de un dispositivo (app/purge.py). Devuelve directorios eliminados."""
+    n = 0
+    with _io_lock:
+        for table in TABLES:
+            d = _dev_dir(table, dev_id)
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+                n += 1
+    return n
+
+# =========================
+# Movimiento BD -> archivo
+# =========================
+def archive_batch(table: str, cutoff: datetime, limit: int) -> int:
+    """Archiva hasta `limit` filas de `table` anteriores a `cutoff`. Requiere app context."""
+    model = TABLES[table]
+    rows = model.query.filter(model.timestamp < cutoff).order_by(model.id.asc()).limit(limit).all()
+    if not rows:
+        return 0
+    # Al archivo van filas completas (los deltas se reconstruyen antes de borrar su keyframe)
+    items = [dict(_row_dict(table, r), dispositivo_id=r.dispositivo_id) for r in rows]
+    (deltas.expand_estado if table == "estado" else deltas.expand_accion)(items)
+    groups: Dict[Tuple[int, str], List[Dict[str, Any]]] = {}
+    for r, it in zip(rows, items):
+        it.pop("dispositivo_id")
+        groups.setdefault((r.dispositivo_id, r.timestamp.strftime("%Y-%m")), []).append(it)
+    with _io_lock:
+        for (dev_id, month), items in groups.items():
+            _append(table, dev_id, month, items)
+    ids = [r.id for r in rows]
+    writer.run(_delete_ids, model, ids)   # el borrado lo hace el escritor único
+    return len(ids)
+
+def _delete_ids(model, ids: List[int]) -> None:
+    db.session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+
+def run_once(app: Flask, max_batches: Optional[int] = None) -> Dict[str, int]:
+    """Archiva todo lo vencido (por lotes cortos para no acaparar el lock de escritura)."""
+    cfg = app.config
+    batch = int(cfg.get("ARCHIVE_BATCH_ROWS", 5000))
+    pause = float(cfg.get("ARCHIVE_PAUSE_MS", 50)) / 1000.0
+    now = datetime.utcnow()
+    cutoffs = {
+        "estado": now - timedelta(days=float(cfg.get("ARCHIVE_ESTADO_AFTER_DAYS", 90))),
+        "accion": now - timedelta(days=float(cfg.get("ARCHIVE_ACCION_AFTER_DAYS", 365))),
+    }
+    moved = {"estado": 0, "accion": 0}
+    t0 = time.perf_counter()
+    for table, cutoff in cutoffs.items():
+        n_batches = 0
+        while not _stop.is_set():
+            n = archive_batch(table, cutoff, batch)
+            moved[table] += n
+            n_batches += 1
+            if n < batch or (max_batches and n_batches >= max_batches):
+                break
+            time.sleep(pause)
+        if cfg.get("PG_DROP_EMPTY_PARTITIONS", True):
+            partitions.drop_empty_before(TABLES[table], cutoff)   # PostgreSQL; no-op en SQLite
+    with _stats_lock:
+        _stats["runs"] += 1
+        _stats["archived_estado"] += moved["estado"]
+        _stats["archived_accion"] += moved["accion"]
+        _stats["last_run_s"] = round(time.perf_counter() - t0, 3)
+    if moved["estado"] or moved["accion"]:
+        print(f"[ARCHIVE] 📦 estado={moved['estado']} accion={moved['accion']} "
+              f"en {_stats['last_run_s']}s")
+    return moved
+
+def _loop(app: Flask) -> None:
+    interval = float(app.config.get("ARCHIVE_INTERVAL_S", 3600))
+    with app.app_context():
+        if _stop.wait(float(app.config.get("ARCHIVE_STARTUP_DELAY_S", 60))):
+            return
+        while not _stop.is_set():
+            try:
+                run_once(app)
+            except Exception as e:
+                db.session.rollback()
+                with _stats_lock:
+                    _stats["errors"] += 1
+                print("[ARCHIVE ERROR]", e)
+            if _stop.wait(interval):
+                return
+
+# =========================
+# Lectura
+# =========================
+def _parse(line: str) -> Optional[Dict[str, Any]]:
+    try:
+        r = json.loads(line)
+    except ValueError:
+        return None
+    r["timestamp"] = datetime.fromisoformat(r["timestamp"])
+    return r
+
+def _read_month(table: str, dev_id: int, paths: List[str]) -> List[Dict[str, Any]]:
+    seen = set()
+    out = []
+    for p in paths:
+        with _open_segment(p) as fh:
+            for line in fh:
+                r = _parse(line)
+                if r is None or r["id"] in seen:
+                    continue
+                seen.add(r["id"])
+                out.append(r)
+    out.sort(key=lambda r: (r["timestamp"], r["id"]))
+    return out
+
+def months(table: str, dev_id: int) -> List[str]:
+    return sorted(_segments(table, dev_id))
+
+def archived_count(table: str, dev_id: int) -> int:
+    return sum(int(m.get("rows", 0)) for m in _load_index(table, dev_id).values())
+
+def read_range(table: str, dev_id: int, since: Optional[datetime] = None, until: Optional[datetime] = None,
+               newest_first: bool = False) -> Iterator[Dict[str, Any]]:
+    """
+    Filas archivadas de un dispositivo en [since, until] (naive UTC), mes a mes.
+    Cada fila es un dict con las columnas del modelo y `timestamp` como datetime.
+    """
+    segs = _segments(table, dev_id)
+    lo = since.strftime("%Y-%m") if since else None
+    hi = until.strftime("%Y-%m") if until else None
+    keys = [m for m in sorted(segs) if (lo is None or m >= lo) and (hi is None or m <= hi)]
+    if newest_first:
+        keys.reverse()
+    for m in keys:
+        rows = _read_month(table, dev_id, segs[m])
+        if newest_first:
+            rows.reverse()
+        for r in rows:
+            ts = r["timestamp"]
+            if (since is None or ts >= since) and (until is None or ts <= until):
+                yield r
@@ -0,0 +1,336 @@
+# app/bulk_import.py
+"""
+Importación masiva de histórico a `EstadoLog` (CSV / JSONL).
+
+Pensado para arrancar hogares con meses de datos sin pasar por MQTT:
+  - lee el fichero en streaming y en bloques (IMPORT_CHUNK_ROWS filas)
+  - resuelve serial -> id UNA vez por serial (registro en memoria; crea el
+    dispositivo si no existe y `create_missing=True`, con una intención propia
+    del escritor que no arrastra filas pendientes)
+  - escribe por el escritor único (`app.writer`): cada IMPORT_COMMIT_ROWS
+    filas son UNA intención (executemany de EstadoLog + muestras + rollups)
+    y una transacción; la ingesta en vivo se intercala entre grupos en vez de
+    esperar al lock de SQLite. Si un grupo falla, el escritor hace rollback
+    (y vacía las cachés de métricas y particiones) y la importación se detiene
+  - tras cada commit invalida esos dispositivos en la capa caliente de
+    métricas (se recargan de BD)
+  - por defecto NO despacha reglas en tiempo real (`run_rules=True` las activa)
+  - informa progreso (filas, filas/s) por callback y por consola
+
+Formatos:
+  CSV   cabecera con `timestamp` (o `ts`) y opcionalmente `serial_number`,
+        `dispositivo_id` y `estado`; el resto de columnas van a `parametros`
+        (números convertidos). Sin columna de serial se usa `serial` o el
+        nombre del fichero (p.ej. river_models/RGD0ABC123.csv).
+  JSONL un objeto por línea: {"serial_number"|"dispositivo_id", "estado",
+        "parametros", "timestamp"} (el mismo formato que exporta EstadoLog).
+Los timestamps sin zona se interpretan en UTC (o en BACKEND_TZ con tz="local").
+"""
+from __future__ import annotations
+import csv, json, os, re, tempfile, threading, time, uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from flask import Flask, current_app
+
+from app.db import db, upsert_returning
+from app import hot_tier, metrics, partitions, registry, writer
+from app.models import Dispositivo, EstadoLog
+from app.utils_time import tz as backend_tz
+
+_RESERVED = {"timestamp", "ts", "serial_number", "serial", "dispositivo_id", "estado"}
+# Epoch como texto (celdas CSV); 8 dígitos justos es la fecha ISO básica AAAAMMDD
+_EPOCH_RE = re.compile(r"^[+-]?(\d{1,7}|\d{9,})(\.\d*)?$")
+
+# =========================
+# Lectura
+# =========================
+def detect_format(name: str, head: str = "") -> str:
+    ext = os.path.splitext(name or "")[1].lower()
+    if ext in (".jsonl", ".ndjson", ".json"):
+        return "jsonl"
+    if ext == ".csv":
+        return "csv"
+    return "jsonl" if head.lstrip().startswith("{") else "csv"
+
+def _coerce(v: str):
+    if v is None:
+        return None
+    s = v.strip()
+    if s == "":
+        return None
+    low = s.lower()
+    if low in ("true", "false"):
+        return low == "true"
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s)
+    except ValueError:
+        return s
+
+def _iter_csv(fh, default_serial: Optional[str]) -> Iterator[Dict[str, Any]]:
+    reader = csv.DictReader(fh)
+    for row in reader:
+        params = {k: _coerce(v) for k, v in row.items() if k and k not in _RESERVED}
+        yield {
+            "serial_number": row.get("serial_number") or row.get("serial") or default_serial,
+            "dispositivo_id": _coerce(row["dispositivo_id"]) if row.get("dispositivo_id") else None,
+            "estado": row.get("estado") or None,
+            "parametros": params,
+            "timestamp": row.get("timestamp") or row.get("ts"),
+        }
+
+def _iter_jsonl(fh, default_serial: Optional[str]) -> Iterator[Dict[str, Any]]:
+    for n, line in enumerate(fh, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"línea {n}: JSON inválido ({e})")
+        yield {
+            "serial_number": obj.get("serial_number") or default_serial,
+            "dispositivo_id": obj.get("dispositivo_id"),
+            "estado": obj.get("estado"),
+            "parametros": obj.get("parametros") or {},
+            "timestamp": obj.get("timestamp") or obj.get("ts"),
+        }
+
+def _parse_ts(raw, local) -> datetime:
+    """ISO-8601 o epoch (s / ms) -> datetime naive en UTC (como lo guarda la ingesta)."""
+    if isinstance(raw, (int, float)):
+        return datetime.fromtimestamp(raw / 1000.0 if raw > 1e11 else raw, timezone.utc).replace(tzinfo=None)
+    s = str(raw or "").strip()
+    if not s:
+        raise ValueError("timestamp vacío")
+    if _EPOCH_RE.match(s):
+        return _parse_ts(float(s), local)
+    dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=local)
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+def _chunks(it: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    buf: List[Dict[str, Any]] = []
+    for x in it:
+        buf.append(x)
+        if len(buf) >= size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+# =========================
+# Resolución serial -> id
+# =========================
+class _Resolver:
+    def __init__(self, create_missing: bool):
+        self.create_missing = create_missing
+        self.ids: Dict[str, Optional[int]] = {}
+        self.known_ids: Dict[int, bool] = {}
+        self.created = 0
+
+    def by_serial(self, serial: str) -> Optional[int]:
+        if serial in self.ids:
+            return self.ids[serial]
+        rec = registry.get(serial)
+        dev_id = rec.id if rec else None
+        if dev_id is None:
+            if self.create_missing:
+                d = writer.run(_alta, serial)   # comiteada aparte: no cierra el grupo en curso
+                self.created += 1
+            else:
+                d = Dispositivo.query.filter_by(serial_number=serial).first()
+            if d is not None:
+                registry.remember(d, bump=False)
+                dev_id = d.id
+        self.ids[serial] = dev_id
+        return dev_id
+
+    def by_id(self, dev_id: int) -> Optional[int]:
+        if dev_id not in self.known_ids:
+            self.known_ids[dev_id] = registry.get_by_id(dev_id) is not None or \
+                db.session.get(Dispositivo, dev_id) is not None
+        return dev_id if self.known_ids[dev_id] else None
+
+# =========================
+# Intenciones del escritor
+# =========================
+def _alta(serial: str) -> Dispositivo:
+    """Alta atómica (o fila existente) en una sentencia: ON CONFLICT ... RETURNING."""
+    return upsert_returning(Dispositivo, {
+        "serial_number": serial, "nombre": "No definido", "tipo": "generico",
+        "modelo": "desconocido", "descripcion": "", "estado": "desconocido",
+        "parametros": {}, "configuracion": {}, "reclamado": False,
+    }, key="serial_number")[0]
+
+def _write_rows(rows: List[Dict[str, Any]]) -> int:
+    partitions.ensure_for(EstadoLog, (r["timestamp"] for r in rows))   # PostgreSQL: meses antiguos
+    db.session.execute(EstadoLog.__table__.insert(), rows)   # executemany
+    metrics.insert_samples((r["dispositivo_id"], r["timestamp"], r["parametros"]) for r in rows)
+    return len(rows)
+
+# =========================
+# Importación
+# =========================
+def import_stream(fh, fmt: str, *, serial: Optional[str] = None, create_missing: bool = True,
+                  run_rules: bool = False, tz: str = "utc", chunk_rows: Optional[int] = None,
+                  commit_rows: Optional[int] = None,
+                  progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    Importa un flujo de texto ya abierto. Requiere app context.
+    Devuelve {"rows", "inserted", "skipped", "devices", "created", "seconds", "rate", "errors"}.
+    Si un grupo falla, los anteriores quedan comiteados y se relanza la excepción.
+    """
+    cfg = current_app.config
+    chunk_rows = int(chunk_rows or cfg.get("IMPORT_CHUNK_ROWS", 5000))
+    commit_rows = int(commit_rows or cfg.get("IMPORT_COMMIT_ROWS", 10000))
+    local = backend_tz() if tz == "local" else timezone.utc
+
+    rows_iter = _iter_csv(fh, serial) if fmt == "csv" else _iter_jsonl(fh, serial)
+    resolver = _Resolver(create_missing)
+    st: Dict[str, Any] = {"rows": 0, "inserted": 0, "skipped": 0, "devices": 0, "created": 0,
+                          "seconds": 0.0, "rate": 0.0, "errors": []}
+    group: List[Dict[str, Any]] = []   # filas del grupo (transacción) en curso
+    t0 = time.perf_counter()
+
+    def _commit_group() -> None:
+        writer.run(_write_rows, group, timeout=None)   # vuelve ya comiteado
+        st["inserted"] += len(group)
+        hot_tier.invalidate({r["dispositivo_id"] for r in group})
+        if run_rules:
+            _dispatch_rules(group)
+        group.clear()
+
+    for chunk in _chunks(rows_iter, chunk_rows):
+        for r in chunk:
+            st["rows"] += 1
+            try:
+                if r.get("dispositivo_id") is not None:
+                    dev_id = resolver.by_id(int(r["dispositivo_id"]))
+                elif r.get("serial_number"):
+                    dev_id = resolver.by_serial(str(r["serial_number"]))
+                else:
+                    raise ValueError("sin serial_number ni dispositivo_id")
+                if dev_id is None:
+                    raise ValueError(f"dispositivo desconocido ({r.get('serial_number') or r.get('dispositivo_id')})")
+                row = {"dispositivo_id": dev_id, "estado": r.get("estado"),
+                       "parametros": r.get("parametros") or {},
+                       "timestamp": _parse_ts(r.get("timestamp"), local)}
+            except Exception as e:
+                st["skipped"] += 1
+                if len(st["errors"]) < 20:
+                    st["errors"].append(f"fila {st['rows']}: {e}")
+                continue
+            group.append(row)
+
+        if len(group) >= commit_rows:
+            _commit_group()
+
+        st["seconds"] = round(time.perf_counter() - t0, 3)
+        st["rate"] = round(st["inserted"] / st["seconds"], 1) if st["seconds"] else 0.0
+        st["devices"] = sum(1 for v in resolver.ids.values() if v is not None) + \
+            sum(1 for v in resolver.known_ids.values() if v)
+        st["created"] = resolver.created
+        print(f"[IMPORT] filas={st['rows']} insertadas={st['inserted']} "
+              f"omitidas={st['skipped']} {st['rate']:.0f} filas/s")
+        if progress:
+            progress(dict(st))
+
+    if group:
+        _commit_group()
+    st["seconds"] = round(time.perf_counter() - t0, 3)
+    st["rate"] = round(st["inserted"] / st["seconds"], 1) if st["seconds"] else 0.0
+    return st
+
+def _dispatch_rules(rows: List[Dict[str, Any]]) -> None:
+    """Despacha las reglas como si las muestras llegaran por MQTT (ts histórico)."""
+    from app.iotelligence.core import dispatch_measure
+    devices: Dict[int, Dispositivo] = {}
+    for row in rows:
+        d = devices.get(row["dispositivo_id"]) or db.session.get(Dispositivo, row["dispositivo_id"])
+        devices[row["dispositivo_id"]] = d
+        ts = row["timestamp"].replace(tzinfo=timezone.utc)
+        for k, v in (row["parametros"] or {}).items():
+            dispatch_measure(d, k, v, ts)
+
+def import_file(path: str, **kwargs) -> Dict[str, Any]:
+    """Abre `path` (detecta formato por extensión) e importa. Requiere app context."""
+    fmt = kwargs.pop("fmt", None)
+    if not kwargs.get("serial") and path.lower().endswith(".csv"):
+        kwargs["serial"] = os.path.splitext(os.path.basename(path))[0]
+    with open(path, "r", encoding="utf-8", newline="") as fh:
+        return import_stream(fh, fmt or detect_format(path), **kwargs)
+
+# =========================
+# Trabajos en segundo plano (endpoint)
+# =========================
+_jobs_lock = threading.Lock()
+_jobs: Dict[str, Dict[str, Any]] = {}
+
+def save_upload(src, max_bytes: int) -> Optional[str]:
+    """
+    Copia en bloques un flujo binario (fichero subido o cuerpo de la petición)
+    a un temporal. Devuelve la ruta, o None si supera `max_bytes`.
+    """
+    fd, path = tempfile.mkstemp(prefix="import-", suffix=".tmp")
+    size = 0
+    with os.fdopen(fd, "wb") as out:
+        while True:
+            buf = src.read(1024 * 1024)
+            if not buf:
+                break
+            size += len(buf)
+            if size > max_bytes:
+                out.close()
+                os.remove(path)
+                return None
+            out.write(buf)
+    return path
+
+def start_job(app: Flask, path: str, filename: str, **kwargs) -> str:
+    """
+    Lanza la importación del temporal `path` (ver save_upload) en un hilo con su
+    propio app context y lo borra al terminar; devuelve job_id.
+    """
+    job_id = uuid.uuid4().hex[:12]
+    with open(path, "r", encoding="utf-8-sig", errors="ignore") as fh:
+        head = fh.read(64)
+    fmt = kwargs.pop("fmt", None) or detect_format(filename, head)
+    if not kwargs.get("serial") and fmt == "csv" and filename:
+        kwargs["serial"] = os.path.splitext(os.path.basename(filename))[0]
+    with _jobs_lock:
+        _jobs[job_id] = {"id": job_id, "status": "running", "file": filename, "format": fmt, "progress": {}}
+
+    def _progress(st):
+        with _jobs_lock:
+            _jobs[job_id]["progress"] = st
+
+    def _run():
+        with app.app_context():
+            try:
+                with open(path, "r", encoding="utf-8-sig", newline="") as fh:
+                    res = import_stream(fh, fmt, progress=_progress, **kwargs)
+                with _jobs_lock:
+                    _jobs[job_id].update(status="done", progress=res)
+            except Exception as e:
+                with _jobs_lock:
+                    _jobs[job_id].update(status="error", error=str(e))
+                print("[IMPORT ERROR]", e)
+            finally:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    threading.Thread(target=_run, name=f"Import-{job_id}", daemon=True).start()
+    return job_id
+
+def job(job_id: str) -> Optional[Dict[str, Any]]:
+    with _jobs_lock:
+        j = _jobs.get(job_id)
+        return dict(j) if j else None
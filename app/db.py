@@ -1,5 +1,301 @@
 # app/db.py
+import threading
+from typing import Any, Callable, Dict, List, Optional, Union
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as _FSASession
+from sqlalchemy import PrimaryKeyConstraint, Table, create_engine, event, inspect as sa_inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
 
-#iniciar db con SQLite
-db = SQLAlchemy()
+TELEMETRY = "telemetry"       # bind de estado_log / accion_log / métricas (ver init_binds)
+
+_read_engines: Dict[Any, Any] = {}   # engine de escritura -> pool `query_only` (SQLite, DB_READ_SPLIT)
+_read_by_key: Dict[Optional[str], Any] = {}   # clave de bind -> pool `query_only`
+_local = threading.local()    # .pinned=True: este hilo lee y escribe por la conexión de escritura
+
+class _RoutingSession(_FSASession):
+    """
+    Envía los SELECT al pool de solo lectura de su BD y el resto
+    (INSERT/UPDATE/DELETE, flush, DDL, text()) al engine de escritura. Una vez
+    que la transacción escribe, sus SELECT siguientes también van por la de
+    escritura para leer lo propio sin comitear.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        engine = None
+        if mapper is None and clause is not None:
+            # Flask-SQLAlchemy solo resuelve el bind de un Table suelto: insert(tabla),
+            # delete(tabla) y select(columnas) de Core irían siempre a la BD principal
+            engine = _core_bind(clause, self._db.engines)
+        if engine is None:
+            engine = super().get_bind(mapper=mapper, clause=clause, **kwargs)
+        if _read_engines and not getattr(_local, "pinned", False):
+            if not self._flushing and getattr(clause, "is_select", False) and not self.info.get("_wrote"):
+                return _read_engines.get(engine, engine)
+            if self._flushing or clause is not None:
+                self.info["_wrote"] = True
+        return engine
+
+def _core_bind(clause, engines):
+    table = getattr(clause, "table", None)                 # INSERT / UPDATE / DELETE
+    if table is None and hasattr(clause, "get_final_froms"):
+        froms = clause.get_final_froms()                   # SELECT
+        table = froms[0] if froms else None
+    while table is not None and hasattr(table, "left"):    # JOIN: la tabla de la izquierda
+        table = table.left
+    if isinstance(table, Table):
+        key = table.metadata.info.get("bind_key")
+        if key is not None:
+            return engines.get(key)
+    return None
+
+@event.listens_for(_RoutingSession, "after_transaction_end")
+def _forget_write(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("_wrote", None)
+
+#iniciar db (SQLite por defecto; PostgreSQL si DATABASE_URL)
+# expire_on_commit=False: las instancias que devuelve el escritor único se leen
+# desde otros hilos sin recargar.
+db = SQLAlchemy(session_options={"class_": _RoutingSession, "expire_on_commit": False})
+
+# =========================
+# Binds (BD principal / telemetría)
+# =========================
+def configure_binds(app) -> None:
+    """
+    SQLALCHEMY_BINDS["telemetry"] a partir de TELEMETRY_DATABASE_URI (o de la
+    URI principal si está vacía). Antes de `db.init_app`.
+    """
+    from config import engine_options
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    uri = app.config.get("TELEMETRY_DATABASE_URI") or app.config["SQLALCHEMY_DATABASE_URI"]
+    binds.setdefault(TELEMETRY, {"url": uri, **engine_options(uri)})
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+def init_binds(app) -> List[Optional[str]]:
+    """
+    Un bind con la misma URL que la BD principal comparte su engine (una sola
+    conexión y transacción por fichero, como antes de separar). Con
+    TELEMETRY_DATABASE_URL distinta, la telemetría va a su propio fichero / BD.
+    Requiere app context. Devuelve las claves con engine propio.
+    """
+    engines = db.engines   # dict de Flask-SQLAlchemy para esta app (mutable)
+    default = engines[None]
+    for key, eng in list(engines.items()):
+        if key is not None and eng is not default and eng.url == default.url:
+            eng.dispose()
+            engines[key] = default
+    own = [k for k, e in engines.items() if k is None or e is not default]
+    if len(own) > 1:
+        print(f"[DB] telemetría en BD aparte: {engines[TELEMETRY].url.render_as_string(hide_password=True)}")
+    return own
+
+def distinct_engines() -> Dict[Optional[str], Any]:
+    """clave de bind -> engine, sin repetir engines compartidos (la principal primero)."""
+    out: Dict[Optional[str], Any] = {}
+    for key, eng in db.engines.items():
+        if eng not in out.values():
+            out[key] = eng
+    return out
+
+def all_tables() -> list:
+    """Tablas de todos los binds."""
+    return [t for md in db.metadatas.values() for t in md.sorted_tables]
+
+def engine_for(table) -> Any:
+    """Engine de escritura de una tabla (objeto Table, modelo o nombre)."""
+    if isinstance(table, str):
+        table = next(t for t in all_tables() if t.name == table)
+    table = getattr(table, "__table__", table)
+    return db.engines[table.metadata.info.get("bind_key")]
+
+def _pragma_key(engine) -> str:
+    return "TELEMETRY_SQLITE_PRAGMAS" if engine is not db.engines[None] else "SQLITE_PRAGMAS"
+
+def init_sqlite_pragmas(app) -> int:
+    """
+    PRAGMAs por conexión de cada BD SQLite: SQLITE_PRAGMAS (principal) y
+    TELEMETRY_SQLITE_PRAGMAS (telemetría aparte). Se aplican en cada conexión
+    nueva del pool (synchronous, cache_size... son por conexión; journal_mode
+    queda persistido en el fichero). Requiere app context.
+    """
+    n = 0
+    for eng in distinct_engines().values():
+        if eng.dialect.name != "sqlite":
+            continue
+        pragmas = dict(app.config.get(_pragma_key(eng)) or {})
+
+        @event.listens_for(eng, "connect")
+        def _apply(dbapi_conn, _record, pragmas=pragmas):
+            cur = dbapi_conn.cursor()
+            for k, v in pragmas.items():
+                cur.execute(f"PRAGMA {k}={v}")
+            cur.close()
+
+        eng.dispose()   # las conexiones ya abiertas (create_all) se rehacen con los pragmas
+        n += 1
+        print(f"[DB] {eng.url.database}: " + ", ".join(f"{k}={v}" for k, v in pragmas.items()))
+    return n
+
+def init_read_split(app) -> bool:
+    """
+    SQLite en fichero + DB_READ_SPLIT: crea un pool de lectura (`PRAGMA
+    query_only=ON`) por cada BD (principal y, si está aparte, telemetría). El
+    escritor único (`app.writer`) se queda con las de escritura. En
+    PostgreSQL no hace falta (MVCC, varios escritores).
+    """
+    if not app.config.get("DB_READ_SPLIT", True) or _read_engines:
+        return False
+    for key, eng in distinct_engines().items():
+        if eng.dialect.name != "sqlite" or eng.url.database in (None, "", ":memory:"):
+            continue
+        rd = create_engine(
+            eng.url,
+            connect_args={"check_same_thread": False, "timeout": 30},
+            pool_size=int(app.config.get("DB_READ_POOL_SIZE", 8)),
+            max_overflow=int(app.config.get("DB_READ_MAX_OVERFLOW", 8)),
+            pool_pre_ping=True,
+        )
+        pragmas = {k: v for k, v in (app.config.get(_pragma_key(eng)) or {}).items()
+                   if k not in ("journal_mode", "auto_vacuum")}   # persistentes: solo la de escritura
+
+        @event.listens_for(rd, "connect")
+        def _query_only(dbapi_conn, _record, pragmas=pragmas):
+            cur = dbapi_conn.cursor()
+            for k, v in pragmas.items():
+                cur.execute(f"PRAGMA {k}={v}")
+            cur.execute("PRAGMA query_only=ON")
+            cur.close()
+
+        _read_engines[eng] = rd
+        for k, e in db.engines.items():
+            if e is eng:
+                _read_by_key[k] = rd
+    if not _read_engines:
+        return False
+    print(f"[DB] lecturas por pool query_only (size={app.config.get('DB_READ_POOL_SIZE', 8)}, "
+          f"bds={len(_read_engines)})")
+    return True
+
+def read_engine(key: Optional[str] = None):
+    return _read_by_key.get(key)
+
+def pin_writes() -> None:
+    """El hilo actual deja de usar el pool de lectura (escritor único, scripts de mantenimiento)."""
+    _local.pinned = True
+
+def add_missing_columns() -> List[str]:
+    """
+    create_all no altera tablas existentes: añade con ALTER TABLE las columnas
+    nuevas que admiten NULL (las filas previas quedan a NULL). Devuelve "tabla.columna".
+    """
+    added: List[str] = []
+    for table in all_tables():
+        eng = engine_for(table)
+        insp = sa_inspect(eng)
+        if not insp.has_table(table.name):
+            continue
+        have = {c["name"] for c in insp.get_columns(table.name)}
+        with eng.begin() as conn:
+            for col in table.columns:
+                if col.name in have or col.primary_key or not col.nullable:
+                    continue
+                ddl = col.type.compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{col.name}" {ddl}'))
+                added.append(f"{table.name}.{col.name}")
+    if added:
+        print(f"[DB] columnas añadidas: {', '.join(added)}")
+    return added
+
+def copy_bind_tables(key: str = TELEMETRY, chunk: int = 5000, drop_source: bool = False) -> Dict[str, Any]:
+    """
+    Copia las tablas del bind `key` que aún estén en la BD principal a su BD
+    propia (tras configurar p.ej. TELEMETRY_DATABASE_URL). Solo tablas vacías
+    en destino; con `drop_source` las borra del origen cuando los conteos
+    coinciden. Con el backend parado.
+    """
+    from sqlalchemy import func, select
+    src, dst = db.engines[None], db.engines[key]
+    if src is dst:
+        return {"skipped": f"el bind '{key}' usa la BD principal"}
+    out: Dict[str, Any] = {}
+    src_tables = set(sa_inspect(src).get_table_names())
+    for table in db.metadatas[key].sorted_tables:
+        if table.name not in src_tables:
+            continue
+        with dst.connect() as dc:
+            if dc.execute(select(func.count()).select_from(table)).scalar():
+                out[table.name] = "destino con filas: omitida"
+                continue
+        copied = 0
+        with src.connect() as sc, dst.begin() as dc:
+            res = sc.execution_options(stream_results=True).execute(select(table))
+            while True:
+                rows = res.fetchmany(chunk)
+                if not rows:
+                    break
+                dc.execute(table.insert(), [r._asdict() for r in rows])
+                copied += len(rows)
+        with src.connect() as sc:
+            n_src = sc.execute(select(func.count()).select_from(table)).scalar()
+        out[table.name] = {"rows": copied, "source_rows": n_src}
+        if drop_source and n_src == copied:
+            with src.begin() as sc:
+                sc.execute(text(f'DROP TABLE "{table.name}"'))
+            out[table.name]["dropped"] = True
+        print(f"[DB] {table.name}: {copied} filas copiadas al bind '{key}'")
+    return out
+
+def dialect_name() -> str:
+    return db.session.get_bind().dialect.name
+
+def is_postgres() -> bool:
+    return dialect_name() == "postgresql"
+
+def monthly_partitioned(column: str) -> Dict[str, Any]:
+    """
+    kwargs de `__table_args__` para una tabla particionada por rango mensual
+    en PostgreSQL (en SQLite no tiene efecto). Las particiones las crea
+    `app.partitions`.
+    """
+    return {"postgresql_partition_by": f"RANGE ({column})", "info": {"partition_key": column}}
+
+@compiles(PrimaryKeyConstraint, "postgresql")
+def _pk_with_partition_key(constraint, compiler, **kw):
+    # PostgreSQL exige que la PK de una tabla particionada incluya la clave de partición:
+    # PRIMARY KEY (id) -> PRIMARY KEY (id, timestamp). El modelo ORM sigue usando solo `id`.
+    sql = compiler.visit_primary_key_constraint(constraint, **kw)
+    table = constraint.table
+    key = table.info.get("partition_key") if table is not None else None
+    if not sql or not key or key in constraint.columns.keys():
+        return sql
+    cut = sql.index(")", sql.index("PRIMARY KEY ("))
+    return sql[:cut] + ", " + compiler.preparer.quote(key) + sql[cut:]
+
+def insert(model):
+    """`INSERT` del dialecto activo (SQLite / PostgreSQL), con soporte de ON CONFLICT."""
+    return (postgresql.insert if is_postgres() else sqlite.insert)(model)
+
+def upsert_returning(model, rows: Union[Dict[str, Any], List[Dict[str, Any]]], *, key: str,
+                     update: Union[None, Dict[str, Any], Callable[[Any], Dict[str, Any]]] = None,
+                     where=None) -> list:
+    """
+    `INSERT ... ON CONFLICT(key) DO UPDATE ... RETURNING <fila>` en UNA sentencia.
+    Devuelve las instancias ORM (insertadas o existentes) sin excepciones ni
+    reintentos por carreras de alta.
+      - update=None      -> no-op (SET key = excluded.key): devuelve la fila existente tal cual
+      - update=dict      -> valores a fijar si ya existía
+      - update=callable  -> recibe `excluded` y devuelve el dict de valores
+      - where            -> condición del DO UPDATE; si no se cumple la fila NO se devuelve
+    """
+    stmt = insert(model).values(rows)
+    if update is None:
+        set_ = {key: stmt.excluded[key]}
+    elif callable(update):
+        set_ = update(stmt.excluded)
+    else:
+        set_ = update
+    stmt = stmt.on_conflict_do_update(index_elements=[key], set_=set_, where=where).returning(model)
+    return db.session.scalars(stmt, execution_options={"populate_existing": True}).all()
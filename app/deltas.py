@@ -0,0 +1,187 @@
+# app/deltas.py
+"""
+Almacenamiento delta de `EstadoLog.parametros` y del payload de
+`AccionLog.detalle` (evento "config_changed").
+
+Por dispositivo se guarda cada DELTA_KEYFRAME_EVERY filas un *keyframe* (el
+dict completo, igual que siempre) y, entre medias, solo lo que cambió
+respecto a ese keyframe:
+
+    {"_k": "<timestamp ISO del keyframe>",
+     "_d": {clave: valor nuevo},          # añadidas / modificadas
+     "_x": [clave borrada, ...],
+     "_p": {clave: <parche anidado>}}     # dicts anidados (configuracion, ...)
+
+El delta es acumulado respecto al keyframe (no a la fila anterior): para
+reconstruir una fila basta con su keyframe, que se localiza por
+(dispositivo_id, timestamp) con el índice existente, aunque entre medias haya
+filas importadas o archivadas. Si el parche deja de compensar (la mitad de
+las claves del estado) se escribe un keyframe nuevo.
+
+Las filas antiguas (dicts sin "_k") son keyframes: la lectura es compatible.
+El codificador vive en memoria y solo lo usa el escritor único; tras un
+rollback se reinicia (la siguiente fila de cada dispositivo es keyframe).
+
+Lectura: `expand_estado(items)` / `expand_accion(items)` sobre dicts con
+`dispositivo_id`, `timestamp` y `parametros` / `detalle` (y `evento`).
+"""
+from __future__ import annotations
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app import writer
+from app.db import db
+from app.models import AccionLog, EstadoLog
+
+KEY, SET, DEL, SUB = "_k", "_d", "_x", "_p"
+ACCION_EVENTS = ("config_changed",)
+
+def is_delta(v) -> bool:
+    return isinstance(v, dict) and KEY in v
+
+# =========================
+# Parches
+# =========================
+def diff(base: Dict[str, Any], cur: Dict[str, Any]) -> Dict[str, Any]:
+    """Parche que convierte `base` en `cur` (recursivo en dicts anidados)."""
+    out: Dict[str, Any] = {}
+    for k, v in cur.items():
+        if k not in base:
+            out.setdefault(SET, {})[k] = v
+            continue
+        old = base[k]
+        if old == v and type(old) is type(v):
+            continue
+        if isinstance(old, dict) and isinstance(v, dict):
+            out.setdefault(SUB, {})[k] = diff(old, v)
+        else:
+            out.setdefault(SET, {})[k] = v
+    gone = [k for k in base if k not in cur]
+    if gone:
+        out[DEL] = gone
+    return out
+
+def patch(base: Dict[str, Any], p: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(base)
+    for k in p.get(DEL, ()):
+        out.pop(k, None)
+    out.update(p.get(SET, {}))
+    for k, sub in p.get(SUB, {}).items():
+        out[k] = patch(out.get(k) if isinstance(out.get(k), dict) else {}, sub)
+    return out
+
+def _weight(p: Dict[str, Any]) -> int:
+    return len(p.get(SET, ())) + len(p.get(DEL, ())) + sum(_weight(s) for s in p.get(SUB, {}).values())
+
+# =========================
+# Codificador (hilo escritor)
+# =========================
+class Encoder:
+    """Estado por dispositivo: (ts ISO del keyframe, keyframe, filas desde el keyframe)."""
+
+    def __init__(self) -> None:
+        self._last: Dict[int, Tuple[str, Dict[str, Any], int]] = {}
+        self._lock = threading.Lock()
+
+    def encode(self, dev_id: int, full: Dict[str, Any], ts: datetime) -> Dict[str, Any]:
+        """Devuelve lo que hay que guardar para `full` (keyframe o parche)."""
+        from flask import current_app
+        cfg = current_app.config
+        full = full or {}
+        if not cfg.get("DELTA_ENABLED", True) or not isinstance(full, dict):
+            return full
+        every = int(cfg.get("DELTA_KEYFRAME_EVERY", 32))
+        with self._lock:
+            last = self._last.get(dev_id)
+            if last is not None and last[2] + 1 < every:
+                kts, kf, n = last
+                p = diff(kf, full)
+                if _weight(p) * 2 < max(len(full), 1):
+                    self._last[dev_id] = (kts, kf, n + 1)
+                    return {KEY: kts, **p}
+            self._last[dev_id] = (ts.isoformat(), full, 0)
+        return full
+
+    def forget(self, dev_id: int) -> None:
+        with self._lock:
+            self._last.pop(dev_id, None)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._last.clear()
+
+estado = Encoder()
+accion = Encoder()
+
+def reset() -> None:
+    estado.reset()
+    accion.reset()
+
+writer.add_rollback_listener(reset)
+
+def encode_payload_detalle(dev_id: int, detalle: Dict[str, Any], ts: datetime) -> Dict[str, Any]:
+    """`{"payload": data}` de config_changed -> `{"payload": <keyframe o parche>}`."""
+    return {**detalle, "payload": accion.encode(dev_id, detalle.get("payload") or {}, ts)}
+
+# =========================
+# Reconstrucción (lectura)
+# =========================
+def _keyframes(model, field: str, dev_id: int, stamps: Iterable[str], evento: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    wanted = {datetime.fromisoformat(s) for s in stamps}
+    q = db.session.query(model.timestamp, getattr(model, field)).filter(
+        model.dispositivo_id == dev_id, model.timestamp.in_(wanted))
+    if evento:
+        q = q.filter(model.evento == evento)
+    out: Dict[str, Dict[str, Any]] = {}
+    for ts, val in q.all():
+        if evento:
+            val = (val or {}).get("payload")
+        if isinstance(val, dict) and not is_delta(val):
+            out[ts.isoformat()] = val
+    missing = wanted - {datetime.fromisoformat(s) for s in out}
+    if missing:
+        # Keyframe ya archivado (app/archive.py guarda filas completas)
+        from app import archive
+        table = "estado" if model is EstadoLog else "accion"
+        for ts in missing:
+            for r in archive.read_range(table, dev_id, since=ts, until=ts):
+                val = r.get(field)
+                if evento:
+                    if r.get("evento") != evento:
+                        continue
+                    val = (val or {}).get("payload")
+                if isinstance(val, dict) and not is_delta(val):
+                    out[ts.isoformat()] = val
+    return out
+
+def _expand(model, field: str, items: List[Dict[str, Any]], get, put, evento: Optional[str] = None) -> List[Dict[str, Any]]:
+    need: Dict[int, set] = {}
+    for it in items:
+        v = get(it)
+        if is_delta(v):
+            need.setdefault(it["dispositivo_id"], set()).add(v[KEY])
+    if not need:
+        return items
+    frames = {dev: _keyframes(model, field, dev, stamps, evento) for dev, stamps in need.items()}
+    for it in items:
+        v = get(it)
+        if is_delta(v):
+            # Sin keyframe (borrado a mano) se devuelve lo que hay: solo lo cambiado
+            put(it, patch(frames[it["dispositivo_id"]].get(v[KEY], {}), v))
+    return items
+
+def expand_estado(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Rellena `parametros` completos en dicts {dispositivo_id, timestamp, parametros, ...}."""
+    return _expand(EstadoLog, "parametros", items,
+                   lambda it: it.get("parametros"),
+                   lambda it, full: it.__setitem__("parametros", full))
+
+def expand_accion(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Rellena `detalle.payload` completo en dicts {dispositivo_id, evento, timestamp, detalle, ...}."""
+    def get(it):
+        d = it.get("detalle")
+        return d.get("payload") if it.get("evento") in ACCION_EVENTS and isinstance(d, dict) else None
+    def put(it, full):
+        it["detalle"] = {**it["detalle"], "payload": full}
+    return _expand(AccionLog, "detalle", items, get, put, evento="config_changed")
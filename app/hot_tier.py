@@ -0,0 +1,441 @@
+# app/hot_tier.py
+"""
+Capa caliente en memoria: las últimas HOT_TIER_HOURS horas de cada métrica
+numérica por dispositivo, comprimidas al estilo Gorilla.
+
+Cada serie (device_id, metric_id) es una lista de bloques de hasta
+HOT_TIER_BLOCK_POINTS puntos (o HOT_TIER_BLOCK_SECONDS de tramo). Dentro del
+bloque, sobre palabras de 64 bits (`array('Q')`):
+  - timestamps en microsegundos con delta-of-delta (0 -> 1 bit; si no,
+    prefijo + 7/14/21/32/64 bits con signo);
+  - valores float64 con XOR contra el anterior (0 -> 1 bit; si no, solo los
+    bits significativos, reutilizando la ventana de ceros previa si cabe).
+Los bloques cerrados son inmutables; los vencidos se descartan enteros.
+
+Coherencia con `metric_sample`:
+  - las muestras entran DESPUÉS del commit del escritor único (se preparan
+    en `metrics.insert_samples` y se descartan si hay rollback);
+  - un dispositivo solo es "caliente" tras cargarse de BD (`_reload`, también
+    una intención del escritor): la serie se instala tras el commit de su
+    lote y las muestras preparadas antes en ese lote, que la carga ya leyó
+    de la sesión, no se vuelven a añadir. Hasta entonces,
+    o si llega una muestra fuera de orden, o tras `invalidate()` (importación
+    masiva, que escribe fuera del escritor), está "frío" y se lee de SQL;
+  - `series()` solo responde si el rango pedido está cubierto (desde >= suelo
+    de la serie, o las `limit` más recientes caen dentro); si no, None.
+`maintenance.py backfill-metrics` corre en otro proceso: reinicia el backend.
+"""
+from __future__ import annotations
+import struct, threading
+from array import array
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from flask import Flask
+
+from app import registry, writer
+from app.db import db
+from app.models import MetricSample
+
+_EPOCH = datetime(1970, 1, 1)
+_US = timedelta(microseconds=1)
+_M64 = (1 << 64) - 1
+_F64 = struct.Struct("<d")
+_U64 = struct.Struct("<Q")
+
+_app: Flask | None = None
+_thread: Optional[threading.Thread] = None
+_stop = threading.Event()
+_wake = threading.Event()
+_lock = threading.Lock()
+_devs: Dict[int, Dict[int, "_Series"]] = {}   # dispositivos calientes -> metric_id -> serie
+_from: Dict[int, int] = {}                     # dispositivo -> inicio (us) de lo cargado de BD
+_cold: Set[int] = set()                        # pendientes de (re)carga
+_gen: Dict[int, int] = {}                      # invalidaciones (carga en curso obsoleta)
+_local = threading.local()                     # muestras y cargas de la transacción en curso
+_stats: Dict[str, int] = {"hits": 0, "misses": 0, "reloads": 0, "evicted_blocks": 0, "out_of_order": 0}
+
+def _us(ts: datetime) -> int:
+    return (ts - _EPOCH) // _US
+
+def _dt(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+# =========================
+# Bloques comprimidos
+# =========================
+class _Block:
+    __slots__ = ("t0", "t_last", "n", "words", "cur", "nbits", "delta", "v", "lead", "trail", "sealed")
+
+    def __init__(self):
+        self.words = array("Q")
+        self.cur = self.nbits = 0
+        self.n = self.t0 = self.t_last = self.delta = self.v = 0
+        self.lead = self.trail = -1
+        self.sealed = False
+
+    def _write(self, value: int, nbits: int) -> None:
+        free = 64 - self.nbits
+        if nbits < free:
+            self.cur = (self.cur << nbits) | value
+            self.nbits += nbits
+            return
+        rest = nbits - free
+        self.words.append(((self.cur << free) | (value >> rest)) & _M64)
+        self.cur = value & ((1 << rest) - 1)
+        self.nbits = rest
+
+    def append(self, t: int, v: float) -> None:
+        bits = _U64.unpack(_F64.pack(v))[0]
+        if self.n == 0:
+            self.t0 = self.t_last = t
+            self.v = bits
+            self._write(bits, 64)
+            self.n = 1
+            return
+        delta = t - self.t_last
+        dod = delta - self.delta
+        if dod == 0:
+            self._write(0, 1)
+        elif -64 <= dod < 64:
+            self._write((0b10 << 7) | (dod & 0x7F), 9)
+        elif -8192 <= dod < 8192:
+            self._write((0b110 << 14) | (dod & 0x3FFF), 17)
+        elif -(1 << 20) <= dod < (1 << 20):
+            self._write((0b1110 << 21) | (dod & 0x1FFFFF), 25)
+        elif -(1 << 31) <= dod < (1 << 31):
+            self._write((0b11110 << 32) | (dod & 0xFFFFFFFF), 37)
+        else:
+            self._write(0b11111, 5)
+            self._write(dod & _M64, 64)
+        self.delta, self.t_last = delta, t
+
+        x = bits ^ self.v
+        if x == 0:
+            self._write(0, 1)
+        else:
+            lead = min(64 - x.bit_length(), 31)
+            trail = (x & -x).bit_length() - 1
+            if self.lead >= 0 and lead >= self.lead and trail >= self.trail:
+                self._write(0b10, 2)
+                self._write(x >> self.trail, 64 - self.lead - self.trail)
+            else:
+                sig = 64 - lead - trail
+                self._write((0b11 << 11) | (lead << 6) | (sig & 63), 13)
+                self._write(x >> trail, sig)
+                self.lead, self.trail = lead, trail
+        self.v = bits
+        self.n += 1
+
+    def seal(self) -> None:
+        if self.nbits:
+            self.words.append((self.cur << (64 - self.nbits)) & _M64)
+            self.cur = self.nbits = 0
+        self.sealed = True
+
+    def snapshot(self) -> Tuple[Any, int, int, int]:
+        """(palabras, nº palabras, cola alineada a la izquierda o -1, puntos). Bajo `_lock`."""
+        tail = (self.cur << (64 - self.nbits)) & _M64 if self.nbits else -1
+        return self.words, len(self.words), tail, self.n
+
+    def nbytes(self) -> int:
+        return len(self.words) * 8 + (8 if self.nbits else 0)
+
+def _decode(t0: int, snap: Tuple[Any, int, int, int]) -> Tuple[List[int], List[float]]:
+    arr, nw, tail, n = snap
+    words = list(arr[:nw])
+    if tail >= 0:
+        words.append(tail)
+    pos = 0
+
+    def read(nbits: int) -> int:
+        nonlocal pos
+        i, off = pos >> 6, pos & 63
+        end = off + nbits
+        pos += nbits
+        if end <= 64:
+            return (words[i] >> (64 - end)) & ((1 << nbits) - 1)
+        rest = end - 64
+        return ((words[i] & ((1 << (64 - off)) - 1)) << rest) | (words[i + 1] >> (64 - rest))
+
+    v = read(64)
+    ts, vals = [t0], [_F64.unpack(_U64.pack(v))[0]]
+    t, delta, lead, trail = t0, 0, 0, 0
+    for _ in range(n - 1):
+        if read(1) == 0:
+            dod = 0
+        elif read(1) == 0:
+            dod = read(7); dod -= (dod >> 6) << 7
+        elif read(1) == 0:
+            dod = read(14); dod -= (dod >> 13) << 14
+        elif read(1) == 0:
+            dod = read(21); dod -= (dod >> 20) << 21
+        elif read(1) == 0:
+            dod = read(32); dod -= (dod >> 31) << 32
+        else:
+            dod = read(64); dod -= (dod >> 63) << 64
+        delta += dod
+        t += delta
+        if read(1):
+            if read(1):
+                lead = read(5)
+                sig = read(6) or 64
+                trail = 64 - lead - sig
+            v ^= read(64 - lead - trail) << trail
+        ts.append(t)
+        vals.append(_F64.unpack(_U64.pack(v))[0])
+    return ts, vals
+
+class _Series:
+    __slots__ = ("blocks", "floor", "last_t")
+
+    def __init__(self, floor: int):
+        self.blocks: List[_Block] = []
+        self.floor = floor     # lo anterior a este instante (us) no está en memoria
+        self.last_t = None
+
+    def append(self, t: int, v: float, max_points: int, max_span: int) -> None:
+        b = self.blocks[-1] if self.blocks else None
+        if b is None or b.sealed or b.n >= max_points or (b.n and t - b.t0 >= max_span):
+            if b is not None and not b.sealed:
+                b.seal()
+            b = _Block()
+            self.blocks.append(b)
+        b.append(t, v)
+        self.last_t = t
+
+    def evict(self, cut: int) -> int:
+        n = 0
+        while self.blocks and self.blocks[0].t_last < cut:
+            self.floor = max(self.floor, self.blocks.pop(0).t_last + 1)
+            n += 1
+        return n
+
+# =========================
+# Ciclo de vida
+# =========================
+def init(app: Flask) -> None:
+    """Arranca el hilo de carga/expiración (idempotente). Requiere el escritor único."""
+    global _app, _thread
+    _app = app
+    if _thread is not None or not app.config.get("HOT_TIER_ENABLED", True):
+        return
+    if not app.config.get("DB_WRITER_ENABLED", True):
+        print("[HOT] desactivado: requiere el escritor único (DB_WRITER_ENABLED)")
+        return
+    _thread = threading.Thread(target=_loop, args=(app,), name="HotTier", daemon=True)
+    _thread.start()
+    print(f"[HOT] capa caliente activa ({app.config.get('HOT_TIER_HOURS', 6)}h por serie)")
+
+def stop() -> None:
+    _stop.set()
+    _wake.set()
+
+def enabled() -> bool:
+    return _thread is not None and not _stop.is_set()
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        out = dict(_stats)
+        out.update(enabled=enabled(), devices=len(_devs), cold=len(_cold),
+                   series=sum(len(s) for s in _devs.values()))
+        points = nbytes = 0
+        for ser in _devs.values():
+            for s in ser.values():
+                for b in s.blocks:
+                    points += b.n
+                    nbytes += b.nbytes()
+    out.update(points=points, bytes=nbytes, bytes_per_point=round(nbytes / points, 2) if points else 0.0)
+    return out
+
+# =========================
+# Escritura (hilo escritor, tras el commit)
+# =========================
+def stage(rows: List[Dict[str, Any]]) -> None:
+    """Prepara filas de metric_sample de la intención en curso (solo en el escritor)."""
+    if rows and enabled() and writer.in_writer():
+        pending = getattr(_local, "rows", None)
+        if pending is None:
+            pending = _local.rows = []
+        pending.extend(rows)
+
+def _discard() -> None:
+    _local.rows = _local.loads = None
+
+def _committed() -> None:
+    rows = getattr(_local, "rows", None)
+    loads = getattr(_local, "loads", None)
+    if not rows and not loads:
+        return
+    _local.rows = _local.loads = None
+    cfg = _app.config
+    max_points = int(cfg.get("HOT_TIER_BLOCK_POINTS", 512))
+    max_span = int(float(cfg.get("HOT_TIER_BLOCK_SECONDS", 1800)) * 1e6)
+    woke = False
+    with _lock:
+        seen: Dict[int, int] = {}   # dispositivo recargado -> filas preparadas que su carga ya leyó
+        for built, gens, floor, staged in loads or ():
+            for dev, ser in built.items():
+                if _gen.get(dev, 0) != gens[dev] or dev not in _cold:
+                    continue   # invalidado (u olvidado) mientras se cargaba
+                _devs[dev] = ser
+                _from[dev] = floor
+                _cold.discard(dev)
+                seen[dev] = staged
+            _stats["reloads"] += len(built)
+        for i, r in enumerate(rows or ()):
+            dev = r["device_id"]
+            if i < seen.get(dev, 0):
+                continue
+            ser = _devs.get(dev)
+            if ser is None:
+                if dev not in _cold:
+                    _cold.add(dev)   # primera muestra desde el arranque: cargar de BD
+                    woke = True
+                continue
+            t = _us(r["ts"])
+            s = ser.get(r["metric_id"])
+            if s is None:
+                s = ser[r["metric_id"]] = _Series(_from.get(dev, 0))
+            elif s.last_t is not None and t < s.last_t:
+                # Fuera de orden: el dispositivo vuelve a SQL hasta recargarlo
+                _devs.pop(dev, None)
+                _cold.add(dev)
+                _stats["out_of_order"] += 1
+                woke = True
+                continue
+            s.append(t, float(r["value"]), max_points, max_span)
+    if woke:
+        _wake.set()
+
+writer.add_commit_listener(_committed)
+writer.add_rollback_listener(_discard)
+
+def invalidate(dev_ids) -> None:
+    """Tras escribir muestras fuera del escritor (ya comiteadas): recargar de BD."""
+    if not enabled():
+        return
+    with _lock:
+        for dev in dev_ids:
+            _devs.pop(dev, None)
+            _cold.add(dev)
+            _gen[dev] = _gen.get(dev, 0) + 1
+    _wake.set()
+
+def forget(dev_id: int) -> None:
+    """Dispositivo eliminado: fuera de memoria (se relee de SQL si se pide)."""
+    with _lock:
+        _devs.pop(dev_id, None)
+        _cold.discard(dev_id)
+        _from.pop(dev_id, None)
+        _gen[dev_id] = _gen.get(dev_id, 0) + 1
+
+# =========================
+# Carga desde BD (intención del escritor)
+# =========================
+def _reload(dev_ids: List[int], cutoff: datetime) -> int:
+    with _lock:
+        gens = {d: _gen.get(d, 0) for d in dev_ids}
+    cfg = _app.config
+    max_points = int(cfg.get("HOT_TIER_BLOCK_POINTS", 512))
+    max_span = int(float(cfg.get("HOT_TIER_BLOCK_SECONDS", 1800)) * 1e6)
+    floor = _us(cutoff)
+    built: Dict[int, Dict[int, _Series]] = {d: {} for d in dev_ids}
+    rows = db.session.query(MetricSample.device_id, MetricSample.metric_id, MetricSample.ts, MetricSample.value) \
+        .filter(MetricSample.device_id.in_(dev_ids), MetricSample.ts >= cutoff) \
+        .order_by(MetricSample.device_id, MetricSample.metric_id, MetricSample.ts).all()
+    for dev, mid, ts, value in rows:
+        s = built[dev].get(mid)
+        if s is None:
+            s = built[dev][mid] = _Series(floor)
+        s.append(_us(ts), float(value), max_points, max_span)
+    # Se instala en `_committed`; la consulta, en la misma transacción, ya ve las
+    # muestras preparadas antes en este lote: esas no se añaden otra vez
+    loads = getattr(_local, "loads", None)
+    if loads is None:
+        loads = _local.loads = []
+    loads.append((built, gens, floor, len(getattr(_local, "rows", None) or ())))
+    return len(rows)
+
+# =========================
+# Lectura
+# =========================
+def series(device_id: int, metric_id: int, since: Optional[datetime], until: Optional[datetime],
+           limit: Optional[int], newest: bool) -> Optional[List[Tuple[datetime, float]]]:
+    """Igual que `metrics.series` (ts naive UTC) si el rango está en memoria; si no, None."""
+    if not enabled():
+        return None
+    with _lock:
+        ser = _devs.get(device_id)
+        if ser is None:
+            _stats["misses"] += 1
+            return None
+        s = ser.get(metric_id)
+        floor = s.floor if s is not None else _from.get(device_id, 0)
+        snaps = [(b.t0, b.t_last, b.snapshot()) for b in s.blocks] if s is not None else []
+    lo = _us(since) if since is not None else None
+    hi = _us(until) if until is not None else None
+    covered = lo is not None and lo >= floor
+    if not covered and not (newest and limit):
+        with _lock:
+            _stats["misses"] += 1
+        return None
+
+    out: List[Tuple[int, float]] = []
+    blocks = [x for x in snaps if (lo is None or x[1] >= lo) and (hi is None or x[0] <= hi)]
+    if newest and limit:
+        for t0, _, snap in reversed(blocks):
+            ts, vals = _decode(t0, snap)
+            part = [(t, v) for t, v in zip(ts, vals) if (lo is None or t >= lo) and (hi is None or t <= hi)]
+            out[:0] = part
+            if len(out) >= limit:
+                break
+        out = out[-int(limit):]
+        if not covered and len(out) < limit:
+            with _lock:
+                _stats["misses"] += 1
+            return None   # faltan puntos anteriores al suelo: a SQL
+    else:
+        for t0, _, snap in blocks:
+            ts, vals = _decode(t0, snap)
+            out.extend((t, v) for t, v in zip(ts, vals) if (lo is None or t >= lo) and (hi is None or t <= hi))
+            if limit and len(out) >= limit:
+                break
+        if limit:
+            out = out[:int(limit)]
+    with _lock:
+        _stats["hits"] += 1
+    return [(_dt(t), v) for t, v in out]
+
+# =========================
+# Mantenimiento
+# =========================
+def run_once(app: Flask) -> None:
+    """Expira bloques vencidos y carga los dispositivos fríos (por tandas)."""
+    hours = float(app.config.get("HOT_TIER_HOURS", 6))
+    cutoff = datetime.utcnow() - timedelta(hours=hours)
+    cut = _us(cutoff)
+    evicted = 0
+    with _lock:
+        for ser in _devs.values():
+            for s in ser.values():
+                evicted += s.evict(cut)
+        _stats["evicted_blocks"] += evicted
+        cold = sorted(d for d in _cold if registry.get_by_id(d) is not None)
+    chunk = max(1, int(app.config.get("HOT_TIER_RELOAD_CHUNK", 100)))
+    for i in range(0, len(cold), chunk):
+        if _stop.is_set():
+            return
+        writer.run(_reload, cold[i:i + chunk], cutoff)
+
+def _loop(app: Flask) -> None:
+    interval = float(app.config.get("HOT_TIER_INTERVAL_S", 30))
+    with app.app_context():
+        while not _stop.is_set():
+            _wake.clear()
+            try:
+                run_once(app)
+            except Exception as e:
+                db.session.rollback()
+                print("[HOT ERROR]", e)
+            _wake.wait(interval)
@@ -0,0 +1,330 @@
+# app/ingest.py
+"""
+Ingesta write-behind de mensajes de estado (MQTT).
+
+El callback de paho solo parsea y encola; un hilo dedicado drena la cola y
+entrega cada lote al escritor único (`app.writer`) como una intención:
+muchos updates de `Dispositivo` + inserts de `EstadoLog` en UNA transacción. El flush se dispara por tamaño
+(INGEST_BATCH_MAX) o por tiempo (INGEST_FLUSH_MS desde el primer mensaje).
+Tras el commit se notifica por SSE y se despachan las reglas IoTelligence.
+Las muestras sin cambios (ver app/storage_policy.py) no se persisten.
+"""
+from __future__ import annotations
+import atexit, threading, time
+from datetime import datetime, timezone
+from queue import Queue, Empty, Full
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from flask import Flask
+
+from app.db import db, upsert_returning
+from app import deltas, metrics, partitions, registry, storage_policy, writer
+from app.models import Dispositivo, EstadoLog
+from app.sse import publish as sse_publish
+from app.iotelligence.core import dispatch_measure
+
+_app: Flask | None = None
+_queue: Queue | None = None
+_thread: threading.Thread | None = None
+_stop = threading.Event()
+_stats_lock = threading.Lock()
+_stats: Dict[str, Any] = {
+    "enqueued": 0,
+    "dropped_full": 0,
+    "flushes": 0,
+    "written": 0,
+    "suppressed": 0,
+    "last_batch": 0,
+    "last_commit_ms": 0.0,
+}
+
+def init(app: Flask) -> None:
+    """Arranca el hilo escritor (idempotente)."""
+    global _app, _queue, _thread
+    _app = app
+    if _thread is not None:
+        return
+    _queue = Queue(maxsize=int(app.config.get("INGEST_QUEUE_MAX", 10000)))
+    _thread = threading.Thread(target=_writer_loop, args=(app,), name="IngestWriter", daemon=True)
+    _thread.start()
+    atexit.register(stop)
+    print(f"[INGEST] writer started (batch_max={app.config.get('INGEST_BATCH_MAX', 500)}, "
+          f"flush_ms={app.config.get('INGEST_FLUSH_MS', 200)})")
+
+def stop(timeout: float = 5.0) -> None:
+    """Pide al escritor que vacíe la cola y termine (se usa en atexit)."""
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=timeout)
+
+def _count(key: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[key] = _stats.get(key, 0) + n
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        out = dict(_stats)
+    out["queued"] = _queue.qsize() if _queue is not None else 0
+    return out
+
+def submit(msg: Dict[str, Any], block: bool = False) -> bool:
+    """
+    Encola un mensaje ya parseado:
+      {"serial_number", "estado", "parametros", "configuracion", "ts"}
+    block=True espera hueco (lo usan las carriles: la presión se propaga
+    hacia atrás hasta el control de admisión). Sin bloqueo, devuelve False
+    si la cola está llena (el mensaje se descarta).
+    """
+    if _queue is None:
+        raise RuntimeError("Ingesta no inicializada. Llama init(app) en create_app().")
+    msg.setdefault("ts", datetime.now(timezone.utc))
+    try:
+        _queue.put(msg, block=block)
+    except Full:
+        _count("dropped_full")
+        print(f"[INGEST] ⚠ cola llena, descartado: {msg.get('serial_number')}")
+        return False
+    _count("enqueued")
+    return True
+
+# =========================
+# Hilo escritor
+# =========================
+def _drain(first: Dict[str, Any], batch_max: int, flush_s: float) -> List[Dict[str, Any]]:
+    """Acumula mensajes hasta batch_max o hasta que venza la ventana de flush."""
+    batch = [first]
+    deadline = time.monotonic() + flush_s
+    while len(batch) < batch_max:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_queue.get(timeout=remaining))
+        except Empty:
+            break
+    return batch
+
+def _writer_loop(app: Flask) -> None:
+    with app.app_context():
+        batch_max = int(app.config.get("INGEST_BATCH_MAX", 500))
+        flush_s = float(app.config.get("INGEST_FLUSH_MS", 200)) / 1000.0
+        while True:
+            try:
+                first = _queue.get(timeout=0.5)
+            except Empty:
+                if _stop.is_set():
+                    return
+                continue
+            batch = _drain(first, batch_max, flush_s)
+            try:
+                _flush(batch)
+            except Exception as e:
+                # El escritor ya hizo rollback e invalidó cachés (listeners)
+                print("[INGEST ERROR]", e)
+
+def _apply(d: Dispositivo, msg: Dict[str, Any]) -> None:
+    if msg.get("estado"):
+        d.estado = msg["estado"]
+    if msg.get("parametros"):
+        d.parametros = msg["parametros"]
+    if msg.get("configuracion"):
+        d.configuracion = msg["configuracion"]
+
+# Caché del escritor: id -> (Dispositivo, rev visto en el registro). Guarda
+# referencias fuertes para que la identity map de la sesión no vuelva a hacer
+# SELECT; si otro camino modificó la fila (rev distinto) se refresca.
+_cache: Dict[int, Tuple[Dispositivo, int]] = {}
+writer.add_rollback_listener(_cache.clear)   # tras rollback las instancias quedan expiradas
+
+def _cached(rec: registry.DeviceRecord) -> Optional[Dispositivo]:
+    hit = _cache.get(rec.id)
+    if hit is not None:
+        d, rev = hit
+        if rev != rec.rev:
+            db.session.refresh(d)
+    else:
+        d = db.session.get(Dispositivo, rec.id)
+        if d is None:
+            return None
+    _cache[rec.id] = (d, rec.rev)
+    return d
+
+def forget(dev_id: int) -> None:
+    """Saca un dispositivo de la caché (tombstone, app/purge.py; hilo escritor)."""
+    _cache.pop(dev_id, None)
+
+def _new_device_row(serial: str, m: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "serial_number": serial,
+        "nombre": "No definido",
+        "tipo": "generico",
+        "modelo": "desconocido",
+        "descripcion": "",
+        "estado": m.get("estado") or "desconocido",
+        "parametros": m.get("parametros") or {},
+        "configuracion": m.get("configuracion") or {},
+        "reclamado": False,
+    }
+
+def _stage(batch: List[Dict[str, Any]]) -> List[Tuple[Dispositivo, Dict[str, Any], str, bool]]:
+    """
+    Aplica el lote sobre la sesión (sin commit). Los seriales se resuelven
+    con el registro en memoria; los desconocidos se dan de alta (no
+    reclamados) con UN upsert `ON CONFLICT(serial_number) ... RETURNING`:
+    si otro proceso/endpoint lo creó entre medias se devuelve esa fila.
+    """
+    devices: Dict[str, Dispositivo] = {}
+    first_msg: Dict[str, Dict[str, Any]] = {}
+    for m in batch:
+        serial = m["serial_number"]
+        if serial in devices or serial in first_msg:
+            continue
+        rec = registry.get(serial)
+        d = _cached(rec) if rec is not None else None
+        if d is not None and d.eliminado_at is None:   # tombstone en este mismo lote: alta nueva
+            devices[serial] = d
+        else:
+            first_msg[serial] = m
+    if first_msg:
+        rows = [_new_device_row(s, m) for s, m in first_msg.items()]
+        for d in upsert_returning(Dispositivo, rows, key="serial_number"):
+            devices[d.serial_number] = d
+
+    staged = []
+    for m in batch:
+        d = devices[m["serial_number"]]
+        stored = storage_policy.should_store(d, m)
+        if stored:
+            _apply(d, m)
+        # estado "congelado" en el momento del mensaje (puede haber varios por lote)
+        staged.append((d, m, d.estado, stored))
+    return staged
+
+def _write(batch: List[Dict[str, Any]]):
+    """Intención del escritor: altas/updates de dispositivos + EstadoLog + muestras (sin commit)."""
+    staged = _stage(batch)
+    rows = [
+        {
+            "dispositivo_id": d.id,
+            "estado": estado,
+            "parametros": m.get("parametros") or {},
+            "timestamp": m["ts"].astimezone(timezone.utc).replace(tzinfo=None),
+        }
+        for d, m, estado, stored in staged if stored
+    ]
+    if rows:
+        partitions.ensure_current()   # PostgreSQL: partición del mes (no-op en SQLite)
+        partitions.ensure_for(EstadoLog, (r["timestamp"] for r in rows))
+        # parametros: keyframe periódico o solo lo cambiado (app/deltas.py); las muestras, completas
+        stored = [dict(r, parametros=deltas.estado.encode(r["dispositivo_id"], r["parametros"], r["timestamp"]))
+                  for r in rows]
+        db.session.execute(EstadoLog.__table__.insert(), stored)
+        metrics.insert_samples((r["dispositivo_id"], r["timestamp"], r["parametros"]) for r in rows)
+    # Instantánea de los eventos SSE en el hilo escritor justo tras el commit:
+    # después, otra intención (p.ej. mover de habitación) ya puede tocar las fichas
+    events: Dict[int, Dict[str, Any]] = {}
+    writer.after_commit(lambda: events.update(_snapshot(staged)))
+    return staged, rows, events
+
+def _flush(batch: List[Dict[str, Any]]) -> None:
+    t0 = time.perf_counter()
+    staged, rows, events = writer.run(_write, batch, timeout=None)   # vuelve ya comiteado
+
+    # Altas nuevas al registro y a la caché. La ficha no guarda nada que la
+    # ingesta modifique: reclamado/tipo los fijan los endpoints, y un rev
+    # cambiado a mitad de lote se refresca en el siguiente.
+    for d in {d.id: d for d, _, _, _ in staged}.values():
+        if registry.get_by_id(d.id) is None:
+            rec = registry.remember(d, bump=False)
+            _cache[d.id] = (d, rec.rev)
+
+    commit_ms = (time.perf_counter() - t0) * 1000.0
+    with _stats_lock:
+        _stats["flushes"] += 1
+        _stats["written"] += len(rows)
+        _stats["suppressed"] += len(staged) - len(rows)
+        _stats["last_batch"] = len(staged)
+        _stats["last_commit_ms"] = round(commit_ms, 2)
+    print(f"[INGEST] 💾 lote={len(staged)} escritos={len(rows)} "
+          f"dispositivos={len({d.id for d, _, _, _ in staged})} commit={commit_ms:.1f}ms")
+
+    if _commit_listeners:
+        committed = [m for _, m, _, stored in staged if stored]
+        for fn in _commit_listeners:
+            try:
+                fn(committed)
+            except Exception as e:
+                print("[INGEST] commit listener error", e)
+
+    _after_commit(staged, events)
+
+def _device_event(d: Dispositivo) -> Dict[str, Any]:
+    return {
+        "id": d.id,
+        "serial_number": d.serial_number,
+        "nombre": d.nombre,
+        "tipo": d.tipo,
+        "modelo": d.modelo,
+        "descripcion": d.descripcion,
+        "estado": d.estado,
+        "parametros": d.parametros,
+        "configuracion": d.configuracion,
+        "reclamado": d.reclamado,
+        "habitacion_id": d.habitacion_id,
+        "event": "device_update"
+    }
+
+def _snapshot(staged: List[Tuple[Dispositivo, Dict[str, Any], str, bool]]) -> Dict[int, Dict[str, Any]]:
+    """
+    Índice en el lote -> device_update. El SSE se coalesce a un evento por
+    dispositivo y lote (último estado) y solo si se persistió algo.
+    """
+    last_idx: Dict[int, int] = {}
+    for i, (d, _, _, stored) in enumerate(staged):
+        if stored:
+            last_idx[d.id] = i
+    return {i: _device_event(staged[i][0]) for i in last_idx.values()}
+
+def _after_commit(staged: List[Tuple[Dispositivo, Dict[str, Any], str, bool]],
+                  events: Dict[int, Dict[str, Any]]) -> None:
+    """Prepara el trabajo post-commit: (dispositivo, mensaje, evento SSE o None)."""
+    work = [(d, m, events.get(i)) for i, (d, m, _, _) in enumerate(staged)]
+    _post_commit(work)
+
+def run_committed(work: List[Tuple[Dispositivo, Dict[str, Any], Optional[Dict[str, Any]]]]) -> None:
+    """SSE + reglas IoTelligence de mensajes ya comiteados (en orden)."""
+    for d, m, evt in work:
+        if evt is not None:
+            # Habitación de la instantánea tomada en el escritor tras el commit
+            # (`_snapshot`; las habitaciones también se escriben por el escritor)
+            sse_publish(evt, room=evt.get("habitacion_id"))
+        # ===============================
+        # IoTelligence: Reglas (ONLINE)
+        # ===============================
+        try:
+            now = m["ts"]
+            # 1) Reglas de métricas (Rule1…) — SI HAY métricas numéricas
+            for metric, val in (m.get("parametros") or d.parametros or {}).items():
+                dispatch_measure(d, metric, val, ts=now)
+            # 1.b) Heartbeat SIEMPRE (garantiza “visto” para Rule4)
+            dispatch_measure(d, "heartbeat", 1, ts=now)
+            # 2) Reglas de configuración (Rule2: Misconfigs)
+            dispatch_measure(d, None, None, ts=now)
+            # 3) Reglas de aprendizaje/estado (Rule3, etc.)
+            dispatch_measure(d, "__state__", None, ts=now)
+        except Exception as e:
+            print("[INGEST] dispatch error", e)
+
+# Observadores de commit (métricas/benchmark): reciben la lista de mensajes
+# persistidos del lote, en el hilo escritor y justo después del commit.
+_commit_listeners: List[Callable[[List[Dict[str, Any]]], None]] = []
+
+def add_commit_listener(fn: Callable[[List[Dict[str, Any]]], None]) -> None:
+    _commit_listeners.append(fn)
+
+# Por defecto el post-commit corre en el hilo escritor; app/ingest_lanes.py
+# lo redirige a la carril de cada dispositivo.
+_post_commit: Callable[[list], None] = run_committed
+
+def set_post_commit(fn: Callable[[list], None]) -> None:
+    global _post_commit
+    _post_commit = fn
@@ -0,0 +1,234 @@
+# app/ingest_lanes.py
+"""
+Despachador de ingesta por carriles (lanes) ordenados por dispositivo.
+
+El hilo de red de paho solo extrae el serial (barato, sin decodificar) y encola el payload
+crudo en la carril `crc32(serial) % INGEST_LANES`. Cada carril es un hilo con
+su cola FIFO que:
+  1) parsea y valida el payload y lo pasa al escritor (app/ingest.py)
+  2) tras el commit, publica el SSE y despacha las reglas IoTelligence
+Así cada dispositivo conserva su orden, dispositivos distintos avanzan en
+paralelo y el bucle MQTT nunca espera a la BD.
+
+Control de admisión (backpressure) por carril:
+  - por debajo de INGEST_SHED_HIGH_WATER * INGEST_LANE_QUEUE_MAX entra todo
+  - por encima se descartan primero los heartbeats duplicados (payload
+    idéntico al anterior del mismo serial)
+  - con la carril llena: un CAMBIO de configuración (crc del sub-objeto
+    `configuracion` distinto del último visto; los equipos la reenvían en cada
+    reporte) se admite por encima del tope hasta el tope duro
+    (1 + INGEST_CONFIG_HEADROOM) * INGEST_LANE_QUEUE_MAX; el resto, y la
+    configuración por encima del tope duro, a QoS 1 espera hasta
+    INGEST_QOS1_BLOCK_MS por hueco y a QoS 0 se descarta
+Solo por encima del umbral se decodifica el payload para comparar la
+configuración; por debajo basta con olvidar la referencia del serial.
+paho (1.6) envía el PUBACK de QoS 1 al volver del callback, así que el ack
+sale solo tras encolar (o agotar la espera): el broker frena la entrega
+cuando se llena su ventana de mensajes en vuelo.
+"""
+from __future__ import annotations
+import json, threading, time, zlib
+from datetime import datetime, timezone
+from queue import Queue, Empty
+from typing import Any, Dict, List, Optional, Tuple
+from flask import Flask
+
+from app import ingest, payload_codecs
+
+_lanes: List[Queue] = []
+_threads: List[threading.Thread] = []
+_lane_max = 2000
+_high_water = 1600
+_hard_max = 2500
+_qos1_block_s = 0.5
+_last_crc: Dict[str, int] = {}       # serial -> crc32 del último payload (solo hilo de paho)
+_last_cfg_crc: Dict[str, int] = {}   # serial -> crc32 de su última `configuracion` (solo hilo de paho)
+_stats_lock = threading.Lock()
+_stats: Dict[str, int] = {
+    "received": 0, "invalid": 0,
+    "shed_duplicate": 0, "shed_state": 0,
+    "config_over_cap": 0, "shed_config": 0, "qos1_waits": 0,
+}
+
+def init(app: Flask) -> None:
+    """Arranca N carriles y redirige el post-commit del escritor (idempotente)."""
+    global _lane_max, _high_water, _hard_max, _qos1_block_s
+    if _lanes:
+        return
+    n = max(1, int(app.config.get("INGEST_LANES", 4)))
+    _lane_max = int(app.config.get("INGEST_LANE_QUEUE_MAX", 2000))
+    _high_water = int(_lane_max * float(app.config.get("INGEST_SHED_HIGH_WATER", 0.8)))
+    _hard_max = int(_lane_max * (1.0 + float(app.config.get("INGEST_CONFIG_HEADROOM", 0.25))))
+    _qos1_block_s = float(app.config.get("INGEST_QOS1_BLOCK_MS", 500)) / 1000.0
+    for i in range(n):
+        # Sin maxsize: el post-commit del escritor nunca debe bloquearse;
+        # la admisión de mensajes nuevos se limita a mano en submit() (_hard_max).
+        q: Queue = Queue()
+        t = threading.Thread(target=_lane_loop, args=(app, q), name=f"IngestLane-{i}", daemon=True)
+        _lanes.append(q)
+        _threads.append(t)
+        t.start()
+    ingest.set_post_commit(_route_committed)
+    print(f"[INGEST] {n} carriles (lane_max={_lane_max})")
+
+def _count(key: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[key] = _stats.get(key, 0) + n
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        out: Dict[str, Any] = dict(_stats)
+    out["lanes"] = [q.qsize() for q in _lanes]
+    return out
+
+def serial_from_topic(topic: str) -> Optional[str]:
+    """dispositivos/<serial>/estado[/<formato>] -> serial (None en el tópico legado)."""
+    parts = (topic or "").split("/")
+    if len(parts) >= 3 and parts[0] == "dispositivos" and parts[2] == "estado" and parts[1] != "estado":
+        return parts[1]
+    return None
+
+def lane_for(serial: Optional[str]) -> int:
+    if not serial or not _lanes:
+        return 0
+    return zlib.crc32(serial.encode("utf-8")) % len(_lanes)
+
+def _config_crc(topic: str, payload: bytes) -> Optional[int]:
+    """crc32 del sub-objeto `configuracion` (None si no viene o no se puede decodificar)."""
+    try:
+        cfg = payload_codecs.decode(topic, payload).get("configuracion")
+    except Exception:
+        return None
+    if not cfg:
+        return None
+    raw = json.dumps(cfg, sort_keys=True, separators=(",", ":"), default=str)
+    return zlib.crc32(raw.encode("utf-8"))
+
+def _classify(serial: Optional[str], topic: str, payload: bytes) -> Tuple[str, int, Optional[int]]:
+    """
+    ('duplicate' | 'config' (la configuración cambió) | 'state', crc, crc de
+    la configuración). No toca las referencias: solo se fijan si el mensaje
+    se admite (`_admitted`), para que un descarte no envenene la detección.
+    """
+    crc = zlib.crc32(payload)
+    if serial is None:
+        return "state", crc, None
+    if _last_crc.get(serial) == crc:
+        return "duplicate", crc, None
+    if b"configuracion" not in payload:
+        return "state", crc, None
+    cfg_crc = _config_crc(topic, payload)
+    if cfg_crc is None:
+        return "state", crc, None
+    # Sin referencia (se olvida por debajo del umbral) cuenta como cambio
+    return ("config" if _last_cfg_crc.get(serial) != cfg_crc else "state"), crc, cfg_crc
+
+def _admitted(serial: str, crc: int, cfg_crc: Optional[int]) -> None:
+    _last_crc[serial] = crc
+    if cfg_crc is not None:
+        _last_cfg_crc[serial] = cfg_crc
+
+def _wait_for_room(q: Queue, timeout: float, limit: int) -> bool:
+    deadline = time.monotonic() + timeout
+    while q.qsize() >= limit:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+def submit(topic: str, payload: bytes, qos: int = 0) -> bool:
+    """
+    Llamado desde el hilo de paho. Aplica la política de descarte y devuelve
+    False si el mensaje se descartó.
+    """
+    if not _lanes:
+        raise RuntimeError("Carriles de ingesta no inicializadas. Llama init(app) en create_app().")
+    _count("received")
+    serial = serial_from_topic(topic) or payload_codecs.extract_serial(topic, payload)
+    idx = lane_for(serial)
+    q = _lanes[idx]
+
+    depth = q.qsize()
+    seen: Optional[Tuple[int, Optional[int]]] = None
+    if depth >= _high_water:
+        kind, crc, cfg_crc = _classify(serial, topic, payload)
+        if kind == "duplicate":
+            _count("shed_duplicate")
+            return False
+        limit = _hard_max if kind == "config" else _lane_max
+        if depth >= _lane_max and kind == "config" and depth < _hard_max:
+            _count("config_over_cap")
+        elif depth >= limit:
+            shed = "shed_config" if kind == "config" else "shed_state"
+            if qos >= 1 and _qos1_block_s > 0:
+                _count("qos1_waits")
+                if not _wait_for_room(q, _qos1_block_s, limit):
+                    _count(shed)
+                    return False
+            else:
+                _count(shed)
+                return False
+        seen = (crc, cfg_crc)
+    elif serial is not None:
+        # La configuración puede cambiar sin que se mire: la próxima vez
+        # por encima del umbral se tratará como cambio (conservador).
+        seen = (zlib.crc32(payload), None)
+        _last_cfg_crc.pop(serial, None)
+
+    q.put(("msg", (topic, payload, datetime.now(timezone.utc), idx)))
+    if serial is not None and seen is not None:
+        _admitted(serial, *seen)
+    return True
+
+# =========================
+# Carriles
+# =========================
+def _parse(topic: str, payload: bytes, ts: datetime, lane: int) -> Optional[Dict[str, Any]]:
+    data = payload_codecs.decode(topic, payload)   # JSON / MessagePack / CBOR
+    if not isinstance(data, dict):
+        print("[ERROR] MQTT: payload no es un objeto (map)")
+        return None
+
+    # En la jerarquía por dispositivo manda el serial del tópico
+    serial = serial_from_topic(topic) or data.get("serial_number")
+    if not serial:
+        print("[ERROR] MQTT: serial_number no proporcionado")
+        return None
+
+    return {
+        "serial_number": serial,
+        "estado": data.get("estado"),
+        "parametros": data.get("parametros", {}),
+        "configuracion": data.get("configuracion", {}),
+        "ts": ts,
+        "lane": lane,
+    }
+
+def _lane_loop(app: Flask, q: Queue) -> None:
+    with app.app_context():
+        while True:
+            try:
+                kind, item = q.get(timeout=1.0)
+            except Empty:
+                continue
+            try:
+                if kind == "msg":
+                    msg = _parse(*item)
+                    if msg is None:
+                        _count("invalid")
+                        continue
+                    ingest.submit(msg, block=True)
+                else:
+                    ingest.run_committed(item)
+            except Exception as e:
+                if kind == "msg":
+                    _count("invalid")
+                print("[INGEST LANE ERROR]", e)
+
+def _route_committed(work: List[Tuple[Any, Dict[str, Any], Optional[Dict[str, Any]]]]) -> None:
+    """Reparte el post-commit de un lote a la carril de origen de cada mensaje."""
+    by_lane: Dict[int, list] = {}
+    for item in work:
+        by_lane.setdefault(item[1].get("lane", 0), []).append(item)
+    for idx, items in by_lane.items():
+        _lanes[idx % len(_lanes)].put(("committed", items))
@@ -2,7 +2,7 @@
 from __future__ import annotations
 from datetime import datetime, timezone
 from typing import Optional
-from app.iotelligence.worker import submit           # 👈 solo submit (NO init aquí)
+from app.iotelligence.worker import submit, try_submit   # 👈 solo submit (NO init aquí)
 from app.iotelligence.rules import REGISTRY
 from app.models import Dispositivo
 
@@ -10,10 +10,13 @@ def dispatch_measure(dispositivo: Dispositivo, metric: str | None, value, ts: Op
     """
     Router para eventos en tiempo real (MQTT/PUT).
     - metric puede ser None para reglas de configuración (Rule 2).
+    - Si la cola del worker está saturada (AI_QUEUE_MAX) la medición se
+      descarta, salvo en reglas `cheap_realtime` que se ejecutan en línea.
     """
     ts = ts or datetime.now(timezone.utc)
     for rule in REGISTRY.values():
-        submit(rule.on_measure, dispositivo, metric, value, ts)
+        if try_submit(rule.on_measure, dispositivo, metric, value, ts) is None and rule.cheap_realtime:
+            rule.on_measure(dispositivo, metric, value, ts)
 
 def run_rule_batch(rule_name: str, **kwargs):
     """
@@ -1,12 +1,10 @@
 # app/iotelligence/routes.py
 from __future__ import annotations
 from flask import Blueprint, request, jsonify, Response, stream_with_context
-from queue import Empty
-import json, time
 
 from app.models import Dispositivo
 from app.iotelligence.core import run_rule_batch      # <<< runner de reglas (concurrencia)
-from app.sse import publish as sse_publish, subscribe, unsubscribe
+from app.sse import publish as sse_publish, subscribe, frames as sse_frames
 from app.utils_time import now_utc, iso_local         # <<< AÑADIR
 
 bp_ai = Blueprint("iotelligence", __name__)
@@ -57,27 +55,14 @@ def stream_ai():
       - ai_fix_applied (si aplicas parches)
       - ai_done        (fin de job batch)
       - ai_progress    (progreso encolado)
+    Filtro opcional: serial=A,B (solo hallazgos de esos dispositivos).
     """
+    raw = request.args.get("serial") or ""
+    serials = [x.strip() for x in raw.split(",") if x.strip()] or None
+
     def gen():
-        q = subscribe()
-        try:
-            yield "event: hello\ndata: {}\n\n"
-            last = time.time()
-            while True:
-                try:
-                    evt = q.get(timeout=5)
-                    # Solo eventos IA            
-                    if isinstance(evt, dict) and str(evt.get("event", "")).startswith("ai_"):
-                        payload = json.dumps(evt, ensure_ascii=False, separators=(',', ':'))
-                        yield f"event: {evt.get('event')}\n"
-                        yield f"data: {payload}\n\n"
-                except Empty:
-                    # keep-alive
-                    if time.time() - last > 25:
-                        yield "event: ping\ndata: {}\n\n"
-                        last = time.time()
-        finally:
-            unsubscribe(q)
+        # Solo eventos IA (el broker filtra al publicar y entrega frames ya serializados)
+        yield from sse_frames(subscribe(family="ai", serials=serials))
 
     headers = {
         "Content-Type": "text/event-stream; charset=utf-8",
@@ -5,6 +5,9 @@ from datetime import datetime
 
 class Rule:
     name: str = "rule"
+    # True si on_measure es O(1) y seguro en el hilo llamante: con el worker
+    # saturado se ejecuta en línea en vez de descartarse (p.ej. Rule4).
+    cheap_realtime: bool = False
 
     def on_measure(self, dispositivo, metric: str, value, ts: datetime) -> None:
         """Procesa una sola medición (tiempo real)."""
@@ -1,11 +1,13 @@
 # app/iotelligence/rules/rule1.py
 from __future__ import annotations
+from collections import OrderedDict
 from typing import Dict, Any, List, Tuple, Optional
 from datetime import datetime, timedelta, timezone
 import os, json, math, threading, time
 from flask import current_app
 from app.sse import publish as sse_publish
-from app.models import Dispositivo, EstadoLog
+from app.models import Dispositivo
+from app import metrics, rollups
 from app.iotelligence.rules.base import Rule
 from app.utils_time import now_utc, iso_local
 
@@ -63,15 +65,8 @@ def _bounds_limits(disp: Dispositivo, metric: str) -> Dict[str, Any]:
 # Series y percentiles hist
 # =========================
 def _fetch_series(disp_id: int, metric: str, since, until, limit=5000) -> List[Tuple[datetime, float]]:
-    q = EstadoLog.query.filter_by(dispositivo_id=disp_id)
-    q = q.filter(EstadoLog.timestamp >= since).filter(EstadoLog.timestamp <= until)
-    q = q.order_by(EstadoLog.timestamp.asc())
-    out: List[Tuple[datetime, float]] = []
-    for log in q.limit(limit).all():
-        v = (log.parametros or {}).get(metric)
-        if isinstance(v,(int,float)):
-            out.append((log.timestamp, float(v)))
-    return out
+    # Una sola métrica por índice (device_id, metric_id, ts) en metric_sample
+    return metrics.series(disp_id, metric, since, until, limit=limit)
 
 def _percentile(sorted_vals: List[float], p: float) -> float:
     if not sorted_vals: return math.nan
@@ -86,12 +81,47 @@ def _hist_bounds(series: List[Tuple[datetime,float]]) -> Dict[str, Any]:
     pmin = float(current_app.config.get("AI_HIST_PMIN", 1.0))
     pmax = float(current_app.config.get("AI_HIST_PMAX", 99.0))
     lo = _percentile(vals, pmin); hi = _percentile(vals, pmax)
+    return _padded(lo, hi, "hist")
+
+# Percentiles aproximados desde rollups (cientos de cubetas en vez de miles de muestras).
+# LRU acotada a AI_HIST_CACHE_MAX entradas (las carriles la consultan en paralelo).
+_HIST_CACHE: "OrderedDict[tuple[int,str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_HIST_LOCK = threading.Lock()
+
+def _hist_bounds_rollups(disp_id: int, metric: str, since, until) -> Dict[str, Any]:
+    key = (disp_id, metric)
+    ttl = float(current_app.config.get("AI_HIST_CACHE_S", 300))
+    with _HIST_LOCK:
+        hit = _HIST_CACHE.get(key)
+        if hit and (time.time() - hit[0]) < ttl:
+            _HIST_CACHE.move_to_end(key)
+            return hit[1]
+    out: Dict[str, Any] = {}
+    mid = metrics.metric_id(metric)
+    if mid is not None:
+        res = rollups.RESOLUTIONS.get(current_app.config.get("AI_HIST_ROLLUP_RES", "1h"), 3600)
+        buckets = rollups.read(disp_id, mid, res, since, until)
+        if sum(b.count for b in buckets) >= int(current_app.config.get("AI_HIST_MIN_POINTS", 500)):
+            pmin = float(current_app.config.get("AI_HIST_PMIN", 1.0))
+            pmax = float(current_app.config.get("AI_HIST_PMAX", 99.0))
+            pct = rollups.approx_percentiles(buckets, (pmin, pmax))
+            if pct:
+                out = _padded(pct[pmin], pct[pmax], "hist~")
+    cap = max(1, int(current_app.config.get("AI_HIST_CACHE_MAX", 4096)))
+    with _HIST_LOCK:
+        _HIST_CACHE[key] = (time.time(), out)
+        _HIST_CACHE.move_to_end(key)
+        while len(_HIST_CACHE) > cap:
+            _HIST_CACHE.popitem(last=False)
+    return out
+
+def _padded(lo: float, hi: float, source: str) -> Dict[str, Any]:
     if math.isnan(lo) or math.isnan(hi) or lo >= hi: return {}
     pad_frac = float(current_app.config.get("AI_HIST_PAD_FRAC", 0.05))
     pad_abs  = float(current_app.config.get("AI_HIST_PAD_ABS", 0.0))
     span = hi - lo
     pad = max(pad_abs, span*pad_frac) if span>0 else pad_abs
-    return {"min": lo - pad, "max": hi + pad, "source": "hist"}
+    return {"min": lo - pad, "max": hi + pad, "source": source}
 
 # ===============
 # Fusión de bounds
@@ -150,10 +180,13 @@ class Rule1Extremos(Rule):
         days = int(current_app.config.get("AI_HIST_WINDOW_DAYS", 30))
         until = datetime.now(timezone.utc)
         since = until - timedelta(days=days)
-        series = _fetch_series(dispositivo.id, metric, since, until)
-        b_hist = {}
-        if len(series) >= int(current_app.config.get("AI_HIST_MIN_POINTS", 500)):
-            b_hist = _hist_bounds(series)
+        if current_app.config.get("AI_HIST_USE_ROLLUPS", True):
+            b_hist = _hist_bounds_rollups(dispositivo.id, metric, since, until)
+        else:
+            series = _fetch_series(dispositivo.id, metric, since, until)
+            b_hist = {}
+            if len(series) >= int(current_app.config.get("AI_HIST_MIN_POINTS", 500)):
+                b_hist = _hist_bounds(series)
 
         bounds = _fuse(b_lim, b_hist) or b_lim or b_hist
         if not bounds:
@@ -7,6 +7,7 @@ from flask import current_app
 from app.iotelligence.rules.base import Rule
 from app.sse import publish as sse_publish
 from app.models import Dispositivo
+from app import registry
 from app.utils_time import now_utc, iso_local
 
 _LAST_SEEN: Dict[int, float]     = {}
@@ -15,7 +16,7 @@ _LAST_ALERT: Dict[int, float]    = {}
 _WATCHDOG_STARTED = False
 _WATCHDOG_LOCK = threading.Lock()
 
-def _publish_offline(d: Dispositivo, *, since_epoch: float, now_epoch: float):
+def _publish_offline(d: registry.DeviceRecord, *, since_epoch: float, now_epoch: float):
     payload = {
         "event": "ai_offline",
         "rule": "offline",
@@ -29,7 +30,7 @@ def _publish_offline(d: Dispositivo, *, since_epoch: float, now_epoch: float):
     }
     sse_publish(payload)
 
-def _publish_back_online(d: Dispositivo, *, was_offline_secs: int):
+def _publish_back_online(d: registry.DeviceRecord, *, was_offline_secs: int):
     payload = {
         "event": "ai_back_online",
         "rule": "offline",
@@ -59,7 +60,8 @@ def _watchdog_loop(app):
                     continue
 
                 for disp_id, last in list(_LAST_SEEN.items()):
-                    d = Dispositivo.query.get(disp_id)
+                    # Ficha del registro en memoria (sin SELECT por iteración)
+                    d = registry.get_by_id(disp_id)
                     if not d or not getattr(d, "reclamado", False):
                         continue
 
@@ -99,6 +101,7 @@ def _ensure_watchdog_started():
 
 class Rule4OfflineWatchdog(Rule):
     name = "offline"
+    cheap_realtime = True   # solo marca "visto": nunca perder heartbeats por backpressure
 
     def applies_realtime(self, disp, metric, value) -> bool:
         return getattr(disp, "reclamado", False)
@@ -7,6 +7,7 @@ from app.iotelligence.rules.base import Rule
 from app.sse import publish as sse_publish
 from app.models import Dispositivo
 from app.db import db
+from app import registry, writer
 from app.utils_time import now_utc, iso_local
 
 # ===== Carga de estándar por prefijo =====
@@ -132,14 +133,23 @@ def _maybe_shutdown_device(disp: Dispositivo, reason: Dict[str, Any]) -> bool:
 
     cfg["modo"] = "manual"
     cfg["encendido"] = False
-    disp.configuracion = cfg
-    disp.estado = "inactivo"
 
-    # Log mínimo en DB; (opcional) podrías insertar EstadoLog si quieres
-    db.session.add(disp)
-    db.session.commit()
+    # Log mínimo en DB vía escritor único; (opcional) podrías insertar EstadoLog si quieres
+    saved = writer.run(_shutdown, disp.id, cfg)
+    if saved is None:
+        return False
+    registry.remember(saved)
     return True
 
+def _shutdown(dev_id: int, cfg: Dict[str, Any]):
+    """Intención del escritor: modo manual + apagado."""
+    d = db.session.get(Dispositivo, dev_id)
+    if d is None:
+        return None
+    d.configuracion = cfg
+    d.estado = "inactivo"
+    return d
+
 class Rule5Weather(Rule):
     name = "weather"
 
@@ -1,18 +1,27 @@
 # app/iotelligence/worker.py
 from __future__ import annotations
 from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Any
+from threading import Lock
+from typing import Callable, Any, Dict
 from flask import Flask
 
 _executor: ThreadPoolExecutor | None = None
 _app: Flask | None = None
 
+# Tareas en tiempo real pendientes (encoladas + en ejecución). El pool de
+# ThreadPoolExecutor no tiene límite de cola: try_submit() lo acota con AI_QUEUE_MAX.
+_pending = 0
+_max_pending = 0          # 0 = sin límite
+_lock = Lock()
+_stats: Dict[str, int] = {"submitted": 0, "shed": 0}
+
 def init(app: Flask, max_workers: int = 2) -> None:
-    global _executor, _app
+    global _executor, _app, _max_pending
     _app = app
+    _max_pending = int(app.config.get("AI_QUEUE_MAX", 0))
     if _executor is None:
         _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="AIWorker")
-        print(f"[AI worker] started (max_workers={max_workers})")
+        print(f"[AI worker] started (max_workers={max_workers}, queue_max={_max_pending or '∞'})")
 
 def _run_with_app(fn: Callable[..., Any], *args, **kwargs) -> Any:
     if _app is None:
@@ -20,7 +29,32 @@ def _run_with_app(fn: Callable[..., Any], *args, **kwargs) -> Any:
     with _app.app_context():
         return fn(*args, **kwargs)
 
+def _done(_fut) -> None:
+    global _pending
+    with _lock:
+        _pending -= 1
+
 def submit(fn: Callable[..., Any], *args, **kwargs):
+    """Encola SIEMPRE (jobs batch / históricos)."""
+    global _pending
     if _executor is None:
         raise RuntimeError("AI worker no inicializado. Llama init(app) en create_app().")
-    return _executor.submit(_run_with_app, fn, *args, **kwargs)
\ No newline at end of file
+    with _lock:
+        _pending += 1
+        _stats["submitted"] += 1
+    fut = _executor.submit(_run_with_app, fn, *args, **kwargs)
+    fut.add_done_callback(_done)
+    return fut
+
+def try_submit(fn: Callable[..., Any], *args, **kwargs):
+    """Encola solo si hay capacidad (tiempo real). Devuelve None si se descarta."""
+    if _max_pending > 0:
+        with _lock:
+            if _pending >= _max_pending:
+                _stats["shed"] += 1
+                return None
+    return submit(fn, *args, **kwargs)
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        return {**_stats, "pending": _pending, "queue_max": _max_pending}
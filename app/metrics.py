@@ -0,0 +1,188 @@
+# app/metrics.py
+"""
+Series numéricas normalizadas: `metric` (diccionario de nombres) + `metric_sample`.
+
+Cada valor numérico de `parametros` se guarda también como fila estrecha
+(device_id, metric_id, ts, value) en la misma transacción que su `EstadoLog`
+(ingesta MQTT, PUT /dispositivos/<id>, importación masiva). Las lecturas de
+UNA métrica (Rule1, /dispositivos/<id>/series, Excel) usan el índice
+(device_id, metric_id, ts) en vez de decodificar el JSON de cada EstadoLog.
+
+Las últimas HOT_TIER_HOURS horas de cada serie se sirven desde memoria
+(`app/hot_tier.py`) sin tocar la BD.
+
+Los ids de métrica se cachean en memoria. Un nombre nuevo se da de alta con
+upsert en la transacción del llamador; si éste hace rollback debe llamar a
+`reset()` (el id podría no haberse persistido). El escritor único lo hace solo.
+"""
+from __future__ import annotations
+import threading, time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app import deltas, hot_tier, rollups, writer
+from app.db import db, upsert_returning
+from app.models import EstadoLog, Metric, MetricSample
+
+_lock = threading.Lock()
+_ids: Dict[str, int] = {}
+_names: Dict[int, str] = {}
+
+def load() -> int:
+    """Carga el diccionario completo (requiere app context)."""
+    rows = db.session.query(Metric.id, Metric.name).all()
+    with _lock:
+        _ids.clear()
+        _names.clear()
+        for id_, name in rows:
+            _ids[name] = id_
+            _names[id_] = name
+    return len(rows)
+
+def reset() -> None:
+    """Invalida la caché (tras un rollback que pudo perder altas de métricas)."""
+    with _lock:
+        _ids.clear()
+        _names.clear()
+
+writer.add_rollback_listener(reset)
+
+def metric_id(name: str) -> Optional[int]:
+    """Id de una métrica existente (None si nunca se ha visto). Sin altas."""
+    mid = _ids.get(name)
+    if mid is None:
+        row = db.session.query(Metric.id).filter_by(name=name).first()
+        if row is None:
+            return None
+        mid = row[0]
+        with _lock:
+            _ids[name] = mid
+            _names[mid] = name
+    return mid
+
+def names() -> Dict[int, str]:
+    with _lock:
+        return dict(_names)
+
+def ensure(names_: Iterable[str]) -> Dict[str, int]:
+    """Resuelve (y da de alta si falta) cada nombre; una sola sentencia para los nuevos."""
+    wanted = set(names_)
+    missing = [n for n in wanted if n not in _ids]
+    if missing:
+        for m in upsert_returning(Metric, [{"name": n} for n in sorted(missing)], key="name"):
+            with _lock:
+                _ids[m.name] = m.id
+                _names[m.id] = m.name
+    return {n: _ids[n] for n in wanted}
+
+def _numeric(v) -> Optional[float]:
+    # Igual que Rule1: int/float (los bool cuentan como 0/1)
+    if isinstance(v, (int, float)):
+        return float(v)
+    return None
+
+def sample_rows(items: Iterable[Tuple[int, datetime, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    [(device_id, ts_naive_utc, parametros), ...] -> filas para
+    `db.session.execute(MetricSample.__table__.insert(), rows)`.
+    """
+    items = list(items)
+    keys = {k for _, _, p in items for k, v in (p or {}).items() if _numeric(v) is not None}
+    if not keys:
+        return []
+    ids = ensure(keys)
+    rows = []
+    for dev_id, ts, params in items:
+        for k, v in (params or {}).items():
+            f = _numeric(v)
+            if f is not None:
+                rows.append({"device_id": dev_id, "metric_id": ids[k], "ts": ts, "value": f})
+    return rows
+
+def insert_samples(items: Iterable[Tuple[int, datetime, Dict[str, Any]]]) -> int:
+    """Inserta (executemany, sin commit) las muestras numéricas de `items` y sus rollups."""
+    rows = sample_rows(items)
+    if rows:
+        db.session.execute(MetricSample.__table__.insert(), rows)
+        rollups.apply(rows)   # count/min/max/sum/m2 por cubeta, misma transacción
+        hot_tier.stage(rows)  # a memoria tras el commit del escritor
+    return len(rows)
+
+# =========================
+# Lecturas
+# =========================
+def _naive_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    if dt is None or dt.tzinfo is None:
+        return dt
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+def series(device_id: int, metric: str, since: Optional[datetime] = None, until: Optional[datetime] = None,
+           limit: Optional[int] = 5000, newest: bool = False) -> List[Tuple[datetime, float]]:
+    """
+    [(ts, value)] de UNA métrica en orden cronológico: de la capa caliente en
+    memoria si cubre el rango, si no range scan sobre el índice.
+    """
+    mid = metric_id(metric)
+    if mid is None:
+        return []
+    hot = hot_tier.series(device_id, mid, _naive_utc(since), _naive_utc(until), limit, newest)
+    if hot is not None:
+        return hot
+    q = db.session.query(MetricSample.ts, MetricSample.value).filter(
+        MetricSample.device_id == device_id, MetricSample.metric_id == mid)
+    since, until = _naive_utc(since), _naive_utc(until)
+    if since is not None:
+        q = q.filter(MetricSample.ts >= since)
+    if until is not None:
+        q = q.filter(MetricSample.ts <= until)
+    q = q.order_by(MetricSample.ts.desc() if newest else MetricSample.ts.asc())
+    if limit:
+        q = q.limit(int(limit))
+    rows = [(ts, float(v)) for ts, v in q.all()]
+    if newest:
+        rows.reverse()
+    return rows
+
+def device_metrics(device_id: int) -> List[str]:
+    """Métricas con muestras para un dispositivo."""
+    ids = [r[0] for r in db.session.query(MetricSample.metric_id)
+           .filter(MetricSample.device_id == device_id).distinct().all()]
+    known = names()
+    if any(i not in known for i in ids):
+        load()
+        known = names()
+    return sorted(known.get(i, str(i)) for i in ids)
+
+# =========================
+# Backfill desde EstadoLog
+# =========================
+def backfill(chunk: int = 5000, progress=None) -> Dict[str, Any]:
+    """
+    Rellena metric_sample con el histórico de EstadoLog anterior a la primera
+    muestra ya existente (lo posterior lo escribió la ingesta en vivo), así
+    que repetirlo no duplica. Recorre EstadoLog por id en bloques.
+    """
+    first = db.session.query(db.func.min(MetricSample.ts)).scalar()
+    t0 = time.perf_counter()
+    st = {"logs": 0, "samples": 0, "seconds": 0.0}
+    last_id = 0
+    while True:
+        q = db.session.query(EstadoLog.id, EstadoLog.dispositivo_id, EstadoLog.timestamp, EstadoLog.parametros) \
+            .filter(EstadoLog.id > last_id)
+        if first is not None:
+            q = q.filter(EstadoLog.timestamp < first)
+        batch = q.order_by(EstadoLog.id.asc()).limit(chunk).all()
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        items = deltas.expand_estado([{"dispositivo_id": dev, "timestamp": ts, "parametros": params}
+                                      for _, dev, ts, params in batch])
+        st["samples"] += insert_samples((it["dispositivo_id"], it["timestamp"], it["parametros"]) for it in items)
+        db.session.commit()
+        st["logs"] += len(batch)
+        st["seconds"] = round(time.perf_counter() - t0, 3)
+        print(f"[METRICS] backfill logs={st['logs']} muestras={st['samples']}")
+        if progress:
+            progress(dict(st))
+    st["seconds"] = round(time.perf_counter() - t0, 3)
+    return st
@@ -1,9 +1,14 @@
 # app/models.py
-from app.db import db
-from sqlalchemy.dialects.sqlite import JSON
+from app.db import TELEMETRY, db, monthly_partitioned
+from app.packed_json import PackedJSON
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
+# JSON: texto en SQLite (json_extract/DuckDB), JSONB en PostgreSQL. PACKED: MessagePack
+# comprimido con diccionario, solo para los blobs grandes y repetidos (app/packed_json.py)
+JSON = PackedJSON(pack=False)
+PACKED = PackedJSON()
+
 class Dispositivo(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     serial_number = db.Column(db.String(100), unique=True, nullable=False)
@@ -13,37 +18,54 @@ class Dispositivo(db.Model):
     descripcion = db.Column(db.String(255), default='')
     estado = db.Column(db.String(20), default='desconocido')
     parametros = db.Column(JSON, default=dict)       # 👈
-    configuracion = db.Column(JSON, default=dict)    # 👈
+    configuracion = db.Column(PACKED, default=dict)  # 👈
     reclamado = db.Column(db.Boolean, default=False)
 
     habitacion_id = db.Column(db.Integer, db.ForeignKey('habitacion.id'), nullable=True)
 
+    # Tombstone: DELETE /dispositivos/<id> lo marca y app/purge.py borra su histórico por lotes
+    eliminado_at = db.Column(db.DateTime, nullable=True, index=True)
+
     # Relaciones útiles para el informe:
     # - estado_logs: mediciones/estados históricos (se llenan desde MQTT/PUT)
     # - accion_logs: auditoría de acciones del usuario/sistema (reclamar, asignar/quitar, renombrar, cambios de config, etc.)
+    # Sin FK en BD: los logs pueden vivir en otra BD (bind "telemetry"), la unión es explícita.
+    # Son consultas (lazy="dynamic"): `d.estado_logs.limit(50)`; nunca se carga el histórico
+    # entero. Sin cascada de borrado: el histórico lo purga app/purge.py por lotes.
     estado_logs = db.relationship(
         "EstadoLog",
+        primaryjoin="Dispositivo.id == foreign(EstadoLog.dispositivo_id)",
         backref="dispositivo",
-        lazy=True,
-        cascade="all, delete-orphan",
+        lazy="dynamic",
+        cascade="save-update, merge",
+        passive_deletes="all",
         order_by="EstadoLog.timestamp.asc()"
     )
     accion_logs = db.relationship(
         "AccionLog",
+        primaryjoin="Dispositivo.id == foreign(AccionLog.dispositivo_id)",
         backref="dispositivo",
-        lazy=True,
-        cascade="all, delete-orphan",
+        lazy="dynamic",
+        cascade="save-update, merge",
+        passive_deletes="all",
         order_by="AccionLog.timestamp.asc()"
     )
 
 
 class EstadoLog(db.Model):
+    __bind_key__ = TELEMETRY   # misma BD que el resto salvo TELEMETRY_DATABASE_URL (ver app/db.py)
     id = db.Column(db.Integer, primary_key=True)
-    dispositivo_id = db.Column(db.Integer, db.ForeignKey('dispositivo.id'), nullable=False, index=True)
+    dispositivo_id = db.Column(db.Integer, nullable=False, index=True)   # -> dispositivo.id (sin FK: otro bind)
     estado = db.Column(db.String(20))
-    parametros = db.Column(JSON, default=dict)       # 👈
+    parametros = db.Column(JSON, default=dict)       # 👈 dict completo (keyframe) o delta: ver app/deltas.py
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
+    __table_args__ = (
+        # Paginación por cursor (timestamp, id) dentro de un dispositivo
+        db.Index("ix_estado_log_dev_ts_id", "dispositivo_id", "timestamp", "id"),
+        monthly_partitioned("timestamp"),   # PostgreSQL: una partición por mes
+    )
+
 
 # ------------------------------------------------------------
 # NUEVO: Auditoría de acciones para informes (Excel por equipo)
@@ -60,13 +82,78 @@ class AccionLog(db.Model):
       - "action_performed"       -> Acciones tipo "apagarTodo", "blind_open", etc. (detalle: {"action": "...", ...})
     `actor`: "user" | "system" | "mqtt" | etc.
     """
+    __bind_key__ = TELEMETRY
     id = db.Column(db.Integer, primary_key=True)
-    dispositivo_id = db.Column(db.Integer, db.ForeignKey('dispositivo.id'), nullable=False, index=True)
+    dispositivo_id = db.Column(db.Integer, nullable=False, index=True)   # -> dispositivo.id (sin FK: otro bind)
     evento = db.Column(db.String(50), nullable=False, index=True)
-    detalle = db.Column(JSON, default=dict)  # se guarda payload/diff contextual
+    detalle = db.Column(JSON, default=dict)  # se guarda payload/diff contextual (config_changed: delta, ver app/deltas.py)
     actor = db.Column(db.String(50), default="user", nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
+    __table_args__ = (monthly_partitioned("timestamp"),)
+
+
+# ------------------------------------------------------------
+# Series numéricas normalizadas (una fila por métrica y muestra)
+# ------------------------------------------------------------
+class Metric(db.Model):
+    """Diccionario de nombres de métrica (interning): 'temperatura' -> 1, ..."""
+    __tablename__ = "metric"
+    __bind_key__ = TELEMETRY
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), unique=True, nullable=False)
+
+
+class MetricSample(db.Model):
+    """
+    Valor numérico de `EstadoLog.parametros[<métrica>]` en tabla estrecha.
+    El índice (device_id, metric_id, ts) permite leer UNA métrica de un
+    dispositivo en un rango con un range scan (Rule1, gráficas, exportes).
+    `metric_id` referencia a `metric.id` sin FK (diccionario solo de altas).
+    """
+    __tablename__ = "metric_sample"
+    __bind_key__ = TELEMETRY
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, nullable=False)   # -> dispositivo.id (sin FK: otro bind)
+    metric_id = db.Column(db.Integer, nullable=False)
+    ts = db.Column(db.DateTime, nullable=False)
+    value = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_metric_sample_dev_metric_ts", "device_id", "metric_id", "ts"),
+    )
+
+
+class MetricRollup(db.Model):
+    """
+    Agregados por cubeta de tiempo (res = 60 / 3600 / 86400 s) mantenidos de
+    forma incremental: count, min, max, sum y m2 (suma de cuadrados de las
+    desviaciones a la media, combinada con la fórmula de Chan: la desviación
+    no pierde precisión con valores grandes y poca dispersión). `sumsq` se
+    sigue escribiendo por compatibilidad; m2 es NULL en cubetas anteriores.
+    """
+    __tablename__ = "metric_rollup"
+    __bind_key__ = TELEMETRY
+    device_id = db.Column(db.Integer, primary_key=True)
+    metric_id = db.Column(db.Integer, primary_key=True)
+    res = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    min = db.Column(db.Float, nullable=False)
+    max = db.Column(db.Float, nullable=False)
+    sum = db.Column(db.Float, nullable=False, default=0.0)
+    sumsq = db.Column(db.Float, nullable=False, default=0.0)
+    m2 = db.Column(db.Float, nullable=True)
+
+
+class BlobDict(db.Model):
+    """Diccionarios de compresión de PackedJSON (solo altas; cada blob guarda el id del suyo)."""
+    __tablename__ = "blob_dict"
+    id = db.Column(db.Integer, primary_key=True)
+    codec = db.Column(db.Integer, nullable=False)   # 1 = zlib zdict, 2 = zstd
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
 
 # -------------------------
 # Usuarios
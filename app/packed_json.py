@@ -0,0 +1,323 @@
+# app/packed_json.py
+"""
+Tipo de columna `PackedJSON`: dicts JSON guardados como binario compacto.
+
+    b"PJ" | códec (1 byte) | id de diccionario (2 bytes) | datos
+
+  códec 0: MessagePack sin comprimir (blobs pequeños, < PACKED_JSON_MIN_COMPRESS)
+  códec 1: MessagePack + zlib raw con diccionario (`zdict`)
+  códec 2: MessagePack + zstd con diccionario (si está `zstandard`)
+
+El diccionario compartido se entrena con blobs reales (`maintenance.py
+pack-json`) y se guarda en la tabla `blob_dict`: los `horarios*` y claves de
+`configuracion` que se repiten en todos los dispositivos pasan a costar unos
+pocos bytes. Los diccionarios nunca se borran (cada blob referencia el suyo).
+
+Solo se empaqueta donde compensa (`Dispositivo.configuracion`, blobs grandes
+y repetidos entre dispositivos). Las columnas `PackedJSON(pack=False)` se
+escriben en texto JSON, legible con `json_extract`, DuckDB o cualquier
+herramienta de SQLite. Las filas que ya estaban empaquetadas se leen igual y
+`pack-json` las devuelve a texto.
+
+Lectura transparente: texto JSON (filas anteriores), `PJ...` o JSON en bytes.
+En PostgreSQL la columna sigue siendo JSONB (ya comprimida por TOAST) y el
+tipo no transforma nada. Sin `msgpack` o con PACKED_JSON_ENABLED=False se
+escribe JSON en texto como antes.
+"""
+from __future__ import annotations
+import json, struct, threading, zlib
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import LargeBinary, Text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.types import TypeDecorator
+
+try:
+    import msgpack
+except Exception:   # dependencia opcional
+    msgpack = None
+
+try:
+    import zstandard
+except Exception:   # dependencia opcional
+    zstandard = None
+
+MAGIC = b"PJ"
+RAW, ZLIB, ZSTD = 0, 1, 2
+_HDR = struct.Struct(">2sBH")
+ZLIB_DICT_MAX = 32 * 1024   # ventana de deflate
+
+_lock = threading.Lock()
+_enabled = msgpack is not None
+_min_compress = 96
+_level = 6
+_dicts: Dict[int, Tuple[int, bytes]] = {}      # id -> (códec, datos)
+_zstd_dicts: Dict[int, Any] = {}               # id -> ZstdCompressionDict
+_zlib_base: Dict[int, Any] = {}                # id -> compresor zlib ya cebado (se copia)
+_current: Optional[int] = None                 # diccionario para escribir
+
+def init(app) -> None:
+    """Lee la configuración y carga los diccionarios (requiere app context)."""
+    global _enabled, _min_compress, _level
+    _zlib_base.clear()
+    _enabled = bool(app.config.get("PACKED_JSON_ENABLED", True)) and msgpack is not None
+    _min_compress = int(app.config.get("PACKED_JSON_MIN_COMPRESS", 96))
+    _level = int(app.config.get("PACKED_JSON_LEVEL", 6))
+    n = load()
+    if _enabled:
+        print(f"[PACKED] columnas JSON en MessagePack (diccionarios={n}, actual={_current})")
+
+def load() -> int:
+    from app.db import db
+    from app.models import BlobDict
+    rows = db.session.query(BlobDict.id, BlobDict.codec, BlobDict.data).order_by(BlobDict.id.asc()).all()
+    for id_, codec, data in rows:
+        register(id_, codec, data)
+    return len(rows)
+
+def register(dict_id: int, codec: int, data: bytes, current: bool = True) -> None:
+    """Da de alta un diccionario en memoria (y lo usa para escribir si `current`)."""
+    global _current
+    with _lock:
+        _dicts[dict_id] = (codec, bytes(data))
+        _zlib_base.pop(dict_id, None)
+        if codec == ZSTD and zstandard is not None:
+            _zstd_dicts[dict_id] = zstandard.ZstdCompressionDict(bytes(data))
+        if current and (codec != ZSTD or zstandard is not None):
+            _current = dict_id
+
+def _lookup(dict_id: int) -> Tuple[int, bytes]:
+    hit = _dicts.get(dict_id)
+    if hit is None:
+        # Diccionario creado por otro proceso (maintenance.py) después del arranque
+        from sqlalchemy import text
+        from app.db import db
+        with db.engine.connect() as conn:
+            row = conn.execute(text("SELECT codec, data FROM blob_dict WHERE id = :i"), {"i": dict_id}).first()
+        if row is None:
+            raise ValueError(f"PackedJSON: diccionario {dict_id} desconocido")
+        register(dict_id, row[0], row[1], current=False)
+        hit = _dicts[dict_id]
+    return hit
+
+# =========================
+# Codificación
+# =========================
+def pack(value: Any) -> bytes:
+    raw = msgpack.packb(value, use_bin_type=True)
+    if len(raw) < _min_compress:
+        return _HDR.pack(MAGIC, RAW, 0) + raw
+    dict_id = _current or 0
+    codec, data = _dicts.get(dict_id, (ZSTD if zstandard is not None else ZLIB, b""))
+    if codec == ZSTD and zstandard is not None:
+        zd = _zstd_dicts.get(dict_id)
+        body = zstandard.ZstdCompressor(level=_level, dict_data=zd).compress(raw) if zd is not None \
+            else zstandard.ZstdCompressor(level=_level).compress(raw)
+    else:
+        codec = ZLIB
+        base = _zlib_base.get(dict_id)
+        if base is None:
+            # Cargar 32 KB de diccionario cuesta más que comprimir: se ceba una vez y se copia
+            base = zlib.compressobj(_level, zlib.DEFLATED, -15, zdict=data) if data \
+                else zlib.compressobj(_level, zlib.DEFLATED, -15)
+            _zlib_base[dict_id] = base
+        c = base.copy()
+        body = c.compress(raw) + c.flush()
+    return _HDR.pack(MAGIC, codec, dict_id) + body
+
+def unpack(blob: bytes) -> Any:
+    _, codec, dict_id = _HDR.unpack_from(blob)
+    body = memoryview(blob)[_HDR.size:]
+    if codec == RAW:
+        raw = bytes(body)
+    elif codec == ZLIB:
+        data = _lookup(dict_id)[1] if dict_id else b""
+        d = zlib.decompressobj(-15, zdict=data) if data else zlib.decompressobj(-15)
+        raw = d.decompress(body) + d.flush()
+    elif codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("PackedJSON: blob zstd sin 'zstandard' instalado")
+        if dict_id:
+            _lookup(dict_id)
+            raw = zstandard.ZstdDecompressor(dict_data=_zstd_dicts[dict_id]).decompress(bytes(body))
+        else:
+            raw = zstandard.ZstdDecompressor().decompress(bytes(body))
+    else:
+        raise ValueError(f"PackedJSON: códec {codec} desconocido")
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+def decode(value: Any) -> Any:
+    """Valor tal como lo devuelve el driver -> objeto Python."""
+    if value is None or isinstance(value, (dict, list)):
+        return value
+    if isinstance(value, memoryview):
+        value = value.tobytes()
+    if isinstance(value, (bytes, bytearray)):
+        if value[:2] == MAGIC:
+            return unpack(bytes(value))
+        value = value.decode("utf-8")
+    return json.loads(value)
+
+def is_packed(value: Any) -> bool:
+    return isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:2]) == MAGIC
+
+# =========================
+# Diccionario compartido
+# =========================
+def train(samples: Iterable[Any], codec: Optional[int] = None, size: int = ZLIB_DICT_MAX) -> Tuple[int, bytes]:
+    """
+    Entrena un diccionario con valores de ejemplo (dicts). zstd: `train_dictionary`;
+    zlib: los blobs distintos de menos a más frecuentes (deflate favorece el final).
+    """
+    raws = [msgpack.packb(s, use_bin_type=True) for s in samples if s]
+    if codec is None:
+        codec = ZSTD if zstandard is not None else ZLIB
+    if codec == ZSTD:
+        return ZSTD, zstandard.train_dictionary(size, raws).as_bytes()
+    counts = Counter(raws)
+    out = b"".join(r for r, _ in sorted(counts.items(), key=lambda kv: (kv[1], len(kv[0]))))
+    return ZLIB, out[-min(size, ZLIB_DICT_MAX):]
+
+# =========================
+# Migración (maintenance.py pack-json)
+# =========================
+def packed_columns(pack: bool = True) -> List[Tuple[str, str]]:
+    """(tabla, columna) de las columnas PackedJSON del modelo (las que empaquetan o, con pack=False, las de texto)."""
+    from app.db import all_tables
+    return [(t.name, c.name) for t in all_tables()
+            for c in t.columns if isinstance(c.type, PackedJSON) and c.type.pack == pack]
+
+def _stored_bytes(table: str, col: str) -> int:
+    from sqlalchemy import text
+    from app.db import db, engine_for
+    return int(db.session.execute(text(f'SELECT COALESCE(SUM(LENGTH("{col}")), 0) FROM "{table}"'),
+                                  bind_arguments={"bind": engine_for(table)}).scalar() or 0)
+
+def migrate(chunk: int = 2000, samples: int = 2000, retrain: bool = False, vacuum: bool = False) -> Dict[str, Any]:
+    """
+    Entrena el diccionario si no hay ninguno (o con `retrain`) y reescribe por
+    lotes las filas en texto JSON (o empaquetadas con otro diccionario). En las
+    columnas de texto (`pack=False`) hace lo contrario: desempaqueta lo que
+    quedara en MessagePack. Solo SQLite; un commit por lote, se puede
+    interrumpir y relanzar.
+    """
+    from sqlalchemy import text
+    from app.db import db, distinct_engines, engine_for, is_postgres
+    from app.models import BlobDict
+    if is_postgres():
+        return {"skipped": "postgresql (JSONB)"}
+    if not _enabled:
+        return {"skipped": "PACKED_JSON_ENABLED=False o sin msgpack"}
+    cols = packed_columns()
+    out: Dict[str, Any] = {"dict_id": _current, "trained": False, "columns": {}}
+
+    for table, col in packed_columns(pack=False):
+        bind = {"bind": engine_for(table)}
+        before = _stored_bytes(table, col)
+        last, rewritten = 0, 0
+        while True:
+            rows = db.session.execute(text(
+                f'SELECT rowid, "{col}" FROM "{table}" WHERE rowid > :l ORDER BY rowid LIMIT :n'),
+                {"l": last, "n": chunk}, bind_arguments=bind).all()
+            if not rows:
+                break
+            last = rows[-1][0]
+            upd = [{"r": rid, "v": _to_text(decode(v))} for rid, v in rows if is_packed(v)]
+            if upd:
+                db.session.execute(text(f'UPDATE "{table}" SET "{col}" = :v WHERE rowid = :r'), upd, bind_arguments=bind)
+                db.session.commit()
+                rewritten += len(upd)
+        out["columns"][f"{table}.{col}"] = {"rows": rewritten, "bytes_before": before,
+                                            "bytes_after": _stored_bytes(table, col)}
+        if rewritten:
+            print(f"[PACKED] {table}.{col}: {rewritten} filas devueltas a texto JSON")
+
+    if _current is None or retrain:
+        sample: List[Any] = []
+        for table, col in cols:
+            rows = db.session.execute(text(
+                f'SELECT "{col}" FROM "{table}" WHERE "{col}" IS NOT NULL ORDER BY rowid DESC LIMIT :n'),
+                {"n": samples}, bind_arguments={"bind": engine_for(table)}).all()
+            sample.extend(decode(r[0]) for r in rows)
+        codec, data = train(sample)
+        if data:
+            bd = BlobDict(codec=codec, data=data)
+            db.session.add(bd)
+            db.session.commit()
+            register(bd.id, codec, data)
+            out.update(dict_id=bd.id, trained=True, dict_bytes=len(data))
+
+    for table, col in cols:
+        bind = {"bind": engine_for(table)}
+        before = _stored_bytes(table, col)
+        last, rewritten = 0, 0
+        while True:
+            rows = db.session.execute(text(
+                f'SELECT rowid, "{col}" FROM "{table}" WHERE rowid > :l ORDER BY rowid LIMIT :n'),
+                {"l": last, "n": chunk}, bind_arguments=bind).all()
+            if not rows:
+                break
+            last = rows[-1][0]
+            upd = []
+            for rid, v in rows:
+                if v is None:
+                    continue
+                if is_packed(v):
+                    _, codec, dict_id = _HDR.unpack_from(bytes(v))
+                    if codec == RAW or dict_id == (_current or 0):
+                        continue
+                upd.append({"r": rid, "v": pack(decode(v))})
+            if upd:
+                db.session.execute(text(f'UPDATE "{table}" SET "{col}" = :v WHERE rowid = :r'), upd, bind_arguments=bind)
+                db.session.commit()
+                rewritten += len(upd)
+        out["columns"][f"{table}.{col}"] = {"rows": rewritten, "bytes_before": before,
+                                            "bytes_after": _stored_bytes(table, col)}
+        print(f"[PACKED] {table}.{col}: {rewritten} filas reescritas")
+
+    if vacuum:
+        for eng in distinct_engines().values():
+            with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text("VACUUM"))
+    return out
+
+# =========================
+# Tipo SQLAlchemy
+# =========================
+def _to_text(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+class PackedJSON(TypeDecorator):
+    """
+    JSON -> MessagePack comprimido (SQLite); JSONB sin cambios (PostgreSQL).
+    pack=False: texto JSON (lee también las filas ya empaquetadas).
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def __init__(self, pack: bool = True):
+        super().__init__()
+        self.pack = pack
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(JSONB())
+        return dialect.type_descriptor(LargeBinary() if self.pack else Text())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == "postgresql":
+            return value
+        if not self.pack:
+            return _to_text(value)
+        if _enabled:
+            return pack(value)
+        return _to_text(value).encode("utf-8")
+
+    def process_result_value(self, value, dialect):
+        if dialect.name == "postgresql":
+            return value
+        return decode(value)
+
+    def coerce_compared_value(self, op, value):
+        return self.impl_instance
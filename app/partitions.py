@@ -0,0 +1,156 @@
+# app/partitions.py
+"""
+Particiones mensuales de `estado_log` / `accion_log` en PostgreSQL.
+
+Las tablas se crean con `PARTITION BY RANGE (timestamp)` (ver
+`db.monthly_partitioned`). Este módulo crea las particiones:
+
+    estado_log_p2026_10  FOR VALUES FROM ('2026-10-01') TO ('2026-11-01')
+    estado_log_default   DEFAULT  (red de seguridad: filas fuera de rango)
+
+  - init(): al arrancar, desde PG_PARTITION_MONTHS_BACK meses atrás hasta
+    PG_PARTITION_MONTHS_AHEAD meses adelante.
+  - ensure_current(): la llama la ingesta en cada lote (coste: comparar el mes
+    actual); crea el mes en curso y el siguiente si el proceso lleva meses vivo.
+  - ensure_for(modelo, timestamps): importaciones con fechas antiguas.
+  - drop_empty_before(modelo, cutoff): el archivador borra con DROP TABLE las
+    particiones ya vaciadas (libera espacio al instante, sin VACUUM).
+
+En SQLite todas las funciones son no-op.
+"""
+from __future__ import annotations
+import threading
+from datetime import datetime
+from typing import Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import text
+
+from app import writer
+from app.db import db, engine_for, is_postgres
+from app.models import AccionLog, EstadoLog
+
+MODELS = (EstadoLog, AccionLog)
+
+_lock = threading.Lock()
+_enabled = False
+_known: Set[Tuple[str, str]] = set()   # (tabla, 'AAAA_MM') ya existentes
+_current: Optional[str] = None         # mes comprobado por ensure_current()
+
+def _month_start(dt: datetime) -> datetime:
+    return datetime(dt.year, dt.month, 1)
+
+def _add_months(dt: datetime, n: int) -> datetime:
+    y, m = divmod(dt.year * 12 + (dt.month - 1) + n, 12)
+    return datetime(y, m + 1, 1)
+
+def _suffix(dt: datetime) -> str:
+    return dt.strftime("%Y_%m")
+
+def _name(table: str, suffix: str) -> str:
+    return f"{table}_p{suffix}"
+
+def _existing(table: str) -> List[str]:
+    rows = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :t"), {"t": table}, bind_arguments={"bind": engine_for(table)}).all()
+    return [r[0] for r in rows]
+
+def init(app) -> int:
+    """Crea DEFAULT + ventana de meses. Requiere app context. Devuelve particiones creadas."""
+    global _enabled
+    _enabled = is_postgres()
+    if not _enabled:
+        return 0
+    with _lock:
+        _known.clear()
+        for model in MODELS:
+            t = model.__tablename__
+            for rel in _existing(t):
+                if rel.startswith(t + "_p"):
+                    _known.add((t, rel[len(t) + 2:]))
+    created = 0
+    for model in MODELS:
+        t = model.__tablename__
+        db.session.execute(text(f'CREATE TABLE IF NOT EXISTS "{t}_default" PARTITION OF "{t}" DEFAULT'),
+                           bind_arguments={"bind": engine_for(model)})
+    now = _month_start(datetime.utcnow())
+    back = int(app.config.get("PG_PARTITION_MONTHS_BACK", 1))
+    ahead = int(app.config.get("PG_PARTITION_MONTHS_AHEAD", 3))
+    for model in MODELS:
+        created += _ensure_months(model, [_add_months(now, k) for k in range(-back, ahead + 1)])
+    db.session.commit()
+    print(f"[PG] particiones mensuales listas ({len(_known)} existentes, {created} nuevas)")
+    return created
+
+def reset() -> None:
+    """Invalida la caché (tras un rollback que pudo deshacer un CREATE TABLE)."""
+    global _current
+    with _lock:
+        _known.clear()
+        _current = None
+
+writer.add_rollback_listener(reset)
+
+def _ensure_months(model, months: Iterable[datetime]) -> int:
+    t = model.__tablename__
+    created = 0
+    for start in sorted(set(months)):
+        suf = _suffix(start)
+        if (t, suf) in _known:
+            continue
+        end = _add_months(start, 1)
+        try:
+            # SAVEPOINT: si DEFAULT ya tiene filas de ese mes el CREATE falla sin tumbar el lote
+            with db.session.begin_nested():
+                db.session.execute(text(
+                    f'CREATE TABLE IF NOT EXISTS "{_name(t, suf)}" PARTITION OF "{t}" '
+                    f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"),
+                    bind_arguments={"bind": engine_for(model)})
+            created += 1
+        except Exception as e:
+            print(f"[PG] no se pudo crear {_name(t, suf)} (las filas quedan en {t}_default): {e}")
+        with _lock:
+            _known.add((t, suf))
+    return created
+
+def ensure_for(model, timestamps: Iterable[datetime]) -> int:
+    """Garantiza partición para cada mes de `timestamps` (sin commit)."""
+    if not _enabled:
+        return 0
+    return _ensure_months(model, {_month_start(ts) for ts in timestamps if ts is not None})
+
+def ensure_current() -> int:
+    """Mes en curso y siguiente para ambas tablas; no-op salvo al cambiar de mes."""
+    global _current
+    if not _enabled:
+        return 0
+    now = _month_start(datetime.utcnow())
+    if _current == _suffix(now):
+        return 0
+    n = sum(_ensure_months(m, [now, _add_months(now, 1)]) for m in MODELS)
+    _current = _suffix(now)
+    return n
+
+def drop_empty_before(model, cutoff: datetime) -> List[str]:
+    """DROP de las particiones que terminan antes de `cutoff` y ya no tienen filas (con commit)."""
+    if not _enabled:
+        return []
+    t = model.__tablename__
+    limit = _suffix(_month_start(cutoff))
+    dropped = []
+    for rel in sorted(_existing(t)):
+        suf = rel[len(t) + 2:] if rel.startswith(t + "_p") else None
+        if suf is None or suf >= limit:   # el mes de `cutoff` aún puede tener filas vigentes
+            continue
+        bind = {"bind": engine_for(model)}
+        if db.session.execute(text(f'SELECT 1 FROM "{rel}" LIMIT 1'), bind_arguments=bind).first() is not None:
+            continue
+        db.session.execute(text(f'DROP TABLE IF EXISTS "{rel}"'), bind_arguments=bind)
+        db.session.commit()
+        with _lock:
+            _known.discard((t, suf))
+        dropped.append(rel)
+    if dropped:
+        print(f"[PG] particiones eliminadas: {', '.join(dropped)}")
+    return dropped
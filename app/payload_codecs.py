@@ -0,0 +1,122 @@
+# app/payload_codecs.py
+"""
+Negociación de formato para payloads de estado: JSON, MessagePack o CBOR.
+
+El formato se elige por:
+  1) sufijo de tópico: dispositivos/estado/json | /msgpack | /cbor
+  2) si no hay sufijo, por el primer byte del payload:
+       '{' o espacio      -> JSON
+       0x80-0x8f, 0xde/df -> MessagePack (map)
+       0xa0-0xbb, 0xbf    -> CBOR (map) ; 0xd9d9f7 = tag self-describe CBOR
+Los tres decodifican directamente desde los bytes a la misma estructura
+(dict con serial_number, estado, parametros, configuracion). En CBOR se
+aceptan typed arrays (RFC 8746) y se convierten a listas de números.
+
+`msgpack` y `cbor2` son opcionales: si faltan, solo esos formatos fallan.
+"""
+from __future__ import annotations
+import json, struct
+from typing import Any, Optional
+
+try:
+    import msgpack
+except Exception:   # dependencia opcional
+    msgpack = None
+
+try:
+    import cbor2
+except Exception:   # dependencia opcional
+    cbor2 = None
+
+JSON, MSGPACK, CBOR = "json", "msgpack", "cbor"
+_SUFFIXES = {"json": JSON, "msgpack": MSGPACK, "mpk": MSGPACK, "cbor": CBOR}
+
+_SERIAL_KEY = b"serial_number"
+_CBOR_SELF_DESCRIBE = b"\xd9\xd9\xf7"   # tag 55799
+
+def format_from_topic(topic: str) -> Optional[str]:
+    last = (topic or "").rsplit("/", 1)[-1].lower()
+    return _SUFFIXES.get(last)
+
+def sniff(payload: bytes) -> str:
+    if not payload:
+        return JSON
+    b = payload[0]
+    if 0x80 <= b <= 0x8f or b in (0xde, 0xdf):
+        return MSGPACK
+    if 0xa0 <= b <= 0xbb or b == 0xbf or payload[:3] == _CBOR_SELF_DESCRIBE:
+        return CBOR
+    return JSON
+
+def detect(topic: str, payload: bytes) -> str:
+    return format_from_topic(topic) or sniff(payload)
+
+# ---- CBOR typed arrays (RFC 8746) ----
+_TYPED_ARRAYS = {
+    64: "B", 68: "B", 72: "b",
+    65: ">H", 66: ">I", 67: ">Q", 73: ">h", 74: ">i", 75: ">q",
+    69: "<H", 70: "<I", 71: "<Q", 77: "<h", 78: "<i", 79: "<q",
+    80: ">e", 81: ">f", 82: ">d", 84: "<e", 85: "<f", 86: "<d",
+}
+
+def _cbor_tag_hook(*args):
+    # cbor2 5.x llama hook(decoder, tag); 6.x llama hook(tag, immutable)
+    tag = next(a for a in args if hasattr(a, "tag") and hasattr(a, "value"))
+    fmt = _TYPED_ARRAYS.get(tag.tag)
+    if fmt is None or not isinstance(tag.value, (bytes, bytearray)):
+        return tag
+    endian, code = (fmt[0], fmt[1]) if len(fmt) == 2 else ("<", fmt)
+    size = struct.calcsize(code)
+    n = len(tag.value) // size
+    return list(struct.unpack(f"{endian}{n}{code}", bytes(tag.value[: n * size])))
+
+def decode(topic: str, payload: bytes) -> Any:
+    """Decodifica el payload según el formato negociado (ValueError si no se puede)."""
+    fmt = detect(topic, payload)
+    if fmt == MSGPACK:
+        if msgpack is None:
+            raise ValueError("payload MessagePack recibido pero 'msgpack' no está instalado")
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    if fmt == CBOR:
+        if cbor2 is None:
+            raise ValueError("payload CBOR recibido pero 'cbor2' no está instalado")
+        if payload[:3] == _CBOR_SELF_DESCRIBE:
+            # La etiqueta no aporta nada y cbor2 6.x decodifica su contenido como
+            # inmutable (frozendict/tuplas): se quita para obtener dict y listas
+            payload = payload[3:]
+        return cbor2.loads(payload, tag_hook=_cbor_tag_hook)
+    return json.loads(payload)
+
+def extract_serial(topic: str, payload: bytes) -> Optional[str]:
+    """
+    Serial sin decodificar el payload completo (solo para elegir carril).
+    Busca la clave 'serial_number' y lee la cabecera del string siguiente.
+    """
+    i = payload.find(_SERIAL_KEY)
+    if i < 0:
+        return None
+    j = i + len(_SERIAL_KEY)
+    fmt = detect(topic, payload)
+    try:
+        if fmt == JSON:
+            start = payload.index(b'"', payload.index(b":", j)) + 1
+            end = payload.index(b'"', start)
+            return payload[start:end].decode("utf-8", "replace")
+        h = payload[j]
+        if fmt == MSGPACK:
+            if 0xa0 <= h <= 0xbf:
+                n, j = h & 0x1f, j + 1
+            elif h == 0xd9:
+                n, j = payload[j + 1], j + 2
+            else:
+                return None
+        else:   # CBOR: text string (major type 3)
+            if 0x60 <= h <= 0x77:
+                n, j = h - 0x60, j + 1
+            elif h == 0x78:
+                n, j = payload[j + 1], j + 2
+            else:
+                return None
+        return payload[j:j + n].decode("utf-8", "replace")
+    except (ValueError, IndexError):
+        return None
@@ -0,0 +1,167 @@
+# app/purge.py
+"""
+Borrado de dispositivos con tombstone y purga del histórico por lotes.
+
+DELETE /dispositivos/<id> solo marca la fila (`eliminado_at`) en una
+transacción corta del escritor único:
+  - libera el serial (`~<id>~<serial>`): si el equipo vuelve a publicar se
+    da de alta como uno nuevo, sin reclamar;
+  - lo quita de su habitación y, ya comiteado (`writer.after_commit`), del
+    registro en memoria, de las cachés de la ingesta, del codificador delta,
+    de la política de almacenamiento y de la capa caliente de métricas.
+
+Un hilo en segundo plano (`Purger`) borra después su histórico en lotes de
+PURGE_BATCH_ROWS filas (una transacción por lote, con PURGE_PAUSE_MS de
+pausa): estado_log, accion_log, metric_sample, metric_rollup y los
+segmentos archivados. Al final borra la fila del dispositivo. Los
+tombstones pendientes se retoman al arrancar.
+"""
+from __future__ import annotations
+import threading, time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from flask import Flask
+from sqlalchemy import delete, select, tuple_
+
+from app import archive, deltas, hot_tier, ingest, registry, storage_policy, writer
+from app.db import db
+from app.models import AccionLog, Dispositivo, EstadoLog, MetricRollup, MetricSample
+
+# (modelo, columna del dispositivo), en orden de borrado
+TARGETS = (
+    (EstadoLog, "dispositivo_id"),
+    (AccionLog, "dispositivo_id"),
+    (MetricSample, "device_id"),
+    (MetricRollup, "device_id"),
+)
+
+_thread: Optional[threading.Thread] = None
+_stop = threading.Event()
+_wake = threading.Event()
+_stats_lock = threading.Lock()
+_stats: Dict[str, Any] = {"tombstoned": 0, "purged_devices": 0, "purged_rows": 0, "batches": 0, "errors": 0}
+
+def init(app: Flask) -> None:
+    """Arranca el hilo de purga (idempotente)."""
+    global _thread
+    if _thread is not None:
+        return
+    _thread = threading.Thread(target=_loop, args=(app,), name="Purger", daemon=True)
+    _thread.start()
+
+def stop() -> None:
+    _stop.set()
+    _wake.set()
+
+def wake() -> None:
+    """Adelanta la siguiente pasada (tras un DELETE)."""
+    _wake.set()
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        return dict(_stats)
+
+def _count(**kw) -> None:
+    with _stats_lock:
+        for k, v in kw.items():
+            _stats[k] = _stats.get(k, 0) + v
+
+# =========================
+# Tombstone (intención del escritor)
+# =========================
+def _tombstone(dev_id: int) -> Optional[Dict[str, Any]]:
+    d = db.session.get(Dispositivo, dev_id)
+    if d is None or d.eliminado_at is not None:
+        return None
+    serial, room = d.serial_number, d.habitacion_id
+    d.eliminado_at = datetime.utcnow()
+    d.serial_number = f"~{d.id}~{serial}"[:100]
+    d.reclamado = False
+    d.habitacion_id = None
+    # Solo si la transacción se comitea (con rollback todo sigue como estaba)
+    writer.after_commit(lambda: _forget(dev_id, serial))
+    return {"id": dev_id, "serial_number": serial, "habitacion_id": room}
+
+def _forget(dev_id: int, serial: str) -> None:
+    """Post-commit del tombstone, en el hilo escritor: fuera de memoria."""
+    registry.forget(dev_id)
+    ingest.forget(dev_id)
+    deltas.estado.forget(dev_id)
+    deltas.accion.forget(dev_id)
+    hot_tier.forget(dev_id)
+    storage_policy.forget(serial)   # un alta nueva con este serial no hereda el estado de deadband
+
+def tombstone(dev_id: int) -> Optional[Dict[str, Any]]:
+    """Marca el dispositivo como eliminado. None si no existe (o ya estaba marcado)."""
+    res = writer.run(_tombstone, dev_id)
+    if res is not None:
+        _count(tombstoned=1)
+        wake()
+    return res
+
+# =========================
+# Purga por lotes
+# =========================
+def _delete_chunk(model, column: str, dev_id: int, limit: int) -> int:
+    pk = list(model.__table__.primary_key.columns)
+    sub = select(*pk).where(getattr(model.__table__.c, column) == dev_id).limit(limit)
+    cond = pk[0].in_(sub) if len(pk) == 1 else tuple_(*pk).in_(sub)
+    return db.session.execute(delete(model.__table__).where(cond)).rowcount or 0
+
+def _drop_device(dev_id: int) -> bool:
+    """Último paso: borra la fila si no le quedan logs (una ingesta en vuelo pudo añadir alguno)."""
+    for model, column in TARGETS[:2]:
+        if db.session.query(getattr(model, column)).filter(getattr(model, column) == dev_id).first() is not None:
+            return False
+    db.session.query(Dispositivo).filter(Dispositivo.id == dev_id,
+                                         Dispositivo.eliminado_at.isnot(None)).delete(synchronize_session=False)
+    return True
+
+def purge_device(dev_id: int, batch: int = 2000, pause: float = 0.05) -> int:
+    """Borra todo el histórico de un dispositivo marcado. Requiere app context. Devuelve filas."""
+    total = 0
+    for model, column in TARGETS:
+        while not _stop.is_set():
+            n = writer.run(_delete_chunk, model, column, dev_id, batch)
+            total += n
+            _count(batches=1, purged_rows=n)
+            if n < batch:
+                break
+            time.sleep(pause)
+    if _stop.is_set():
+        return total
+    archive.purge_device(dev_id)
+    if writer.run(_drop_device, dev_id):
+        _count(purged_devices=1)
+    return total
+
+def pending() -> List[int]:
+    rows = db.session.query(Dispositivo.id).filter(Dispositivo.eliminado_at.isnot(None)) \
+        .order_by(Dispositivo.eliminado_at.asc()).all()
+    return [r[0] for r in rows]
+
+def run_once(app: Flask) -> Dict[str, int]:
+    batch = int(app.config.get("PURGE_BATCH_ROWS", 2000))
+    pause = float(app.config.get("PURGE_PAUSE_MS", 50)) / 1000.0
+    out: Dict[str, int] = {}
+    for dev_id in pending():
+        if _stop.is_set():
+            break
+        t0 = time.perf_counter()
+        out[str(dev_id)] = n = purge_device(dev_id, batch, pause)
+        print(f"[PURGE] 🧹 dispositivo={dev_id} filas={n} en {time.perf_counter() - t0:.2f}s")
+    return out
+
+def _loop(app: Flask) -> None:
+    interval = float(app.config.get("PURGE_INTERVAL_S", 300))
+    with app.app_context():
+        while not _stop.is_set():
+            _wake.clear()
+            try:
+                run_once(app)
+            except Exception as e:
+                db.session.rollback()
+                _count(errors=1)
+                print("[PURGE ERROR]", e)
+            _wake.wait(interval)
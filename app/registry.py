@@ -0,0 +1,83 @@
+# app/registry.py
+"""
+Registro en memoria de dispositivos (proceso completo), indexado por serial e id.
+
+Evita un SELECT por mensaje MQTT y por iteración del watchdog (Rule4).
+Se carga al arrancar y se mantiene coherente desde los caminos que escriben
+(ingesta MQTT, PUT /dispositivos/<id>, reclamar, alta manual, Rule5).
+"""
+from __future__ import annotations
+import threading
+from typing import Dict, Optional
+from app.models import Dispositivo
+
+class DeviceRecord:
+    """Ficha compacta de un dispositivo (lo mínimo para los caminos calientes)."""
+    __slots__ = ("id", "serial_number", "reclamado", "tipo", "rev")
+
+    def __init__(self, id: int, serial_number: str, reclamado: bool, tipo: str, rev: int = 0):
+        self.id = id
+        self.serial_number = serial_number
+        self.reclamado = reclamado
+        self.tipo = tipo
+        self.rev = rev   # se incrementa cuando alguien distinto de la ingesta modifica la fila
+
+    def __repr__(self) -> str:
+        return f"<DeviceRecord {self.id} {self.serial_number} reclamado={self.reclamado} rev={self.rev}>"
+
+_lock = threading.Lock()
+_by_serial: Dict[str, DeviceRecord] = {}
+_by_id: Dict[int, DeviceRecord] = {}
+
+def load() -> int:
+    """Carga todos los dispositivos (requiere app context). Devuelve cuántos."""
+    rows = Dispositivo.query.with_entities(
+        Dispositivo.id, Dispositivo.serial_number, Dispositivo.reclamado,
+        Dispositivo.tipo
+    ).filter(Dispositivo.eliminado_at.is_(None)).all()
+    with _lock:
+        _by_serial.clear()
+        _by_id.clear()
+        for id_, serial, recl, tipo in rows:
+            rec = DeviceRecord(id_, serial, bool(recl), tipo)
+            _by_serial[serial] = rec
+            _by_id[id_] = rec
+    print(f"[REGISTRY] {len(rows)} dispositivos cargados")
+    return len(rows)
+
+def get(serial: str) -> Optional[DeviceRecord]:
+    return _by_serial.get(serial)
+
+def get_by_id(dev_id: int) -> Optional[DeviceRecord]:
+    return _by_id.get(dev_id)
+
+def remember(d: Dispositivo, *, bump: bool = True) -> DeviceRecord:
+    """
+    Refresca la ficha a partir de un `Dispositivo` ya comiteado.
+    bump=True marca que la fila cambió fuera de la ingesta (el escritor
+    debe refrescar su copia en caché antes de volver a usarla).
+    """
+    with _lock:
+        rec = _by_id.get(d.id)
+        if rec is None:
+            rec = DeviceRecord(d.id, d.serial_number, bool(d.reclamado), d.tipo)
+            _by_id[d.id] = rec
+        else:
+            if rec.serial_number != d.serial_number:
+                _by_serial.pop(rec.serial_number, None)
+            rec.serial_number = d.serial_number
+            rec.reclamado = bool(d.reclamado)
+            rec.tipo = d.tipo
+            if bump:
+                rec.rev += 1
+        _by_serial[d.serial_number] = rec
+    return rec
+
+def forget(dev_id: int) -> None:
+    with _lock:
+        rec = _by_id.pop(dev_id, None)
+        if rec is not None and _by_serial.get(rec.serial_number) is rec:   # puede haberlo retomado un alta nueva
+            _by_serial.pop(rec.serial_number)
+
+def size() -> int:
+    return len(_by_id)
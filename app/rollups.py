@@ -0,0 +1,198 @@
+# app/rollups.py
+"""
+Rollups por cubeta de tiempo (1m / 1h / 1d) sobre `metric_sample`.
+
+Cada lote de muestras se agrega en memoria por (device_id, metric_id, res,
+cubeta) y se aplica con UN upsert por lote:
+    INSERT ... ON CONFLICT(device_id, metric_id, res, bucket) DO UPDATE SET
+      count = count + excluded.count, min = min(min, excluded.min), ...
+      m2 = m2 + excluded.m2 + delta² * n_a * n_b / (n_a + n_b)   (Chan)
+en la misma transacción que las muestras (ingesta, PUT, importación). Así los
+paneles y la línea base de Rule1 leen cientos de filas agregadas en vez de
+decenas de miles de muestras.
+
+Percentiles aproximados: cada cubeta se modela como una normal (media,
+desviación) recortada a [min, max]; el percentil de la mezcla ponderada por
+count se obtiene por bisección sobre su CDF.
+"""
+from __future__ import annotations
+import math, time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func
+
+from app.db import db, insert, is_postgres
+from app.models import MetricRollup, MetricSample
+
+RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+_EPOCH = datetime(1970, 1, 1)
+
+def bucket_of(ts: datetime, res: int) -> datetime:
+    """Inicio de la cubeta (naive UTC) que contiene `ts`."""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    secs = int((ts - _EPOCH).total_seconds())
+    return _EPOCH + timedelta(seconds=secs - secs % res)
+
+def _aggregate(rows: Iterable[Dict[str, Any]], resolutions: Iterable[int]) -> List[Dict[str, Any]]:
+    # [count, min, max, sum, sumsq, media, m2] (Welford)
+    acc: Dict[Tuple[int, int, int, datetime], List[float]] = {}
+    for r in rows:
+        v = float(r["value"])
+        for res in resolutions:
+            k = (r["device_id"], r["metric_id"], res, bucket_of(r["ts"], res))
+            a = acc.get(k)
+            if a is None:
+                acc[k] = [1, v, v, v, v * v, v, 0.0]
+            else:
+                a[0] += 1
+                if v < a[1]: a[1] = v
+                if v > a[2]: a[2] = v
+                a[3] += v
+                a[4] += v * v
+                d = v - a[5]
+                a[5] += d / a[0]
+                a[6] += d * (v - a[5])
+    return [
+        {"device_id": d, "metric_id": m, "res": res, "bucket": b,
+         "count": a[0], "min": a[1], "max": a[2], "sum": a[3], "sumsq": a[4], "m2": a[6]}
+        for (d, m, res, b), a in acc.items()
+    ]
+
+def _resolutions() -> List[int]:
+    from flask import current_app
+    names = current_app.config.get("ROLLUP_RESOLUTIONS") or list(RESOLUTIONS)
+    return [RESOLUTIONS[n] for n in names if n in RESOLUTIONS]
+
+def apply(sample_rows: List[Dict[str, Any]]) -> int:
+    """Suma un lote de filas de metric_sample a sus rollups (sin commit)."""
+    if not sample_rows:
+        return 0
+    agg = _aggregate(sample_rows, _resolutions())
+    t = MetricRollup.__table__
+    stmt = insert(t)
+    ex = stmt.excluded
+    least, greatest = (func.least, func.greatest) if is_postgres() else (func.min, func.max)   # min/max escalares en SQLite
+    n_a, n_b = t.c["count"], ex["count"]
+    delta = ex["sum"] / n_b - t.c["sum"] / n_a
+    # Cubetas anteriores a m2: se estima desde sumsq (como hacía stats_of)
+    m2_a = func.coalesce(t.c["m2"], greatest(t.c["sumsq"] - t.c["sum"] * t.c["sum"] / n_a, 0.0))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[t.c.device_id, t.c.metric_id, t.c.res, t.c.bucket],
+        set_={
+            "count": t.c["count"] + ex["count"],
+            "min": least(t.c["min"], ex["min"]),
+            "max": greatest(t.c["max"], ex["max"]),
+            "sum": t.c["sum"] + ex["sum"],
+            "sumsq": t.c["sumsq"] + ex["sumsq"],
+            "m2": m2_a + ex["m2"] + delta * delta * (n_a * 1.0) * n_b / (n_a + n_b),
+        },
+    )
+    db.session.execute(stmt, agg)
+    return len(agg)
+
+# =========================
+# Lecturas
+# =========================
+def _naive_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    if dt is None or dt.tzinfo is None:
+        return dt
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+def read(device_id: int, metric_id: int, res: int, since: Optional[datetime] = None,
+         until: Optional[datetime] = None) -> List[MetricRollup]:
+    q = MetricRollup.query.filter(
+        MetricRollup.device_id == device_id, MetricRollup.metric_id == metric_id, MetricRollup.res == res)
+    since, until = _naive_utc(since), _naive_utc(until)
+    if since is not None:
+        q = q.filter(MetricRollup.bucket >= bucket_of(since, res))
+    if until is not None:
+        q = q.filter(MetricRollup.bucket <= until)
+    return q.order_by(MetricRollup.bucket.asc()).all()
+
+def stats_of(r: MetricRollup) -> Dict[str, Any]:
+    n = r.count or 0
+    mean = r.sum / n if n else math.nan
+    if not n:
+        var = math.nan
+    elif r.m2 is not None:
+        var = max(0.0, r.m2 / n)
+    else:
+        var = max(0.0, r.sumsq / n - mean * mean)   # cubeta anterior a m2
+    return {"count": n, "min": r.min, "max": r.max, "avg": mean, "std": math.sqrt(var) if n else math.nan}
+
+def _bucket_cdf(x: float, mn: float, mx: float, mu: float, sd: float) -> float:
+    if x < mn:
+        return 0.0
+    if x >= mx:
+        return 1.0
+    if sd <= 0:
+        return 1.0 if x >= mu else 0.0
+    # normal recortada a [mn, mx]
+    phi = lambda z: 0.5 * (1.0 + math.erf(z / math.sqrt(2.0)))
+    lo, hi = phi((mn - mu) / sd), phi((mx - mu) / sd)
+    if hi - lo <= 1e-12:
+        return 1.0 if x >= mu else 0.0
+    return (phi((x - mu) / sd) - lo) / (hi - lo)
+
+def approx_percentiles(buckets: List[MetricRollup], ps: Iterable[float]) -> Dict[float, float]:
+    """Percentiles aproximados (0-100) de la mezcla de cubetas."""
+    parts = []
+    total = 0
+    for r in buckets:
+        s = stats_of(r)
+        if s["count"]:
+            parts.append((s["count"], r.min, r.max, s["avg"], s["std"]))
+            total += s["count"]
+    if not total:
+        return {}
+    gmin = min(p[1] for p in parts)
+    gmax = max(p[2] for p in parts)
+    out: Dict[float, float] = {}
+    for p in ps:
+        target = max(0.0, min(1.0, p / 100.0))
+        lo, hi = gmin, gmax
+        for _ in range(40):
+            mid = (lo + hi) / 2.0
+            cdf = sum(n * _bucket_cdf(mid, a, b, mu, sd) for n, a, b, mu, sd in parts) / total
+            if cdf < target:
+                lo = mid
+            else:
+                hi = mid
+        out[p] = hi
+    return out
+
+# =========================
+# Backfill (reconstrucción completa)
+# =========================
+def rebuild(chunk: int = 20000, progress=None) -> Dict[str, Any]:
+    """
+    Reconstruye los rollups desde metric_sample. El DELETE y la lectura del
+    id máximo van en la misma transacción: las muestras comiteadas después
+    (id mayor) ya suman en vivo sobre la tabla vacía y no se cuentan dos veces.
+    """
+    t0 = time.perf_counter()
+    db.session.query(MetricRollup).delete(synchronize_session=False)
+    max_id = db.session.query(func.max(MetricSample.id)).scalar() or 0
+    db.session.commit()
+
+    st = {"samples": 0, "rollup_rows": 0, "seconds": 0.0}
+    last = 0
+    cols = (MetricSample.id, MetricSample.device_id, MetricSample.metric_id, MetricSample.ts, MetricSample.value)
+    while last < max_id:
+        batch = db.session.query(*cols).filter(MetricSample.id > last, MetricSample.id <= max_id) \
+            .order_by(MetricSample.id.asc()).limit(chunk).all()
+        if not batch:
+            break
+        last = batch[-1][0]
+        st["rollup_rows"] += apply([{"device_id": d, "metric_id": m, "ts": ts, "value": v}
+                                    for _, d, m, ts, v in batch])
+        db.session.commit()
+        st["samples"] += len(batch)
+        st["seconds"] = round(time.perf_counter() - t0, 3)
+        print(f"[ROLLUP] backfill muestras={st['samples']}")
+        if progress:
+            progress(dict(st))
+    st["seconds"] = round(time.perf_counter() - t0, 3)
+    return st
@@ -1,7 +1,7 @@
 # app/routes.py
-from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app, send_file
+from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app, send_file, abort
 from app.models import Dispositivo, EstadoLog
-from app.db import db
+from app.db import db, upsert_returning
 from app.models import (
     Dispositivo,
     EstadoLog,
@@ -11,11 +11,12 @@ from app.models import (
     SecurityCode,       # códigos de seguridad (cambio contraseña y forgot/registro)
     AccionLog           # <-- NUEVO: para auditoría/eventos de negocio
 )
-from app.sse import subscribe, unsubscribe, publish as sse_publish
-import json, time, requests
-from queue import Empty
+from app.sse import subscribe, frames as sse_frames, publish as sse_publish, stats as sse_stats
+from app import registry, ingest, ingest_lanes, bulk_import, metrics, rollups, archive, writer, deltas, purge, sqlite_maint, hot_tier, analytics
+import base64, json, time, requests
 from datetime import datetime, timezone
 from app.iotelligence.core import dispatch_measure
+from app.iotelligence.worker import stats as ai_worker_stats
 
 import os
 import smtplib
@@ -24,10 +25,10 @@ import secrets
 from email.message import EmailMessage
 from email.utils import make_msgid
 from datetime import datetime, timedelta
-from queue import Empty
 from secrets import randbelow
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
 from werkzeug.utils import secure_filename
+from werkzeug.security import generate_password_hash
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from app.iotelligence.dev_kinds import infer_kind, infer_capability
 
@@ -69,19 +70,47 @@ def _actor_tag() -> str:
     except Exception:
         return "system"
 
-def _log_action(dispositivo_id: int, evento: str, detalle: dict | None = None, actor: str | None = None):
+def _log_action(dispositivo_id: int, evento: str, detalle: dict | None = None, actor: str | None = None,
+                ts: datetime | None = None):
     try:
+        ts = ts or datetime.utcnow()
+        detalle = detalle or {}
+        if evento in deltas.ACCION_EVENTS:
+            # payload repetido en cada cambio: keyframe periódico + claves cambiadas
+            detalle = deltas.encode_payload_detalle(dispositivo_id, detalle, ts)
         a = AccionLog(
             dispositivo_id=dispositivo_id,
             evento=evento,
-            detalle=(detalle or {}),
-            actor=(actor or _actor_tag())
+            detalle=detalle,
+            actor=(actor or _actor_tag()),
+            timestamp=ts
         )
         db.session.add(a)
         # No hacemos commit aquí; se comitea en la transacción del caller
     except Exception as e:
         current_app.logger.warning(f"[accion_log] No se pudo registrar acción {evento} para {dispositivo_id}: {e}")
 
+def _dispositivo_or_404(id):
+    """Como get_or_404, pero los dispositivos eliminados (tombstone, app/purge.py) no existen."""
+    return Dispositivo.query.filter(Dispositivo.id == id, Dispositivo.eliminado_at.is_(None)).first_or_404()
+
+def _alta_dispositivo(data):
+    """Intención del escritor para POST /dispositivos."""
+    nuevo = Dispositivo(
+        serial_number=data.get('serial_number'),
+        nombre=data.get('nombre'),
+        tipo=data.get('tipo'),
+        modelo=data.get('modelo', ''),
+        descripcion=data.get('descripcion', ''),
+        estado=data.get('estado', 'desconocido'),
+        parametros={},
+        configuracion=data.get('configuracion', {}),
+        reclamado=data.get('reclamado', False)  # <-- Nuevo campo opcional
+    )
+    db.session.add(nuevo)
+    db.session.flush()   # id asignado antes del commit del lote
+    return nuevo
+
 @bp.route('/dispositivos', methods=['POST'])
 @jwt_required(optional=True)
 def agregar_dispositivo():
@@ -90,22 +119,10 @@ def agregar_dispositivo():
         if not data:
             return jsonify({"error": "Datos JSON inválidos o faltantes"}), 400
 
-        nuevo = Dispositivo(
-            serial_number=data.get('serial_number'),
-            nombre=data.get('nombre'),
-            tipo=data.get('tipo'),
-            modelo=data.get('modelo', ''),
-            descripcion=data.get('descripcion', ''),
-            estado=data.get('estado', 'desconocido'),
-            parametros={},
-            configuracion=data.get('configuracion', {}),
-            reclamado=data.get('reclamado', False)  # <-- Nuevo campo opcional
-        )
-        db.session.add(nuevo)
-        db.session.commit()
+        nuevo = writer.run(_alta_dispositivo, data)
+        registry.remember(nuevo)
         return jsonify({"mensaje": "Dispositivo agregado", "id": nuevo.id}), 201
     except Exception as e:
-        db.session.rollback()
         return jsonify({"error": "Error al agregar dispositivo", "detalle": str(e)}), 500
 
 
@@ -235,6 +252,159 @@ def _set_room_icon_if_present(room: Habitacion, value: str | None):
     _safe_set(room, value, "icon", "icono", "icon_name", "iconName")
 
 
+def _aplicar_actualizacion(id, data, actor):
+    """Intención del escritor para PUT /dispositivos/<id>: merge + EstadoLog + auditoría (sin commit)."""
+    dispositivo = _dispositivo_or_404(id)
+
+    old_name = dispositivo.nombre  # para log de renombrado
+
+    # --- CONFIGURACIÓN ---
+    cfg_actual = dispositivo.configuracion or {}
+    cfg_payload = data.get("configuracion") or {}
+    cfg_merged = {**cfg_actual, **cfg_payload}
+
+    # ✅ encendido puede venir arriba o dentro de configuracion
+    if "encendido" in data and data["encendido"] is not None:
+        cfg_merged["encendido"] = bool(data["encendido"])
+
+    # ✅ Soporte capabilities/capability (plantillas nuevas)
+    if "capability" not in cfg_merged and "capabilities" in cfg_merged:
+        caps = cfg_merged.pop("capabilities")
+        if isinstance(caps, list) and caps:
+            cfg_merged["capability"] = caps[0]
+        else:
+            cfg_merged["capability"] = caps  # string o None tal cual
+
+    # ✅ Asegura que los canales existan como dict si el cliente manda null
+    for k in ("horarios", "horarios_pos", "horarios_speed",
+              "horarios_lock", "horarios_riego", "horarios_temp"):
+        if k in cfg_merged and cfg_merged[k] is None:
+            cfg_merged[k] = {}
+
+    # (opcional) Validación/sanitización ligera de los mapas de horarios
+    def _is_event_list(v):
+        # espera lista de pares ["HH:MM", valor]
+        if not isinstance(v, list): 
+            return False
+        return all(isinstance(x, (list, tuple)) and len(x) == 2 for x in v)
+
+    def _sanitize_schedule_map(m):
+        if not isinstance(m, dict):
+            return m
+        out = {}
+        for day, lst in m.items():
+            if _is_event_list(lst):
+                out[str(day).lower()] = lst
+        return out
+
+    for ch in ("horarios", "horarios_pos", "horarios_speed",
+               "horarios_lock", "horarios_riego", "horarios_temp"):
+        if ch in cfg_merged and isinstance(cfg_merged[ch], dict):
+            cfg_merged[ch] = _sanitize_schedule_map(cfg_merged[ch])
+
+    # --- PARAMETROS ---
+    par_actual = dispositivo.parametros or {}
+    par_payload = data.get("parametros") or {}
+
+    # Extraer campos planos compatibles y meterlos en parámetros
+    flat_params = {}
+    # pos/position (0..100)
+    if "pos" in data and data["pos"] is not None:
+        try: flat_params["pos"] = int(data["pos"])
+        except: pass
+    if "position" in data and data["position"] is not None:
+        try: flat_params["position"] = int(data["position"])
+        except: pass
+    # speed/velocidad
+    if "speed" in data and data["speed"] is not None:
+        try:
+            flat_params["speed"] = int(data["speed"])
+            flat_params["velocidad"] = int(data["speed"])  # espejo común
+        except:
+            pass
+    if "velocidad" in data and data["velocidad"] is not None:
+        try:
+            flat_params["velocidad"] = int(data["velocidad"])
+            flat_params["speed"] = int(data["velocidad"])
+        except:
+            pass
+    # set_temp
+    if "set_temp" in data and data["set_temp"] is not None:
+        try: flat_params["set_temp"] = int(data["set_temp"])
+        except: pass
+    # minutos restantes
+    if "minutes_left" in data and data["minutes_left"] is not None:
+        try: flat_params["minutes_left"] = int(data["minutes_left"])
+        except: pass
+    # epoch de fin de riego
+    if "watering_end_epoch" in data and data["watering_end_epoch"] is not None:
+        try: flat_params["watering_end_epoch"] = int(data["watering_end_epoch"])
+        except: pass
+
+    parametros_merged = {**par_actual, **flat_params, **par_payload}
+
+    # --- ESTADO ---
+    estado_in = data.get("estado", None)
+    if isinstance(estado_in, str):
+        estado_in = estado_in.strip()
+        # mantenemos tal cual (sin normalizar a "activo/inactivo")
+        if estado_in != "":
+            dispositivo.estado = estado_in
+
+    # Derivar encendido si no vino y el estado es un on/off típico
+    if "encendido" not in cfg_merged:
+        if isinstance(estado_in, str):
+            low = estado_in.lower()
+            if low in ("on", "activo", "active", "true", "1"):
+                cfg_merged["encendido"] = True
+            elif low in ("off", "inactivo", "inactive", "false", "0"):
+                cfg_merged["encendido"] = False
+            # Otros estados (open/closed/locked/unlocked/watering/cleaning…) no definen encendido.
+
+    # --- CAMPOS EXTRA (opcionales) ---
+    renamed = False
+    if "nombre" in data and data["nombre"] != dispositivo.nombre:
+        renamed = True
+    if "nombre" in data:
+        dispositivo.nombre = data["nombre"]
+    if "tipo" in data:
+        dispositivo.tipo = data["tipo"]
+    if "modelo" in data:
+        dispositivo.modelo = data["modelo"]
+    if "descripcion" in data:
+        dispositivo.descripcion = data["descripcion"]
+
+    # Aplicar merges finales en el modelo
+    dispositivo.parametros = parametros_merged
+    dispositivo.configuracion = cfg_merged
+
+    # Logs: estado histórico
+    log_ts = datetime.utcnow()
+    log = EstadoLog(
+        dispositivo_id=dispositivo.id,
+        estado=dispositivo.estado,
+        parametros=deltas.estado.encode(dispositivo.id, dispositivo.parametros or {}, log_ts),
+        timestamp=log_ts
+    )
+    db.session.add(log)
+    metrics.insert_samples([(dispositivo.id, log_ts, dispositivo.parametros)])
+
+    # Logs: acciones/configuración/renombrado
+    if renamed:
+        _log_action(dispositivo.id, "renamed", {"old": old_name, "new": dispositivo.nombre}, actor=actor)
+    # Registrar el payload exacto que llegó (útil para auditoría/config)
+    if (cfg_payload or par_payload or flat_params or estado_in is not None):
+        _log_action(
+            dispositivo.id,
+            "config_changed",
+            {"payload": data},
+            actor=actor,
+            ts=log_ts
+        )
+
+    return dispositivo
+
+
 @bp.route('/dispositivos/<int:id>', methods=['PUT'])
 @jwt_required(optional=True)
 def actualizar_dispositivo(id):
@@ -248,150 +418,8 @@ def actualizar_dispositivo(id):
     """
     try:
         data = request.get_json() or {}
-        dispositivo = Dispositivo.query.get_or_404(id)
-
-        old_name = dispositivo.nombre  # para log de renombrado
-
-        # --- CONFIGURACIÓN ---
-        cfg_actual = dispositivo.configuracion or {}
-        cfg_payload = data.get("configuracion") or {}
-        cfg_merged = {**cfg_actual, **cfg_payload}
-
-        # ✅ encendido puede venir arriba o dentro de configuracion
-        if "encendido" in data and data["encendido"] is not None:
-            cfg_merged["encendido"] = bool(data["encendido"])
-
-        # ✅ Soporte capabilities/capability (plantillas nuevas)
-        if "capability" not in cfg_merged and "capabilities" in cfg_merged:
-            caps = cfg_merged.pop("capabilities")
-            if isinstance(caps, list) and caps:
-                cfg_merged["capability"] = caps[0]
-            else:
-                cfg_merged["capability"] = caps  # string o None tal cual
-
-        # ✅ Asegura que los canales existan como dict si el cliente manda null
-        for k in ("horarios", "horarios_pos", "horarios_speed",
-                  "horarios_lock", "horarios_riego", "horarios_temp"):
-            if k in cfg_merged and cfg_merged[k] is None:
-                cfg_merged[k] = {}
-
-        # (opcional) Validación/sanitización ligera de los mapas de horarios
-        def _is_event_list(v):
-            # espera lista de pares ["HH:MM", valor]
-            if not isinstance(v, list): 
-                return False
-            return all(isinstance(x, (list, tuple)) and len(x) == 2 for x in v)
-
-        def _sanitize_schedule_map(m):
-            if not isinstance(m, dict):
-                return m
-            out = {}
-            for day, lst in m.items():
-                if _is_event_list(lst):
-                    out[str(day).lower()] = lst
-            return out
-
-        for ch in ("horarios", "horarios_pos", "horarios_speed",
-                   "horarios_lock", "horarios_riego", "horarios_temp"):
-            if ch in cfg_merged and isinstance(cfg_merged[ch], dict):
-                cfg_merged[ch] = _sanitize_schedule_map(cfg_merged[ch])
-
-        # --- PARAMETROS ---
-        par_actual = dispositivo.parametros or {}
-        par_payload = data.get("parametros") or {}
-
-        # Extraer campos planos compatibles y meterlos en parámetros
-        flat_params = {}
-        # pos/position (0..100)
-        if "pos" in data and data["pos"] is not None:
-            try: flat_params["pos"] = int(data["pos"])
-            except: pass
-        if "position" in data and data["position"] is not None:
-            try: flat_params["position"] = int(data["position"])
-            except: pass
-        # speed/velocidad
-        if "speed" in data and data["speed"] is not None:
-            try:
-                flat_params["speed"] = int(data["speed"])
-                flat_params["velocidad"] = int(data["speed"])  # espejo común
-            except:
-                pass
-        if "velocidad" in data and data["velocidad"] is not None:
-            try:
-                flat_params["velocidad"] = int(data["velocidad"])
-                flat_params["speed"] = int(data["velocidad"])
-            except:
-                pass
-        # set_temp
-        if "set_temp" in data and data["set_temp"] is not None:
-            try: flat_params["set_temp"] = int(data["set_temp"])
-            except: pass
-        # minutos restantes
-        if "minutes_left" in data and data["minutes_left"] is not None:
-            try: flat_params["minutes_left"] = int(data["minutes_left"])
-            except: pass
-        # epoch de fin de riego
-        if "watering_end_epoch" in data and data["watering_end_epoch"] is not None:
-            try: flat_params["watering_end_epoch"] = int(data["watering_end_epoch"])
-            except: pass
-
-        parametros_merged = {**par_actual, **flat_params, **par_payload}
-
-        # --- ESTADO ---
-        estado_in = data.get("estado", None)
-        if isinstance(estado_in, str):
-            estado_in = estado_in.strip()
-            # mantenemos tal cual (sin normalizar a "activo/inactivo")
-            if estado_in != "":
-                dispositivo.estado = estado_in
-
-        # Derivar encendido si no vino y el estado es un on/off típico
-        if "encendido" not in cfg_merged:
-            if isinstance(estado_in, str):
-                low = estado_in.lower()
-                if low in ("on", "activo", "active", "true", "1"):
-                    cfg_merged["encendido"] = True
-                elif low in ("off", "inactivo", "inactive", "false", "0"):
-                    cfg_merged["encendido"] = False
-                # Otros estados (open/closed/locked/unlocked/watering/cleaning…) no definen encendido.
-
-        # --- CAMPOS EXTRA (opcionales) ---
-        renamed = False
-        if "nombre" in data and data["nombre"] != dispositivo.nombre:
-            renamed = True
-        if "nombre" in data:
-            dispositivo.nombre = data["nombre"]
-        if "tipo" in data:
-            dispositivo.tipo = data["tipo"]
-        if "modelo" in data:
-            dispositivo.modelo = data["modelo"]
-        if "descripcion" in data:
-            dispositivo.descripcion = data["descripcion"]
-
-        # Aplicar merges finales en el modelo
-        dispositivo.parametros = parametros_merged
-        dispositivo.configuracion = cfg_merged
-
-        # Logs: estado histórico
-        log = EstadoLog(
-            dispositivo_id=dispositivo.id,
-            estado=dispositivo.estado,
-            parametros=dispositivo.parametros or {}
-        )
-        db.session.add(log)
-
-        # Logs: acciones/configuración/renombrado
-        if renamed:
-            _log_action(dispositivo.id, "renamed", {"old": old_name, "new": dispositivo.nombre})
-        # Registrar el payload exacto que llegó (útil para auditoría/config)
-        if (cfg_payload or par_payload or flat_params or estado_in is not None):
-            _log_action(
-                dispositivo.id,
-                "config_changed",
-                {"payload": data}
-            )
-
-        db.session.commit()
+        dispositivo = writer.run(_aplicar_actualizacion, id, data, _actor_tag())
+        registry.remember(dispositivo)
 
         # Disparar regla por cambio de config/estado
         now = datetime.now(timezone.utc)
@@ -414,7 +442,7 @@ def actualizar_dispositivo(id):
                 "parametros": dispositivo.parametros,
                 "configuracion": dispositivo.configuracion,
                 "reclamado": dispositivo.reclamado
-            })
+            }, room=dispositivo.habitacion_id)
         except Exception as e:
             current_app.logger.warning(f"[sse] publish error: {e}")
 
@@ -422,24 +450,40 @@ def actualizar_dispositivo(id):
         return jsonify(_device_full_payload(dispositivo)), 200
 
     except Exception as e:
-        db.session.rollback()
         return jsonify({"error": "Error al actualizar dispositivo", "detalle": str(e)}), 500
 
 @bp.route('/dispositivos/<int:id>', methods=['GET'])
 @jwt_required(optional=True)
 def obtener_dispositivo(id):
     try:
-        dispositivo = Dispositivo.query.get_or_404(id)
+        dispositivo = _dispositivo_or_404(id)
         return jsonify(_disp_payload(dispositivo))
     except Exception as e:
         return jsonify({"error": "Error al obtener dispositivo", "detalle": str(e)}), 500
 
 
+@bp.route('/dispositivos/<int:id>', methods=['DELETE'])
+@jwt_required()
+def eliminar_dispositivo(id):
+    """
+    Elimina un dispositivo: lo marca al momento (deja de listarse y su serial
+    queda libre) y su histórico se purga por lotes en segundo plano (app/purge.py).
+    """
+    try:
+        res = purge.tombstone(id)
+        if res is None:
+            return jsonify({"error": "Recurso no encontrado"}), 404
+        sse_publish({"event": "device_deleted", "data": res}, room=res["habitacion_id"])
+        return jsonify({"mensaje": "Dispositivo eliminado; historial en purga", **res}), 202
+    except Exception as e:
+        return jsonify({"error": "Error al eliminar dispositivo", "detalle": str(e)}), 500
+
+
 @bp.route('/dispositivos', methods=['GET'])
 @jwt_required(optional=True)
 def obtener_todos():
     try:
-        q = Dispositivo.query
+        q = Dispositivo.query.filter(Dispositivo.eliminado_at.is_(None))
 
         # Filtros opcionales:
         estado = request.args.get('estado')
@@ -476,30 +520,250 @@ def obtener_todos():
 @bp.route('/dispositivos/<int:id>/logs', methods=['GET'])
 @jwt_required(optional=True)
 def obtener_logs(id):
+    """
+    Historial de estados (más reciente primero).
+    - Por defecto: paginación por OFFSET (page=1, per_page=50, máx. 200) con total.
+    - Con `cursor`, `limit`, `from` o `to` (y sin `page`): cursor por
+      (timestamp, id); coste constante en páginas profundas.
+      Query: limit (o per_page, máx. 200), from/to ISO-8601, cursor (= `next`
+      de la respuesta anterior), total=true para incluir el conteo (opcional).
+      Respuesta: {"limit", "data", "next"} (+ "total")
+    """
+    if request.args.get('page') is None and any(k in request.args for k in ('cursor', 'limit', 'from', 'to')):
+        return _obtener_logs_cursor(id)
     try:
         page = int(request.args.get('page', 1))
         per_page = min(int(request.args.get('per_page', 50)), 200)
 
         q = EstadoLog.query.filter_by(dispositivo_id=id).order_by(EstadoLog.timestamp.desc())
         items = q.paginate(page=page, per_page=per_page, error_out=False)
-
+        data = [
+            {
+                "estado": log.estado,
+                "parametros": log.parametros,
+                "timestamp": log.timestamp.isoformat()
+            } for log in items.items
+        ]
+        _expand_logs(id, data)
+
+        # Páginas que pasan del final de la BD continúan en el archivo (app/archive.py)
+        archived = archive.archived_count("estado", id)
+        if archived and len(data) < per_page:
+            skip = max(0, (page - 1) * per_page - items.total)
+            for r in archive.read_range("estado", id, newest_first=True):
+                if skip:
+                    skip -= 1
+                    continue
+                data.append({
+                    "estado": r.get("estado"),
+                    "parametros": r.get("parametros"),
+                    "timestamp": r["timestamp"].isoformat()
+                })
+                if len(data) >= per_page:
+                    break
+
+        total = items.total + archived
         return jsonify({
             "page": page,
             "per_page": per_page,
-            "total": items.total,
-            "pages": items.pages,
-            "data": [
-                {
-                    "estado": log.estado,
-                    "parametros": log.parametros,
-                    "timestamp": log.timestamp.isoformat()
-                } for log in items.items
-            ]
+            "total": total,
+            "pages": (total + per_page - 1) // per_page,
+            "data": data
         })
     except Exception as e:
         return jsonify({"error": "Error al obtener logs", "detalle": str(e)}), 500
 
 
+def _encode_cursor(ts: datetime, log_id: int, archived: bool) -> str:
+    raw = json.dumps({"t": ts.isoformat(), "i": int(log_id), "a": int(archived)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_cursor(token: str):
+    raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    c = json.loads(raw)
+    return datetime.fromisoformat(c["t"]), int(c["i"]), bool(c.get("a"))
+
+def _log_item(estado, parametros, ts: datetime) -> dict:
+    return {"estado": estado, "parametros": parametros, "timestamp": ts.isoformat()}
+
+def _expand_logs(dev_id: int, data: list) -> list:
+    """Filas delta de EstadoLog -> parametros completos (app/deltas.py), in situ."""
+    items = [{"dispositivo_id": dev_id, "parametros": d["parametros"]} for d in data]
+    deltas.expand_estado(items)
+    for d, it in zip(data, items):
+        d["parametros"] = it["parametros"]
+    return data
+
+def _obtener_logs_cursor(id):
+    try:
+        limit = min(int(request.args.get('limit', request.args.get('per_page', 50))), 200)
+        desde = _parse_iso_utc(request.args.get('from'))
+        hasta = _parse_iso_utc(request.args.get('to'))
+        desde = desde.replace(tzinfo=None) if desde else None   # la BD guarda UTC naive
+        hasta = hasta.replace(tzinfo=None) if hasta else None
+        token = request.args.get('cursor')
+        cur_ts, cur_id, in_archive = _decode_cursor(token) if token else (None, None, False)
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({"error": "Parámetros inválidos", "detalle": str(e)}), 400
+
+    try:
+        data, last = [], None   # last = (ts, id, archivado) de la última fila devuelta
+        if not in_archive:
+            q = EstadoLog.query.with_entities(EstadoLog.id, EstadoLog.estado, EstadoLog.parametros, EstadoLog.timestamp) \
+                .filter(EstadoLog.dispositivo_id == id)
+            if desde is not None:
+                q = q.filter(EstadoLog.timestamp >= desde)
+            if hasta is not None:
+                q = q.filter(EstadoLog.timestamp <= hasta)
+            if cur_ts is not None:
+                # Comparación de fila (timestamp, id) < (t, i): un solo range scan del índice
+                q = q.filter(db.tuple_(EstadoLog.timestamp, EstadoLog.id) < db.tuple_(cur_ts, cur_id))
+            rows = q.order_by(EstadoLog.timestamp.desc(), EstadoLog.id.desc()).limit(limit + 1).all()
+            for log_id, estado, parametros, ts in rows[:limit]:
+                data.append(_log_item(estado, parametros, ts))
+                last = (ts, log_id, False)
+            _expand_logs(id, data)
+            if len(rows) > limit:
+                return jsonify(_logs_page(id, limit, data, last, desde, hasta))
+            # BD agotada: se sigue por el archivo desde el principio de su rango
+            cur_ts, cur_id = None, None
+
+        # Tramo archivado (app/archive.py): más antiguo que lo que queda en la BD
+        until = hasta if cur_ts is None else (min(cur_ts, hasta) if hasta else cur_ts)
+        more = False
+        for r in archive.read_range("estado", id, since=desde, until=until, newest_first=True):
+            if cur_ts is not None and (r["timestamp"], r["id"]) >= (cur_ts, cur_id):
+                continue
+            if len(data) >= limit:
+                more = True
+                break
+            data.append(_log_item(r.get("estado"), r.get("parametros"), r["timestamp"]))
+            last = (r["timestamp"], r["id"], True)
+        return jsonify(_logs_page(id, limit, data, last if more else None, desde, hasta))
+    except Exception as e:
+        return jsonify({"error": "Error al obtener logs", "detalle": str(e)}), 500
+
+def _logs_page(id, limit, data, last, desde, hasta) -> dict:
+    out = {"limit": limit, "data": data, "next": _encode_cursor(*last) if last else None}
+    if _coerce_bool(request.args.get('total')):
+        q = EstadoLog.query.filter(EstadoLog.dispositivo_id == id)
+        if desde is not None:
+            q = q.filter(EstadoLog.timestamp >= desde)
+        if hasta is not None:
+            q = q.filter(EstadoLog.timestamp <= hasta)
+        total = q.order_by(None).count()
+        if desde is None and hasta is None:
+            total += archive.archived_count("estado", id)
+        else:
+            total += sum(1 for _ in archive.read_range("estado", id, since=desde, until=hasta))
+        out["total"] = total
+    return out
+
+
+def _parse_iso_utc(raw: str | None):
+    """ISO-8601 (con o sin zona; sin zona = UTC) -> datetime aware UTC, o None."""
+    if not raw:
+        return None
+    dt = datetime.fromisoformat(raw.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+@bp.route('/dispositivos/<int:id>/series', methods=['GET'])
+@jwt_required(optional=True)
+def obtener_series(id):
+    """
+    Serie de UNA métrica numérica (tabla metric_sample, range scan por índice).
+    Query: metric (sin ella, lista de métricas disponibles), desde/hasta ISO-8601
+    (por defecto últimas `horas`=24), limit (máx. 10000; se devuelven las más recientes).
+    Respuesta: {"metric", "desde", "hasta", "data": [[ts_iso, valor], ...]}
+    """
+    try:
+        metric = request.args.get('metric')
+        if not metric:
+            return jsonify({"dispositivo_id": id, "metrics": metrics.device_metrics(id)})
+        hasta = _parse_iso_utc(request.args.get('hasta')) or datetime.now(timezone.utc)
+        desde = _parse_iso_utc(request.args.get('desde')) or \
+            hasta - timedelta(hours=float(request.args.get('horas', 24)))
+        limit = min(int(request.args.get('limit', 2000)), 10000)
+        serie = metrics.series(id, metric, desde, hasta, limit=limit, newest=True)
+        return jsonify({
+            "dispositivo_id": id,
+            "metric": metric,
+            "desde": desde.isoformat(),
+            "hasta": hasta.isoformat(),
+            "data": [[ts.isoformat() + "Z", v] for ts, v in serie],
+        })
+    except ValueError as e:
+        return jsonify({"error": "Parámetros inválidos", "detalle": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": "Error al obtener serie", "detalle": str(e)}), 500
+
+_ROLLUP_DEFAULT_WINDOW = {"1m": timedelta(hours=6), "1h": timedelta(days=7), "1d": timedelta(days=90)}
+
+@bp.route('/dispositivos/<int:id>/rollups', methods=['GET'])
+@jwt_required(optional=True)
+def obtener_rollups(id):
+    """
+    Agregados por cubeta de UNA métrica (tabla metric_rollup) para gráficas.
+    Query: metric, res=1m|1h|1d (por defecto 1h), desde/hasta ISO-8601
+    (ventana por defecto: 6h / 7d / 90d según res).
+    Respuesta: {"metric", "res", "data": [{"t", "count", "min", "max", "avg", "std"}, ...]}
+    """
+    try:
+        metric = request.args.get('metric')
+        res_name = request.args.get('res', '1h')
+        if not metric or res_name not in rollups.RESOLUTIONS:
+            return jsonify({"error": "Debe indicar metric y res (1m, 1h o 1d)"}), 400
+        hasta = _parse_iso_utc(request.args.get('hasta')) or datetime.now(timezone.utc)
+        desde = _parse_iso_utc(request.args.get('desde')) or hasta - _ROLLUP_DEFAULT_WINDOW[res_name]
+        mid = metrics.metric_id(metric)
+        buckets = rollups.read(id, mid, rollups.RESOLUTIONS[res_name], desde, hasta) if mid is not None else []
+        data = []
+        for b in buckets:
+            st = rollups.stats_of(b)
+            data.append({
+                "t": b.bucket.isoformat() + "Z",
+                "count": st["count"], "min": st["min"], "max": st["max"],
+                "avg": round(st["avg"], 4), "std": round(st["std"], 4),
+            })
+        return jsonify({"dispositivo_id": id, "metric": metric, "res": res_name,
+                        "desde": desde.isoformat(), "hasta": hasta.isoformat(), "data": data})
+    except ValueError as e:
+        return jsonify({"error": "Parámetros inválidos", "detalle": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": "Error al obtener rollups", "detalle": str(e)}), 500
+
+def _reclamar(serial, data, actor):
+    """
+    Intención del escritor para POST /dispositivos/reclamar. Reclamo atómico en UNA sentencia:
+      INSERT ... ON CONFLICT(serial_number) DO UPDATE SET reclamado=1, ...
+      WHERE reclamado IS NOT 1 RETURNING *
+    Dos reclamos simultáneos: solo uno recibe la fila; el otro, None -> 409.
+    """
+    campos = {k: data[k] for k in ("nombre", "tipo", "modelo", "descripcion") if k in data}
+    nuevo = {
+        "serial_number": serial, "nombre": "No definido", "tipo": "generico",
+        "modelo": "desconocido", "descripcion": "", "estado": "desconocido",
+        "parametros": {}, "configuracion": {}, **campos, "reclamado": True,
+    }
+    claimed = upsert_returning(Dispositivo, nuevo, key="serial_number",
+                               update={**campos, "reclamado": True},
+                               where=Dispositivo.reclamado.isnot(True))
+    if not claimed:
+        return None
+    disp = claimed[0]
+
+    # La fila queda bloqueada por el upsert hasta el commit: el merge es seguro
+    if "configuracion" in data:
+        cfg = dict(disp.configuracion or {})
+        cfg.update(data["configuracion"] or {})
+        disp.configuracion = cfg
+
+    # Log de acción: reclaim
+    _log_action(disp.id, "claimed", {"serial_number": disp.serial_number}, actor=actor)
+    return disp
+
 @bp.route('/dispositivos/reclamar', methods=['POST'])
 @jwt_required(optional=True)
 def reclamar_dispositivo():
@@ -509,46 +773,31 @@ def reclamar_dispositivo():
         if not serial:
             return jsonify({"error":"Debe proporcionar serial_number"}), 400
 
-        disp = Dispositivo.query.filter_by(serial_number=serial).first()
-        if not disp:
+        # Sin alta previa por MQTT -> 404 (salvo CLAIM_AUTO_REGISTER). El registro en
+        # memoria evita la consulta; si no lo conoce se confirma en BD (otro proceso).
+        if not current_app.config.get("CLAIM_AUTO_REGISTER", False) and registry.get(serial) is None \
+                and db.session.query(Dispositivo.id).filter_by(serial_number=serial).first() is None:
             return jsonify({"error":"Dispositivo no encontrado. Asegúrese de que haya sido detectado por MQTT"}), 404
 
-        if disp.reclamado:
-            return jsonify({"error":"El dispositivo ya fue reclamado previamente"}), 409
-
-        # Actualiza SOLO si vienen campos
-        if "nombre" in data:       disp.nombre = data["nombre"]
-        if "tipo" in data:         disp.tipo = data["tipo"]
-        if "modelo" in data:       disp.modelo = data["modelo"]
-        if "descripcion" in data:  disp.descripcion = data["descripcion"]
-        if "configuracion" in data:
-            cfg = dict(disp.configuracion or {})
-            cfg.update(data["configuracion"] or {})
-            disp.configuracion = cfg
-
-        disp.reclamado = True
-
-        # Captura primitivos ANTES de commit
-        disp_id = disp.id
-
-        # Log de acción: reclaim
-        _log_action(disp.id, "claimed", {"serial_number": disp.serial_number})
-
         try:
-            db.session.commit() # guarda reclamado y cualquier config inicial
-            #Dispara Rule2
-            now = datetime.now(timezone.utc)
-            dispatch_measure(disp, None, None, ts=now)
+            disp = writer.run(_reclamar, serial, data, _actor_tag())
         except IntegrityError as e:
-            db.session.rollback()
             return jsonify({"error":"Conflicto al reclamar", "detalle": str(e)}), 409
         except SQLAlchemyError as e:
-            db.session.rollback()
             # Reintento blando: vuelve a leer y verifica estado
             disp = Dispositivo.query.filter_by(serial_number=serial).first()
             if disp and disp.reclamado:
                 return jsonify({"mensaje":"Dispositivo reclamado correctamente", "id": disp.id}), 200
             return jsonify({"error":"Error al reclamar dispositivo", "detalle": str(e)}), 500
+        if disp is None:
+            return jsonify({"error":"El dispositivo ya fue reclamado previamente"}), 409
+
+        # Captura primitivos (la instancia es de la sesión del escritor)
+        disp_id = disp.id
+        registry.remember(disp)
+        #Dispara Rule2
+        now = datetime.now(timezone.utc)
+        dispatch_measure(disp, None, None, ts=now)
 
         # ✅ No toques disp aquí (evita refrescos implícitos)
         return jsonify({"mensaje":"Dispositivo reclamado correctamente", "id": disp_id}), 200
@@ -563,7 +812,7 @@ def reclamar_dispositivo():
 @jwt_required(optional=True)
 def obtener_no_reclamados():
     try:
-        dispositivos = Dispositivo.query.filter_by(reclamado=False).order_by(Dispositivo.id.desc()).all()
+        dispositivos = Dispositivo.query.filter_by(reclamado=False, eliminado_at=None).order_by(Dispositivo.id.desc()).all()
         return jsonify([_device_full_payload(d) for d in dispositivos])
     except Exception as e:
         return jsonify({"error": "Error al obtener dispositivos no reclamados", "detalle": str(e)}), 500
@@ -764,47 +1013,122 @@ def meteo_inject():
         _METEO_INJECT["until"] = 0.0
         return jsonify({"ok": True, "mode": "cleared"})
 
+@bp.route('/importar/estados', methods=['POST'])
+@jwt_required()
+def importar_estados():
+    """
+    Importación masiva de histórico a EstadoLog (en segundo plano).
+    - multipart: campo `file` (CSV o JSONL); o cuerpo crudo con ?format=csv|jsonl
+    - query: serial (CSV sin columna de serial), run_rules=true, tz=utc|local,
+             create_missing=false
+    El fichero se copia en bloques a un temporal (nunca entero en memoria).
+    Responde 202 con {job_id}; progreso en GET /importar/estados/<job_id>.
+    """
+    max_bytes = int(current_app.config.get("IMPORT_MAX_UPLOAD_MB", 200)) * 1024 * 1024
+    if request.content_length and request.content_length > max_bytes:
+        return jsonify({"error": "fichero demasiado grande"}), 413
+    fmt = request.args.get("format")
+    if fmt and fmt not in ("csv", "jsonl"):
+        return jsonify({"error": "format debe ser csv o jsonl"}), 400
+
+    f = request.files.get("file")
+    if f is not None:
+        src, filename = f.stream, secure_filename(f.filename or "")
+    else:
+        src, filename = request.stream, ""
+    path = bulk_import.save_upload(src, max_bytes)
+    if path is None:
+        return jsonify({"error": "fichero demasiado grande"}), 413
+    if os.path.getsize(path) == 0:
+        os.remove(path)
+        return jsonify({"error": "fichero vacío"}), 400
+
+    job_id = bulk_import.start_job(
+        current_app._get_current_object(), path, filename,
+        fmt=fmt,
+        serial=request.args.get("serial"),
+        run_rules=_coerce_bool(request.args.get("run_rules")) is True,
+        create_missing=_coerce_bool(request.args.get("create_missing", "true")) is not False,
+        tz=request.args.get("tz", "utc"),
+    )
+    return jsonify({"job_id": job_id, "status": "running"}), 202
+
+@bp.route('/importar/estados/<job_id>', methods=['GET'])
+@jwt_required()
+def importar_estados_estado(job_id):
+    """Estado/progreso de una importación: filas, insertadas, omitidas, filas/s."""
+    j = bulk_import.job(job_id)
+    if j is None:
+        return jsonify({"error": "job no encontrado"}), 404
+    return jsonify(j)
+
+@bp.route('/analytics/reports', methods=['GET'])
+@jwt_required()
+def analytics_reports():
+    """Catálogo de informes de analítica (DuckDB) y sus parámetros."""
+    return jsonify({"available": analytics.available(), "reports": analytics.reports()})
+
+@bp.route('/analytics/query', methods=['GET'])
+@jwt_required()
+def analytics_query():
+    """
+    Ejecuta un informe parametrizado de flota sobre DuckDB (solo lectura).
+    Query: report=<nombre> + sus parámetros (ver GET /analytics/reports).
+    Respuesta: {"report", "params", "columns", "rows": [[...], ...], "ms"}
+    """
+    report = request.args.get("report")
+    if not report:
+        return jsonify({"error": "falta report"}), 400
+    try:
+        return jsonify(analytics.run(report, request.args.to_dict()))
+    except analytics.AnalyticsError as e:
+        return jsonify({"error": str(e)}), e.status
+
+@bp.route('/ingest/stats', methods=['GET'])
+def ingest_stats():
+    """Métricas de la ingesta: escritor (cola, lotes, commit), escritor único de BD y profundidad por carril."""
+    return jsonify({
+        "writer": ingest.stats(),
+        "db_writer": writer.stats(),
+        "purge": purge.stats(),
+        "lanes": ingest_lanes.stats(),
+        "ai_worker": ai_worker_stats(),
+        "registry_size": registry.size(),
+        "archive": archive.stats(),
+        "sqlite": sqlite_maint.stats(),
+        "hot_tier": hot_tier.stats(),
+        "analytics": analytics.stats(),
+        "sse": sse_stats(),
+    })
+
+def _csv_arg(name: str):
+    """?name=a,b -> ["a", "b"] (None si no viene)."""
+    raw = request.args.get(name)
+    if not raw:
+        return None
+    return [x.strip() for x in raw.split(",") if x.strip()] or None
+
 @bp.route('/stream/dispositivos', methods=['GET'])
 def stream_dispositivos():
     """
     SSE para cambios de dispositivos:
-    - JSON compacto (menos bytes)
+    - Frames ya serializados por el broker (una vez por evento, no por cliente)
     - Heartbeat 'ping' cada ~25s para evitar timeouts
+    - Filtros opcionales (los aplica el broker al publicar): serial=A,B
+      habitacion=3,4 reclamado=true|false
     """
-    serial_filter = request.args.get('serial')
-    recl_filter   = request.args.get('reclamado')
+    serials = _csv_arg('serial')
+    try:
+        rooms = [int(x) for x in _csv_arg('habitacion') or ()]
+    except ValueError:
+        return jsonify({"error": "habitacion debe ser un id numérico"}), 400
+    recl_filter = request.args.get('reclamado')
 
     def gen():
-        q = subscribe()
-        try:
-            yield "event: hello\ndata: {}\n\n"
-            last_ping = time.time()
-            while True:
-                try:
-                    evt = q.get(timeout=5)
-
-                    # ⛔️ Excluir eventos de IA
-                    if isinstance(evt, dict) and str(evt.get("event","")).startswith("ai_"):
-                        continue
-
-                    # Filtros opcionales
-                    if serial_filter and evt.get("serial_number") != serial_filter:
-                        continue
-                    if recl_filter in ('true','false') and str(evt.get("reclamado")).lower() != recl_filter:
-                        continue
-
-                    payload = json.dumps(evt, ensure_ascii=False, separators=(',',':'))
-                    # Opcional: usa nombre de evento si viene, o 'device_update' por defecto
-                    evname = evt.get("event") or "device_update"
-                    yield f"event: {evname}\n"
-                    yield f"data: {payload}\n\n"
-
-                except Empty:
-                    if time.time() - last_ping > 25:
-                        yield "event: ping\ndata: {}\n\n"
-                        last_ping = time.time()
-        finally:
-            unsubscribe(q)
+        # Sin eventos de IA (van por /stream/ai)
+        q = subscribe(family="devices", serials=serials, rooms=rooms,
+                      reclamado={"true": True, "false": False}.get(recl_filter))
+        yield from sse_frames(q)
 
     headers = {
         "Content-Type": "text/event-stream; charset=utf-8",
@@ -849,11 +1173,15 @@ def _public_avatar_url(rel_path: str) -> str:
     return f"{base}/static/{rel}"
 
 
-def _get_or_create_profile_extra(u: User) -> UserProfileExtra:
-    """Obtiene o crea UserProfileExtra para el usuario."""
-    extra = UserProfileExtra.query.filter_by(user_id=u.id).first()
+# ---- Intenciones del escritor (usuarios / perfil). El hash de la contraseña
+# se calcula en el hilo de la petición: pbkdf2 no debe frenar al escritor.
+
+def _guardar_perfil_extra(user_id: int, **cambios):
+    """Crea u actualiza UserProfileExtra. Devuelve (extra, avatar_path anterior)."""
+    extra = UserProfileExtra.query.filter_by(user_id=user_id).first()
+    old_avatar = (extra.avatar_path or "") if extra else ""
     if not extra:
-        extra = UserProfileExtra(user_id=u.id, avatar_path="")
+        extra = UserProfileExtra(user_id=user_id, avatar_path="")
         # Si el modelo ya tiene columna 'theme', inicializa en 'dark' (no rompe si no existe)
         try:
             if getattr(extra, "theme", None) is None:
@@ -861,8 +1189,56 @@ def _get_or_create_profile_extra(u: User) -> UserProfileExtra:
         except Exception:
             pass
         db.session.add(extra)
-        db.session.commit()
-    return extra
+    for k, v in cambios.items():
+        # Si la columna no existe aún, setattr no crashea pero no persistirá
+        try:
+            setattr(extra, k, v)
+        except Exception:
+            pass
+    return extra, old_avatar
+
+def _crear_usuario(email: str, nombre: str, password_hash: str) -> User:
+    u = User(email=email, nombre=nombre, password_hash=password_hash)
+    db.session.add(u)
+    db.session.flush()
+    return u
+
+def _actualizar_usuario(user_id: int, **cambios) -> User | None:
+    u = db.session.get(User, user_id)
+    if u is not None:
+        for k, v in cambios.items():
+            setattr(u, k, v)
+    return u
+
+def _nuevo_codigo(user_id: int, purpose: str, code: str, expires) -> int:
+    """Invalida los códigos pendientes del mismo propósito y crea uno nuevo. Devuelve su id."""
+    SecurityCode.query.filter_by(user_id=user_id, purpose=purpose, consumed=False).delete()
+    sc = SecurityCode(user_id=user_id, purpose=purpose, code=code, expires_at=expires)
+    db.session.add(sc)
+    db.session.flush()
+    return sc.id
+
+def _borrar_codigo(sc_id: int) -> None:
+    SecurityCode.query.filter_by(id=sc_id).delete()
+
+def _registro_inicio(email: str, password_hash: str, code: str, expires) -> User:
+    u = _crear_usuario(email, "", password_hash)
+    _nuevo_codigo(u.id, "register_verify", code, expires)
+    return u
+
+def _registro_cancelar(user_id: int) -> None:
+    SecurityCode.query.filter_by(user_id=user_id, purpose="register_verify").delete()
+    User.query.filter_by(id=user_id).delete()
+
+def _consumir_codigo(sc_id: int, user_id: int, password_hash: str, nombre: str = "") -> None:
+    """Marca el código como usado y fija la contraseña nueva (y el nombre, si viene)."""
+    sc = db.session.get(SecurityCode, sc_id)
+    if sc is not None:
+        sc.consumed = True
+    cambios = {"password_hash": password_hash}
+    if nombre:
+        cambios["nombre"] = nombre
+    _actualizar_usuario(user_id, **cambios)
 
 
 def _effective_theme(extra: UserProfileExtra | None) -> str:
@@ -1114,10 +1490,10 @@ def auth_register():
     if User.query.filter_by(email=email).first():
         return jsonify({"error": "Email ya registrado"}), 409
 
-    u = User(email=email, nombre=nombre)
-    u.set_password(password)
-    db.session.add(u)
-    db.session.commit()
+    try:
+        u = writer.run(_crear_usuario, email, nombre, generate_password_hash(password))
+    except IntegrityError:
+        return jsonify({"error": "Email ya registrado"}), 409
 
     token = create_access_token(identity=str(u.id))  # subject como string
     return jsonify({"access_token": token, "user": {"id": u.id, "email": u.email, "nombre": u.nombre}}), 201
@@ -1149,18 +1525,12 @@ def auth_register_start():
         return jsonify({"error": "Email ya registrado"}), 409
 
     tmp_password = secrets.token_hex(16)
-    u = User(email=email, nombre="")
-    u.set_password(tmp_password)
-    db.session.add(u)
-    db.session.commit()
-
-    SecurityCode.query.filter_by(user_id=u.id, purpose="register_verify", consumed=False).delete()
-
     code = _generate_code(6)
     expires = datetime.utcnow() + timedelta(minutes=5)
-    sc = SecurityCode(user_id=u.id, purpose="register_verify", code=code, expires_at=expires)
-    db.session.add(sc)
-    db.session.commit()
+    try:
+        u = writer.run(_registro_inicio, email, generate_password_hash(tmp_password), code, expires)
+    except IntegrityError:
+        return jsonify({"error": "Email ya registrado"}), 409
 
     try:
         _send_password_code_email(u.email, code)
@@ -1168,9 +1538,7 @@ def auth_register_start():
     except Exception as e:
         current_app.logger.error(f"[SMTP] Error enviando email de registro a {u.email}: {e}")
         try:
-            SecurityCode.query.filter_by(user_id=u.id, purpose="register_verify").delete()
-            db.session.delete(u)
-            db.session.commit()
+            writer.run(_registro_cancelar, u.id)
         except Exception:
             pass
         return jsonify({"error": "No se pudo enviar el código por email"}), 500
@@ -1199,11 +1567,7 @@ def auth_register_verify():
     if datetime.utcnow() > sc.expires_at:
         return jsonify({"error": "Código expirado"}), 400
 
-    sc.consumed = True
-    if nombre:
-        u.nombre = nombre
-    u.set_password(password)
-    db.session.commit()
+    writer.run(_consumir_codigo, sc.id, u.id, generate_password_hash(password), nombre)
 
     return jsonify({"ok": True, "message": "Cuenta creada correctamente"})
 
@@ -1220,13 +1584,9 @@ def auth_forgot_start():
     if not u:
         return jsonify({"error": "Email no encontrado"}), 404
 
-    SecurityCode.query.filter_by(user_id=u.id, purpose="forgot_password", consumed=False).delete()
-
     code = _generate_code(6)
     expires = datetime.utcnow() + timedelta(minutes=5)
-    sc = SecurityCode(user_id=u.id, purpose="forgot_password", code=code, expires_at=expires)
-    db.session.add(sc)
-    db.session.commit()
+    sc_id = writer.run(_nuevo_codigo, u.id, "forgot_password", code, expires)
 
     try:
         _send_password_code_email(u.email, code)
@@ -1234,8 +1594,7 @@ def auth_forgot_start():
     except Exception as e:
         current_app.logger.error(f"[SMTP] Error enviando email a {u.email}: {e}")
         try:
-            db.session.delete(sc)
-            db.session.commit()
+            writer.run(_borrar_codigo, sc_id)
         except Exception:
             pass
         return jsonify({"error": "No se pudo enviar el código por email"}), 500
@@ -1263,9 +1622,7 @@ def auth_forgot_verify():
     if datetime.utcnow() > sc.expires_at:
         return jsonify({"error": "Código expirado"}), 400
 
-    sc.consumed = True
-    u.set_password(new_password)
-    db.session.commit()
+    writer.run(_consumir_codigo, sc.id, u.id, generate_password_hash(new_password))
 
     return jsonify({"ok": True, "message": "Contraseña actualizada"})
 
@@ -1293,9 +1650,8 @@ def update_me():
     nombre = (data.get("nombre") or "").strip()
 
     if nombre:
-        u.nombre = nombre
+        u = writer.run(_actualizar_usuario, u.id, nombre=nombre)
 
-    db.session.commit()
     return jsonify(_user_profile_payload(u))
 
 # --------- Avatar ---------
@@ -1326,27 +1682,15 @@ def upload_avatar():
 
     file.save(abs_path)
 
-    extra = UserProfileExtra.query.filter_by(user_id=u.id).first()
-    if not extra:
-        extra = UserProfileExtra(user_id=u.id, avatar_path=rel_path.replace("\\", "/"))
-        # inicializar tema si existe columna
-        try:
-            if getattr(extra, "theme", None) is None:
-                setattr(extra, "theme", "dark")
-        except Exception:
-            pass
-        db.session.add(extra)
-    else:
-        try:
-            if extra.avatar_path:
-                old_abs = os.path.join(static_folder, extra.avatar_path)
-                if os.path.isfile(old_abs):
-                    os.remove(old_abs)
-        except Exception:
-            pass
-        extra.avatar_path = rel_path.replace("\\", "/")
-
-    db.session.commit()
+    extra, old_avatar = writer.run(_guardar_perfil_extra, u.id, avatar_path=rel_path.replace("\\", "/"))
+    # El fichero anterior se borra ya comiteado el nuevo
+    try:
+        if old_avatar and old_avatar != extra.avatar_path:
+            old_abs = os.path.join(static_folder, old_avatar)
+            if os.path.isfile(old_abs):
+                os.remove(old_abs)
+    except Exception:
+        pass
 
     return jsonify({
         "avatarUrl": _public_avatar_url(extra.avatar_path),
@@ -1366,22 +1710,14 @@ def delete_avatar():
         return jsonify({"error": "No autenticado"}), 401
 
     static_folder = current_app.static_folder or "static"
-    extra = UserProfileExtra.query.filter_by(user_id=u.id).first()
-
-    if extra:
-        try:
-            if extra.avatar_path:
-                abs_path = os.path.join(static_folder, extra.avatar_path)
-                if os.path.isfile(abs_path):
-                    os.remove(abs_path)
-        except Exception:
-            pass
-        extra.avatar_path = ""
-        db.session.commit()
-    else:
-        extra = UserProfileExtra(user_id=u.id, avatar_path="")
-        db.session.add(extra)
-        db.session.commit()
+    _, old_avatar = writer.run(_guardar_perfil_extra, u.id, avatar_path="")
+    try:
+        if old_avatar:
+            abs_path = os.path.join(static_folder, old_avatar)
+            if os.path.isfile(abs_path):
+                os.remove(abs_path)
+    except Exception:
+        pass
 
     return jsonify(_user_profile_payload(u))
 
@@ -1411,19 +1747,10 @@ def set_my_theme():
     if theme not in ("light", "dark"):
         return jsonify({"error": "Valor de theme inválido (usa 'light' o 'dark')"}), 400
 
-    extra = _get_or_create_profile_extra(u)
-
-    # Si la columna no existe aún, setattr no crashea pero no persistirá:
-    try:
-        setattr(extra, "theme", theme)
-    except Exception:
-        pass
-
     try:
-        db.session.commit()
+        writer.run(_guardar_perfil_extra, u.id, theme=theme)
     except Exception as e:
         current_app.logger.error(f"[theme] Error guardando tema: {e}")
-        db.session.rollback()
         return jsonify({"error": "No se pudo guardar el tema"}), 500
 
     return jsonify({"ok": True, "theme": theme})
@@ -1448,13 +1775,9 @@ def start_change_password():
     if not u:
         return jsonify({"error": "No autenticado"}), 401
 
-    SecurityCode.query.filter_by(user_id=u.id, purpose="change_password", consumed=False).delete()
-
     code = _generate_code(6)
     expires = datetime.utcnow() + timedelta(minutes=5)
-    sc = SecurityCode(user_id=u.id, purpose="change_password", code=code, expires_at=expires)
-    db.session.add(sc)
-    db.session.commit()
+    sc_id = writer.run(_nuevo_codigo, u.id, "change_password", code, expires)
 
     try:
         _send_password_code_email(u.email, code)
@@ -1462,8 +1785,7 @@ def start_change_password():
     except Exception as e:
         current_app.logger.error(f"[SMTP] Error enviando email a {u.email}: {e}")
         try:
-            db.session.delete(sc)
-            db.session.commit()
+            writer.run(_borrar_codigo, sc_id)
         except Exception:
             pass
         return jsonify({"error": "No se pudo enviar el código por email"}), 500
@@ -1492,9 +1814,7 @@ def verify_change_password():
     if datetime.utcnow() > sc.expires_at:
         return jsonify({"error": "Código expirado"}), 400
 
-    sc.consumed = True
-    u.set_password(new_password)
-    db.session.commit()
+    writer.run(_consumir_codigo, sc.id, u.id, generate_password_hash(new_password))
 
     return jsonify({"ok": True, "message": "Contraseña actualizada"})
 
@@ -1520,8 +1840,10 @@ def change_email():
     if exists:
         return jsonify({"error": "Email ya en uso"}), 409
 
-    u.email = new_email
-    db.session.commit()
+    try:
+        writer.run(_actualizar_usuario, u.id, email=new_email)
+    except IntegrityError:
+        return jsonify({"error": "Email ya en uso"}), 409
 
     return jsonify({"ok": True, "message": "Email actualizado"})
 
@@ -1552,41 +1874,74 @@ def crear_habitacion():
     except (TypeError, ValueError):
         return jsonify({"error": "Token inválido"}), 401
 
+    room = writer.run(_crear_habitacion, nombre, icon, user_id)
+    return jsonify(_room_to_dict(room)), 201
+
+# ---- Intenciones del escritor (habitaciones). Los dispositivos se modifican en
+# la sesión del escritor: la caché de la ingesta ve el habitacion_id nuevo.
+
+def _crear_habitacion(nombre: str, icon: str, user_id):
     room = Habitacion(nombre=nombre, user_id=user_id)
     _set_room_icon_if_present(room, icon)
-
     db.session.add(room)
-    db.session.commit()
+    db.session.flush()   # id asignado antes del commit del lote
+    return room
 
-    return jsonify(_room_to_dict(room)), 201
+def _borrar_habitacion(hid: int):
+    """Devuelve los dispositivos que quedaron sin habitación (None si no existe)."""
+    room = db.session.get(Habitacion, hid)
+    if room is None:
+        return None
+    devs = Dispositivo.query.filter_by(habitacion_id=hid).all()
+    for d in devs:
+        _dev_set_habitacion_id(d, None)
+    db.session.delete(room)
+    return devs
 
+def _actualizar_habitacion(hid: int, nombre, icon):
+    room = db.session.get(Habitacion, hid)
+    if room is None:
+        return None
+    if nombre:
+        room.nombre = nombre
+    if icon:
+        _set_room_icon_if_present(room, icon)
+    return room
+
+def _mover_dispositivo(dev_id: int, hid: int | None, evento: str, detalle: dict, actor: str):
+    """Asigna (hid) o quita (None) la habitación: (dispositivo, habitación anterior) o None."""
+    dev = db.session.get(Dispositivo, dev_id)
+    if dev is None or dev.eliminado_at is not None:
+        return None
+    from_room = _dev_get_habitacion_id(dev)
+    _dev_set_habitacion_id(dev, hid)
+    _log_action(dev.id, evento, detalle, actor=actor)
+    return dev, from_room
 
 @bp.route("/habitaciones/<int:hid>", methods=["DELETE"])
 @jwt_required()
 def borrar_habitacion(hid):
-    room = Habitacion.query.get_or_404(hid)
-    Dispositivo.query.filter_by(habitacion_id=room.id).update({"habitacion_id": None})
-    db.session.delete(room)
-    db.session.commit()
-    sse_publish({"event": "room_deleted", "data": {"id": hid}})
+    devs = writer.run(_borrar_habitacion, hid)
+    if devs is None:
+        abort(404)
+    for d in devs:
+        registry.remember(d)
+    sse_publish({"event": "room_deleted", "data": {"id": hid}}, room=hid)
     return jsonify({"ok": True})
 
 
 # ---- Variantes de actualización de habitación
 
 def _actualizar_habitacion_core(hid: int, data: dict):
-    room = Habitacion.query.get_or_404(hid)
-
     nombre = data.get("nombre") or data.get("name")
-    if isinstance(nombre, str) and nombre.strip():
-        room.nombre = nombre.strip()
-
+    nombre = nombre.strip() if isinstance(nombre, str) else None
     icon = data.get("icon") or data.get("icono") or data.get("icon_name")
-    if isinstance(icon, str) and icon.strip():
-        _set_room_icon_if_present(room, icon.strip())
+    icon = icon.strip() if isinstance(icon, str) else None
 
-    db.session.commit()
-    sse_publish({"event": "room_updated", "data": _room_to_dict(room)})
+    room = writer.run(_actualizar_habitacion, hid, nombre, icon)
+    if room is None:
+        abort(404)
+    sse_publish({"event": "room_updated", "data": _room_to_dict(room)}, room=room.id)
     return jsonify(_room_to_dict(room))
 
 
@@ -1644,16 +1999,16 @@ def agregar_dispositivo_a_habitacion(hid):
         return jsonify({"error": "dispositivo_id es obligatorio"}), 400
 
     room = Habitacion.query.get_or_404(hid)
-    dev = Dispositivo.query.get_or_404(int(device_id))
-
-    _dev_set_habitacion_id(dev, room.id)
-
-    # Log de acción
-    _log_action(dev.id, "assigned_to_room", {"habitacion_id": room.id, "habitacion": room.nombre})
-
-    db.session.commit()
-
-    sse_publish({"event": "device_moved", "data": {"device_id": _dev_get_id(dev), "to_room": room.id}})
+    res = writer.run(_mover_dispositivo, int(device_id), room.id, "assigned_to_room",
+                     {"habitacion_id": room.id, "habitacion": room.nombre}, _actor_tag())
+    if res is None:
+        abort(404)
+    dev, from_room = res
+    registry.remember(dev)   # el escritor refresca su copia antes de la próxima ingesta
+
+    sse_publish({"event": "device_moved", "data": {"device_id": _dev_get_id(dev), "serial_number": dev.serial_number,
+                                                   "to_room": room.id}},
+                room=(from_room, room.id))
     return jsonify({"ok": True})
 
 
@@ -1666,16 +2021,15 @@ def quitar_dispositivo_de_habitacion(hid):
         return jsonify({"error": "dispositivo_id es obligatorio"}), 400
 
     Habitacion.query.get_or_404(hid)
-    dev = Dispositivo.query.get_or_404(int(device_id))
-
-    _dev_set_habitacion_id(dev, None)
-
-    # Log de acción
-    _log_action(dev.id, "removed_from_room", {"habitacion_id": hid})
-
-    db.session.commit()
-
-    sse_publish({"event": "device_moved", "data": {"device_id": _dev_get_id(dev), "to_room": None}})
+    res = writer.run(_mover_dispositivo, int(device_id), None, "removed_from_room",
+                     {"habitacion_id": hid}, _actor_tag())
+    if res is None:
+        abort(404)
+    dev, _ = res
+    registry.remember(dev)
+
+    sse_publish({"event": "device_moved", "data": {"device_id": _dev_get_id(dev), "serial_number": dev.serial_number,
+                                                   "to_room": None}}, room=hid)
     return jsonify({"ok": True})
 
 # =========================================================
@@ -1683,15 +2037,15 @@ def quitar_dispositivo_de_habitacion(hid):
 # =========================================================
 
 def _query_all_devices():
-    return Dispositivo.query.order_by(Dispositivo.id.desc()).all()
+    return Dispositivo.query.filter_by(eliminado_at=None).order_by(Dispositivo.id.desc()).all()
 
 
 def _query_unclaimed_devices():
     """Devuelve Query si hay columna (reclamado/claimed); si no, filtra en memoria."""
     if hasattr(Dispositivo, "reclamado"):
-        return Dispositivo.query.filter_by(reclamado=False).order_by(Dispositivo.id.desc()).all()
+        return Dispositivo.query.filter_by(reclamado=False, eliminado_at=None).order_by(Dispositivo.id.desc()).all()
     if hasattr(Dispositivo, "claimed"):
-        return Dispositivo.query.filter_by(claimed=False).order_by(Dispositivo.id.desc()).all()
+        return Dispositivo.query.filter_by(claimed=False, eliminado_at=None).order_by(Dispositivo.id.desc()).all()
     return [d for d in _query_all_devices() if not _dev_get_reclamado(d)]
 
 # =========================================================
@@ -1757,21 +2111,44 @@ def _build_device_excel(dispositivo: Dispositivo) -> bytes:
     # Estados
     estados = EstadoLog.query.filter_by(dispositivo_id=dispositivo.id).order_by(EstadoLog.timestamp.asc()).all()
 
+    # Filas delta -> vista completa (app/deltas.py)
+    acciones = deltas.expand_accion([
+        {"dispositivo_id": a.dispositivo_id, "evento": a.evento, "detalle": a.detalle, "timestamp": a.timestamp}
+        for a in acciones])
+    estados = deltas.expand_estado([
+        {"dispositivo_id": e.dispositivo_id, "estado": e.estado, "parametros": e.parametros, "timestamp": e.timestamp}
+        for e in estados])
+
     ws2.append(["Fecha/Hora (UTC)", "Tipo", "Evento/Estado", "Detalle"])
     rows = []
     for a in acciones:
         rows.append((
-            a.timestamp.isoformat() + "Z",
+            a["timestamp"].isoformat() + "Z",
             "Acción",
-            a.evento,
-            json.dumps(a.detalle or {}, ensure_ascii=False)
+            a["evento"],
+            json.dumps(a["detalle"] or {}, ensure_ascii=False)
         ))
     for e in estados:
         rows.append((
-            e.timestamp.isoformat() + "Z",
+            e["timestamp"].isoformat() + "Z",
             "Estado",
-            e.estado or "",
-            json.dumps(e.parametros or {}, ensure_ascii=False)
+            e["estado"] or "",
+            json.dumps(e["parametros"] or {}, ensure_ascii=False)
+        ))
+    # Histórico ya movido a segmentos comprimidos (retención)
+    for a in archive.read_range("accion", dispositivo.id):
+        rows.append((
+            a["timestamp"].isoformat() + "Z",
+            "Acción",
+            a.get("evento") or "",
+            json.dumps(a.get("detalle") or {}, ensure_ascii=False)
+        ))
+    for e in archive.read_range("estado", dispositivo.id):
+        rows.append((
+            e["timestamp"].isoformat() + "Z",
+            "Estado",
+            e.get("estado") or "",
+            json.dumps(e.get("parametros") or {}, ensure_ascii=False)
         ))
     # Ordenar por fecha/hora por si acaso
     rows.sort(key=lambda r: r[0])
@@ -1779,6 +2156,19 @@ def _build_device_excel(dispositivo: Dispositivo) -> bytes:
         ws2.append(list(r))
     _auto_fit(ws2)
 
+    # --- Hoja 3: Métricas (metric_sample, una columna por métrica) ---
+    nombres = metrics.device_metrics(dispositivo.id)
+    if nombres:
+        ws3 = wb.create_sheet("Métricas")
+        ws3.append(["Fecha/Hora (UTC)"] + nombres)
+        por_ts: dict = {}
+        for col, nombre in enumerate(nombres):
+            for ts, v in metrics.series(dispositivo.id, nombre, limit=None):
+                por_ts.setdefault(ts, [None] * len(nombres))[col] = v
+        for ts in sorted(por_ts):
+            ws3.append([ts.isoformat() + "Z"] + por_ts[ts])
+        _auto_fit(ws3)
+
     # Serializar a bytes
     bio = io.BytesIO()
     wb.save(bio)
@@ -1798,7 +2188,7 @@ def exportar_dispositivo_excel(id: int):
       • /dispositivos/<id>/export_excel     (la que usa el Android)
     """
     try:
-        dispositivo = Dispositivo.query.get_or_404(id)
+        dispositivo = _dispositivo_or_404(id)
         data = _build_device_excel(dispositivo)
         filename = f"dispositivo_{dispositivo.id}_{dispositivo.serial_number}.xlsx"
         return send_file(
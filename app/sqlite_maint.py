@@ -0,0 +1,171 @@
+# app/sqlite_maint.py
+"""
+Mantenimiento periódico de las BD SQLite (principal y, si está aparte,
+telemetría): checkpoints del WAL según su tamaño y `incremental_vacuum` en
+ventanas de inactividad.
+
+Cada SQLITE_MAINT_INTERVAL_S segundos, por fichero:
+  - WAL >= SQLITE_CHECKPOINT_PASSIVE_BYTES  -> `wal_checkpoint(PASSIVE)`
+    (copia lo que pueda sin bloquear a nadie);
+  - WAL >= SQLITE_CHECKPOINT_TRUNCATE_BYTES y el escritor único lleva
+    SQLITE_IDLE_S sin trabajo (o el WAL pasa de SQLITE_WAL_HARD_LIMIT_BYTES)
+    -> `wal_checkpoint(TRUNCATE)`, que deja el -wal a 0 bytes;
+  - escritor inactivo, `auto_vacuum=INCREMENTAL` y más de
+    SQLITE_VACUUM_MIN_FREE_PAGES páginas libres -> `incremental_vacuum`
+    de hasta SQLITE_VACUUM_PAGES páginas (devuelve espacio al disco).
+
+El `wal_autocheckpoint` de SQLite sigue activo como red de seguridad. Los
+PRAGMA por conexión (mmap_size, cache_size, temp_store...) los aplica
+`app.db.init_sqlite_pragmas`. Las BD creadas antes de `auto_vacuum` necesitan
+un VACUUM completo una vez (`maintenance.py vacuum`).
+"""
+from __future__ import annotations
+import os, threading, time
+from typing import Any, Dict, Optional
+
+from flask import Flask
+
+from app import writer
+from app.db import db, distinct_engines
+
+_thread: Optional[threading.Thread] = None
+_stop = threading.Event()
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, Any]] = {}   # fichero -> métricas
+
+def init(app: Flask) -> None:
+    """Arranca el hilo de mantenimiento si hay BD SQLite en fichero (idempotente)."""
+    global _thread
+    if _thread is not None or not app.config.get("SQLITE_MAINT_ENABLED", True):
+        return
+    with app.app_context():
+        if not _targets():
+            return
+    _thread = threading.Thread(target=_loop, args=(app,), name="SQLiteMaint", daemon=True)
+    _thread.start()
+    print(f"[SQLITE] mantenimiento activo (cada {app.config.get('SQLITE_MAINT_INTERVAL_S', 5)}s)")
+
+def stop() -> None:
+    _stop.set()
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        return {k: dict(v) for k, v in _stats.items()}
+
+def _targets() -> Dict[str, Any]:
+    """fichero -> engine de escritura, solo SQLite en fichero."""
+    out = {}
+    for eng in distinct_engines().values():
+        if eng.dialect.name == "sqlite" and eng.url.database not in (None, "", ":memory:"):
+            out[eng.url.database] = eng
+    return out
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def _entry(path: str) -> Dict[str, Any]:
+    return _stats.setdefault(path, {
+        "wal_bytes": 0, "db_bytes": 0, "free_pages": 0, "auto_vacuum": None,
+        "checkpoints_passive": 0, "checkpoints_truncate": 0, "checkpoint_busy": 0,
+        "last_checkpoint_ms": 0.0, "max_checkpoint_ms": 0.0,
+        "vacuumed_pages": 0, "last_vacuum_ms": 0.0, "errors": 0,
+    })
+
+# =========================
+# Operaciones
+# =========================
+def checkpoint(engine, mode: str = "PASSIVE") -> Dict[str, Any]:
+    """`PRAGMA wal_checkpoint(mode)`: {busy, log, checkpointed, ms}."""
+    t0 = time.perf_counter()
+    with engine.connect() as conn:
+        busy, log, done = conn.exec_driver_sql(f"PRAGMA wal_checkpoint({mode})").one()
+    return {"busy": busy, "log": log, "checkpointed": done, "ms": (time.perf_counter() - t0) * 1000.0}
+
+def incremental_vacuum(engine, pages: int) -> int:
+    """Libera hasta `pages` páginas del freelist. Devuelve cuántas se liberaron."""
+    with engine.begin() as conn:
+        before = conn.exec_driver_sql("PRAGMA freelist_count").scalar() or 0
+        # pysqlite da UN solo paso a una sentencia sin columnas y cada paso de
+        # incremental_vacuum libera una página: se repite hasta N (o el freelist)
+        for _ in range(min(int(pages), before)):
+            conn.exec_driver_sql("PRAGMA incremental_vacuum")
+        after = conn.exec_driver_sql("PRAGMA freelist_count").scalar() or 0
+    return before - after
+
+def full_vacuum() -> Dict[str, Any]:
+    """
+    VACUUM completo de cada BD SQLite (con el backend parado). Aplica el
+    `auto_vacuum` configurado a ficheros creados sin él. Requiere app context.
+    """
+    from flask import current_app
+    out = {}
+    for path, eng in _targets().items():
+        key = "SQLITE_PRAGMAS" if eng is db.engines[None] else "TELEMETRY_SQLITE_PRAGMAS"
+        mode = (current_app.config.get(key) or {}).get("auto_vacuum")
+        before = _size(path)
+        t0 = time.perf_counter()
+        with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            if mode is not None:
+                conn.exec_driver_sql(f"PRAGMA auto_vacuum={mode}")
+            conn.exec_driver_sql("VACUUM")
+            # En WAL el fichero no encoge hasta el checkpoint
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            av = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+        out[path] = {"bytes_before": before, "bytes_after": _size(path), "auto_vacuum": av,
+                     "seconds": round(time.perf_counter() - t0, 3)}
+    return out
+
+def run_once(app: Flask) -> None:
+    cfg = app.config
+    passive = int(cfg.get("SQLITE_CHECKPOINT_PASSIVE_BYTES", 16 * 1024 * 1024))
+    truncate = int(cfg.get("SQLITE_CHECKPOINT_TRUNCATE_BYTES", 64 * 1024 * 1024))
+    hard = int(cfg.get("SQLITE_WAL_HARD_LIMIT_BYTES", 256 * 1024 * 1024))
+    idle = writer.idle_s() >= float(cfg.get("SQLITE_IDLE_S", 2.0))
+    for path, eng in _targets().items():
+        wal = _size(path + "-wal")
+        mode = None
+        if wal >= hard or (wal >= truncate and idle):
+            mode = "TRUNCATE"
+        elif wal >= passive:
+            mode = "PASSIVE"
+        try:
+            if mode:
+                r = checkpoint(eng, mode)
+                with _stats_lock:
+                    e = _entry(path)
+                    e["checkpoints_" + mode.lower()] += 1
+                    e["checkpoint_busy"] += int(bool(r["busy"]))
+                    e["last_checkpoint_ms"] = round(r["ms"], 2)
+                    e["max_checkpoint_ms"] = max(e["max_checkpoint_ms"], round(r["ms"], 2))
+                if r["ms"] > 1000:
+                    print(f"[SQLITE] checkpoint {mode} {os.path.basename(path)} "
+                          f"wal={wal // 1024}KB en {r['ms']:.0f}ms (busy={r['busy']})")
+            with eng.connect() as conn:
+                free = conn.exec_driver_sql("PRAGMA freelist_count").scalar() or 0
+                av = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+            freed, vac_ms = 0, None
+            if idle and av == 2 and free >= int(cfg.get("SQLITE_VACUUM_MIN_FREE_PAGES", 1024)):
+                t0 = time.perf_counter()
+                freed = incremental_vacuum(eng, int(cfg.get("SQLITE_VACUUM_PAGES", 2000)))
+                vac_ms = (time.perf_counter() - t0) * 1000.0
+                free -= freed
+            with _stats_lock:
+                e = _entry(path)
+                e.update(wal_bytes=_size(path + "-wal"), db_bytes=_size(path), free_pages=free,
+                         auto_vacuum={0: "NONE", 1: "FULL", 2: "INCREMENTAL"}.get(av, av))
+                e["vacuumed_pages"] += freed
+                if vac_ms is not None:
+                    e["last_vacuum_ms"] = round(vac_ms, 2)
+        except Exception as ex:
+            with _stats_lock:
+                _entry(path)["errors"] += 1
+            print(f"[SQLITE] mantenimiento {os.path.basename(path)}: {ex}")
+
+def _loop(app: Flask) -> None:
+    interval = float(app.config.get("SQLITE_MAINT_INTERVAL_S", 5))
+    with app.app_context():
+        while not _stop.wait(interval):
+            run_once(app)
@@ -1,50 +1,150 @@
 # app/sse.py
-import json
-from queue import Queue, Full
+"""
+Broker SSE en memoria con suscripciones filtradas.
+
+Cada suscripción declara sus filtros al crearse:
+  - family     "devices" | "ai" | None (todos): familia del evento (`ai_*` -> "ai")
+  - serials    conjunto de serial_number (top-level o en `data`)
+  - rooms      conjunto de habitacion_id (el publicador indica `room=`)
+  - reclamado  True / False
+
+`publish` no recorre todas las colas: cada suscripción se indexa por su
+dimensión más selectiva (serial > habitación > familia) y solo se comprueban
+los candidatos de los índices que tocan al evento. Un cliente móvil que mira
+un dispositivo ya no se despierta con los eventos de los demás.
+
+Un evento sin serial (o sin habitación) solo llega a quien no filtra por esa
+dimensión. Las colas llenas (cliente lento) se dan de baja.
+
+Cada evento se serializa UNA vez (orjson si está instalado) a un frame
+`event:/data:` en bytes, fuera del lock y solo si alguien lo va a recibir; las
+colas comparten ese mismo buffer inmutable y los generadores (`frames`) lo
+escriben tal cual. Nada de print por publicación: contadores en `stats()`.
+"""
+import json, time
+from queue import Empty, Full, Queue
 from threading import Lock
-from typing import Dict, Any
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+try:
+    import orjson
+except Exception:   # dependencia opcional
+    orjson = None
 
 _SUB_CAPACITY = 200  # un poco más holgado que 100
-_subs = set()
 _lock = Lock()
+_subs: Dict[Queue, "_Sub"] = {}
+_by_serial: Dict[str, Set[Queue]] = {}
+_by_room: Dict[int, Set[Queue]] = {}
+_by_family: Dict[Optional[str], Set[Queue]] = {}   # None = sin filtro de familia
+_stats: Dict[str, int] = {"published": 0, "unrouted": 0, "delivered": 0, "encoded_bytes": 0,
+                          "encode_fallbacks": 0, "dropped_slow": 0, "subscribed": 0, "unsubscribed": 0}
+
+HELLO = b"event: hello\ndata: {}\n\n"
+PING = b"event: ping\ndata: {}\n\n"
+_MAX_STR = 2000   # recorte de campos de texto enormes
+
+class _Sub:
+    __slots__ = ("family", "serials", "rooms", "reclamado")
+
+    def __init__(self, family, serials, rooms, reclamado):
+        self.family = family
+        self.serials = serials
+        self.rooms = rooms
+        self.reclamado = reclamado
+
+    def matches(self, family: str, serial: Optional[str], rooms: Set[int], evt: Dict[str, Any]) -> bool:
+        if self.family is not None and self.family != family:
+            return False
+        if self.serials is not None and serial not in self.serials:
+            return False
+        if self.rooms is not None and not (rooms & self.rooms):
+            return False
+        if self.reclamado is not None and str(evt.get("reclamado")).lower() != ("true" if self.reclamado else "false"):
+            return False
+        return True
+
+def _index(q: Queue, s: _Sub) -> List[Set[Queue]]:
+    """Buckets en los que vive la suscripción (solo en su dimensión más selectiva)."""
+    if s.serials is not None:
+        return [_by_serial.setdefault(x, set()) for x in s.serials]
+    if s.rooms is not None:
+        return [_by_room.setdefault(x, set()) for x in s.rooms]
+    return [_by_family.setdefault(s.family, set())]
 
-def subscribe() -> Queue:
+def _drop(q: Queue) -> None:
+    s = _subs.pop(q, None)
+    if s is None:
+        return
+    for idx, keys in ((_by_serial, s.serials), (_by_room, s.rooms)):
+        for k in keys or ():
+            b = idx.get(k)
+            if b is not None:
+                b.discard(q)
+                if not b:
+                    del idx[k]
+    b = _by_family.get(s.family)
+    if b is not None:
+        b.discard(q)
+
+def subscribe(family: Optional[str] = None, serials: Optional[Iterable[str]] = None,
+              rooms: Optional[Iterable[int]] = None, reclamado: Optional[bool] = None) -> Queue:
+    """Cola de frames (bytes) con los eventos que pasan los filtros."""
     q = Queue(maxsize=_SUB_CAPACITY)
+    s = _Sub(family,
+             set(serials) if serials else None,
+             {int(r) for r in rooms} if rooms else None,
+             reclamado)
     with _lock:
-        _subs.add(q)
-        try:
-            print(f"[SSE] +subscribe -> subs={len(_subs)}")
-        except Exception:
-            pass
+        _subs[q] = s
+        for b in _index(q, s):
+            b.add(q)
+        _stats["subscribed"] += 1
     return q
 
 def unsubscribe(q: Queue) -> None:
     with _lock:
-        _subs.discard(q)
+        if q in _subs:
+            _stats["unsubscribed"] += 1
+        _drop(q)
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        out = dict(_stats)
+        out["subscribers"] = len(_subs)
+    out["encoder"] = "orjson" if orjson is not None else "json"
+    return out
+
+def _serial_of(evt: Dict[str, Any]) -> Optional[str]:
+    serial = evt.get("serial_number")
+    if serial is None and isinstance(evt.get("data"), dict):
+        serial = evt["data"].get("serial_number")
+    return serial
+
+def _encode(evt: Dict[str, Any]) -> bytes:
+    """JSON compacto UTF-8; lo no serializable pasa a str (como hacía _safe_payload)."""
+    for k, v in evt.items():
+        if isinstance(v, str) and len(v) > _MAX_STR:
+            evt = dict(evt)
+            evt[k] = v[:_MAX_STR] + "…"
+    if orjson is not None:
         try:
-            print(f"[SSE] -unsubscribe -> subs={len(_subs)}")
+            return orjson.dumps(evt, default=str, option=orjson.OPT_NON_STR_KEYS)
         except Exception:
-            pass
+            with _lock:
+                _stats["encode_fallbacks"] += 1   # p.ej. enteros de más de 64 bits
+    return json.dumps(evt, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+def frame(evt: Dict[str, Any]) -> bytes:
+    """Frame SSE listo para escribir: `event: <nombre>` + `data: <json>`."""
+    name = str(evt.get("event") or "device_update")
+    return b"event: " + name.encode("utf-8") + b"\ndata: " + _encode(evt) + b"\n\n"
 
-def _safe_payload(evt: Dict[str, Any]) -> Dict[str, Any]:
+def publish(event: Dict[str, Any], room=None) -> None:
     """
-    Devuelve una copia 'segura' para logging / SSE:
-    - Convierte objetos no-serializables a str
-    - Limita tamaño de campos muy grandes
+    Entrega `event` a las suscripciones que lo aceptan. `room`: habitacion_id
+    (o varias, p.ej. origen y destino de un device_moved) para los filtros por habitación.
     """
-    out: Dict[str, Any] = {}
-    for k, v in (evt or {}).items():
-        try:
-            json.dumps({k: v})
-            out[k] = v
-        except Exception:
-            out[k] = str(v)
-        # recorte opcional de mensajes enormes
-        if isinstance(out[k], str) and len(out[k]) > 2000:
-            out[k] = out[k][:2000] + "…"
-    return out
-
-def publish(event: Dict[str, Any]) -> None:
     if not isinstance(event, dict):
         try:
             print(f"[SSE] WARN publish non-dict: {type(event)} -> {event}")
@@ -52,27 +152,68 @@ def publish(event: Dict[str, Any]) -> None:
             pass
         return
 
-    evt = _safe_payload(event)
-    name = str(evt.get("event", "unknown"))
-    dead = []
+    name = str(event.get("event", "unknown"))
+    family = "ai" if name.startswith("ai_") else "devices"
+    serial = _serial_of(event)
+    if room is None:
+        rooms: Set[int] = set()
+    elif isinstance(room, (list, tuple, set)):
+        rooms = {int(r) for r in room if r is not None}
+    else:
+        rooms = {int(room)}
 
     with _lock:
-        # Log básico de publicación (una vez por publish)
-        try:
-            print(f"[SSE] publish event={name} to {len(_subs)} subs | keys={list(evt.keys())}")
-        except Exception:
-            pass
+        _stats["published"] += 1
+        candidates: Set[Queue] = set()
+        for b in (_by_family.get(None), _by_family.get(family), _by_serial.get(serial)):
+            if b:
+                candidates |= b
+        for r in rooms:
+            b = _by_room.get(r)
+            if b:
+                candidates |= b
+        targets = [q for q in candidates if _subs[q].matches(family, serial, rooms, event)]
+        if not targets:
+            _stats["unrouted"] += 1
+            return
 
-        for q in list(_subs):
-            try:
-                q.put_nowait(evt)
-            except Full:
-                dead.append(q)
+    data = frame(event)   # una sola serialización, compartida por todas las colas
+    dead = []
+    for q in targets:
+        try:
+            q.put_nowait(data)
+        except Full:
+            dead.append(q)
 
+    with _lock:
+        _stats["delivered"] += len(targets) - len(dead)
+        _stats["encoded_bytes"] += len(data)
+        _stats["dropped_slow"] += len(dead)
         for q in dead:
-            _subs.discard(q)
-        if dead:
+            _drop(q)
+
+def frames(q: Queue, ping_s: float = 25.0) -> Iterator[bytes]:
+    """
+    Generador para `Response`: hello, los frames de `q` (varios seguidos en una
+    sola escritura) y un ping cada `ping_s` sin eventos. Da de baja `q` al cerrar.
+    """
+    try:
+        yield HELLO
+        last = time.time()
+        while True:
             try:
-                print(f"[SSE] dropped {len(dead)} slow subscriber(s); subs={len(_subs)}")
-            except Exception:
-                pass
\ No newline at end of file
+                batch = [q.get(timeout=5)]
+            except Empty:
+                if time.time() - last > ping_s:
+                    yield PING
+                    last = time.time()
+                continue
+            while len(batch) < 64:
+                try:
+                    batch.append(q.get_nowait())
+                except Empty:
+                    break
+            yield b"".join(batch)
+            last = time.time()
+    finally:
+        unsubscribe(q)
@@ -0,0 +1,108 @@
+# app/storage_policy.py
+"""
+Política de almacenamiento por prefijo de serial (change detection + deadband).
+
+Decide si una muestra MQTT se persiste (UPDATE de `Dispositivo`, fila en
+`EstadoLog` y `device_update` por SSE) o se suprime por no aportar nada:
+  - coincidencia exacta con lo último escrito (estado/parametros/configuracion)
+  - métricas numéricas dentro de su banda muerta (abs y/o rel) por prefijo
+  - aun así se escribe un keep-alive si pasó max_silence_s desde la última escritura
+Las reglas IoTelligence se siguen despachando para todas las muestras.
+La última escritura de cada serial se fija al comitear el lote del escritor:
+si hay rollback (y reintento) el keep-alive no se da por escrito.
+"""
+from __future__ import annotations
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional
+from flask import current_app
+
+from app import writer
+
+_lock = threading.Lock()
+_last_write: Dict[str, datetime] = {}   # serial -> ts de la última muestra persistida (comiteada)
+_local = threading.local()              # .pending: lo escrito en la transacción en curso
+
+def _policy_for(serial: str) -> Dict[str, Any]:
+    policies = current_app.config.get("INGEST_STORAGE_POLICY") or {}
+    for pfx, pol in policies.items():
+        if str(serial or "").startswith(pfx):
+            return pol or {}
+    return current_app.config.get("INGEST_STORAGE_POLICY_DEFAULT") or {}
+
+def _is_number(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+def _in_band(old, new, band: Optional[Dict[str, float]]) -> bool:
+    if old == new:
+        return True
+    if not band or not (_is_number(old) and _is_number(new)):
+        return False
+    diff = abs(float(new) - float(old))
+    if "abs" in band and diff <= float(band["abs"]):
+        return True
+    if "rel" in band and old != 0 and diff <= abs(float(old)) * float(band["rel"]):
+        return True
+    return False
+
+def should_store(d, msg: Dict[str, Any]) -> bool:
+    """
+    `d` es el Dispositivo con el último estado persistido (o el del mensaje
+    anterior del mismo lote); `msg` el mensaje ya parseado de la ingesta.
+    Si devuelve True registra la muestra como la última escrita del serial
+    (visible ya en la transacción; para el resto, tras el commit).
+    """
+    if not current_app.config.get("INGEST_DEDUP_ENABLED", True):
+        return True
+    if _changed(d, msg):
+        pending = getattr(_local, "pending", None)
+        if pending is None:
+            pending = _local.pending = {}
+            writer.after_commit(_committed)
+        pending[d.serial_number] = msg["ts"]
+        return True
+    return False
+
+def _committed() -> None:
+    pending, _local.pending = getattr(_local, "pending", None), None
+    if pending:
+        with _lock:
+            _last_write.update(pending)
+
+def _discard() -> None:
+    _local.pending = None
+
+writer.add_rollback_listener(_discard)
+
+def _changed(d, msg: Dict[str, Any]) -> bool:
+    pol = _policy_for(d.serial_number)
+    last = (getattr(_local, "pending", None) or {}).get(d.serial_number)
+    if last is None:
+        with _lock:
+            last = _last_write.get(d.serial_number)
+    max_silence = float(pol.get("max_silence_s", current_app.config.get("INGEST_MAX_SILENCE_S", 300)))
+    if last is None or (msg["ts"] - last).total_seconds() >= max_silence:
+        return True   # primera muestra del proceso (o alta nueva) o keep-alive
+
+    estado = msg.get("estado")
+    if estado and estado != d.estado:
+        return True
+
+    cfg = msg.get("configuracion")
+    if cfg and cfg != (d.configuracion or {}):
+        return True
+
+    params = msg.get("parametros") or {}
+    if params:
+        cur = d.parametros or {}
+        if params.keys() != cur.keys():
+            return True
+        bands = pol.get("deadband") or {}
+        for k, v in params.items():
+            if not _in_band(cur.get(k), v, bands.get(k)):
+                return True
+    return False
+
+def forget(serial: str) -> None:
+    with _lock:
+        _last_write.pop(serial, None)
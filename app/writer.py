@@ -0,0 +1,242 @@
+# app/writer.py
+"""
+Escritor único de la BD (actor).
+
+Un hilo dedicado (`DBWriter`) es el único que escribe en la BD mientras el
+backend está en marcha: recibe *intenciones de escritura* (callables) por una
+cola, las ejecuta en SU sesión y hace UN commit por lote de intenciones. Así
+la ingesta MQTT, el PUT/alta/reclamo de dispositivos, habitaciones, usuarios y
+perfil, la importación masiva, las reglas IA (Rule5), el archivador y la purga
+ya no compiten por el lock del fichero SQLite ni esperan el `timeout` de 30 s.
+Como todas las escrituras de `Dispositivo` pasan por aquí, las instancias que
+el escritor guarda en caché (ingesta) nunca quedan desfasadas.
+
+    disp = writer.run(_aplicar, dev_id, cambios)      # bloquea hasta el commit
+    fut  = writer.submit(_aplicar, dev_id, cambios)   # concurrent.futures.Future
+
+Reglas para las intenciones:
+  - Solo trabajo de BD con argumentos primitivos (ni `request` ni JWT: se
+    ejecutan en otro hilo, con app context pero sin request context).
+  - Nada de commit/rollback: lo hace el actor.
+  - Efectos externos (registro en memoria, SSE, reglas) DESPUÉS, en el
+    llamador, con el resultado devuelto: si una intención del lote falla se
+    hace rollback y las demás se reejecutan de una en una. Los que deban
+    correr en el hilo escritor (cachés de la ingesta) se registran con
+    `after_commit(fn)`: se ejecutan tras el commit y se descartan si hay rollback.
+  - Los objetos ORM devueltos pertenecen a la sesión del escritor; leerlos es
+    seguro (expire_on_commit=False), modificarlos no.
+
+Lecturas: con DB_READ_SPLIT (SQLite) los SELECT de cualquier otro hilo van por
+un pool de conexiones `PRAGMA query_only` (ver `app.db`). Solo los comandos de
+`maintenance.py` (backfills, pack-json, vacuum; con el backend parado) y las
+particiones de PostgreSQL escriben con sus propias transacciones.
+"""
+from __future__ import annotations
+import atexit, threading, time
+from concurrent.futures import Future
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import Flask
+
+from app.db import db, pin_writes
+
+_app: Flask | None = None
+_queue: Queue | None = None
+_thread: threading.Thread | None = None
+_stop = threading.Event()
+_rollback_listeners: List[Callable[[], None]] = []
+_commit_listeners: List[Callable[[], None]] = []
+_stats_lock = threading.Lock()
+_stats: Dict[str, Any] = {
+    "intents": 0,
+    "batches": 0,
+    "failed": 0,
+    "retried_batches": 0,
+    "last_batch": 0,
+    "last_commit_ms": 0.0,
+}
+
+_last_done = time.monotonic()   # fin del último lote (ventanas de inactividad)
+_local = threading.local()      # .after: callbacks post-commit de la transacción en curso
+
+_Intent = Tuple[Callable[..., Any], tuple, dict, Future]
+
+def init(app: Flask) -> None:
+    """Arranca el hilo escritor (idempotente). Con DB_WRITER_ENABLED=False `run` ejecuta en línea."""
+    global _app, _queue, _thread
+    _app = app
+    if _thread is not None or not app.config.get("DB_WRITER_ENABLED", True):
+        return
+    _queue = Queue(maxsize=int(app.config.get("DB_WRITER_QUEUE_MAX", 10000)))
+    _thread = threading.Thread(target=_loop, args=(app,), name="DBWriter", daemon=True)
+    _thread.start()
+    atexit.register(stop)
+    print(f"[WRITER] started (batch_max={app.config.get('DB_WRITER_BATCH_MAX', 64)})")
+
+def stop(timeout: float = 5.0) -> None:
+    """Vacía la cola y termina (atexit)."""
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=timeout)
+
+def add_rollback_listener(fn: Callable[[], None]) -> None:
+    """`fn()` se llama en el hilo escritor tras cada rollback (invalidar cachés)."""
+    _rollback_listeners.append(fn)
+
+def add_commit_listener(fn: Callable[[], None]) -> None:
+    """`fn()` se llama en el hilo escritor tras cada commit, antes de resolver los Futures."""
+    _commit_listeners.append(fn)
+
+def after_commit(fn: Callable[[], None]) -> None:
+    """Desde una intención: `fn()` tras el commit de su lote (mismo hilo); nada si hay rollback."""
+    after = getattr(_local, "after", None)
+    if after is None:
+        after = _local.after = []
+    after.append(fn)
+
+def _drop_after() -> None:
+    _local.after = None
+
+def _run_after() -> None:
+    after, _local.after = getattr(_local, "after", None), None
+    for fn in after or ():
+        try:
+            fn()
+        except Exception as e:
+            print("[WRITER] after_commit:", e)
+
+def in_writer() -> bool:
+    return _thread is not None and threading.current_thread() is _thread
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        out = dict(_stats)
+    out["queued"] = _queue.qsize() if _queue is not None else 0
+    out["enabled"] = _thread is not None
+    return out
+
+def idle_s() -> float:
+    """Segundos sin trabajo del escritor (0 si hay intenciones en cola)."""
+    if _queue is not None and _queue.qsize():
+        return 0.0
+    return time.monotonic() - _last_done
+
+def _count(**kw) -> None:
+    with _stats_lock:
+        for k, v in kw.items():
+            _stats[k] = _stats.get(k, 0) + v
+
+# =========================
+# API
+# =========================
+def submit(fn: Callable[..., Any], *args, **kwargs) -> Future:
+    """Encola una intención; el Future se resuelve tras el commit (o con la excepción)."""
+    fut: Future = Future()
+    if _queue is None:
+        # Sin actor (deshabilitado o script sin create_app completo): ejecuta y comitea aquí
+        try:
+            res = fn(*args, **kwargs)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            _drop_after()
+            _notify_rollback()
+            fut.set_exception(e)
+            return fut
+        _run_after()
+        fut.set_result(res)
+        return fut
+    try:
+        _queue.put((fn, args, kwargs, fut), timeout=float(_app.config.get("DB_WRITER_TIMEOUT_S", 30)))
+    except Full:
+        fut.set_exception(RuntimeError("cola del escritor llena"))
+    return fut
+
+def run(fn: Callable[..., Any], *args, timeout: Optional[float] = -1, **kwargs) -> Any:
+    """
+    Ejecuta `fn(*args, **kwargs)` en el escritor y devuelve su resultado ya
+    comiteado (relanza su excepción). Desde el propio hilo escritor se
+    ejecuta en línea, dentro de la transacción en curso.
+    timeout=-1 -> DB_WRITER_TIMEOUT_S; None -> sin límite.
+    """
+    if in_writer():
+        return fn(*args, **kwargs)
+    if timeout == -1:
+        timeout = float(_app.config.get("DB_WRITER_TIMEOUT_S", 30)) if _app is not None else None
+    return submit(fn, *args, **kwargs).result(timeout=timeout)
+
+# =========================
+# Hilo escritor
+# =========================
+def _loop(app: Flask) -> None:
+    pin_writes()   # lee lo propio por la conexión de escritura
+    with app.app_context():
+        batch_max = int(app.config.get("DB_WRITER_BATCH_MAX", 64))
+        while True:
+            try:
+                first = _queue.get(timeout=0.5)
+            except Empty:
+                if _stop.is_set():
+                    return
+                continue
+            # Group commit: todo lo que ya esté esperando entra en la misma transacción
+            batch = [first]
+            while len(batch) < batch_max:
+                try:
+                    batch.append(_queue.get_nowait())
+                except Empty:
+                    break
+            _execute(batch)
+
+def _notify_rollback() -> None:
+    for fn in _rollback_listeners:
+        try:
+            fn()
+        except Exception as e:
+            print("[WRITER] rollback listener:", e)
+
+def _notify_commit() -> None:
+    for fn in _commit_listeners:
+        try:
+            fn()
+        except Exception as e:
+            print("[WRITER] commit listener:", e)
+
+def _execute(batch: List[_Intent]) -> None:
+    global _last_done
+    try:
+        _run_batch(batch)
+    finally:
+        _last_done = time.monotonic()
+
+def _run_batch(batch: List[_Intent]) -> None:
+    t0 = time.perf_counter()
+    results = []
+    try:
+        for fn, args, kwargs, _ in batch:
+            results.append(fn(*args, **kwargs))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        _drop_after()
+        _notify_rollback()
+        if len(batch) == 1:
+            _count(failed=1)
+            batch[0][3].set_exception(e)
+            return
+        # Aislar a la intención que falla: el resto se reintenta por separado
+        _count(retried_batches=1)
+        for it in batch:
+            _run_batch([it])
+        return
+    ms = (time.perf_counter() - t0) * 1000.0
+    _run_after()
+    _notify_commit()
+    with _stats_lock:
+        _stats["intents"] += len(batch)
+        _stats["batches"] += 1
+        _stats["last_batch"] = len(batch)
+        _stats["last_commit_ms"] = round(ms, 2)
+    for (_, _, _, fut), res in zip(batch, results):
+        fut.set_result(res)
@@ -0,0 +1,257 @@
+# bench_ingest.py
+"""
+Benchmark end-to-end de la ingesta con una flota sintética de dispositivos.
+
+Simula N dispositivos repartidos entre los prefijos reales de
+KIND_BY_SERIAL_PREFIX (parametros/configuracion realistas por tipo) y mide:
+  - throughput sostenido (mensajes/s publicados y comiteados)
+  - latencia publicación -> commit de EstadoLog (p50/p99)
+  - latencia publicación -> entrega SSE a un suscriptor (p50/p99)
+  - backlog del worker IA (máximo y final)
+
+Modos:
+  --mode direct  inyecta mensajes falsos en mqtt_client.handle_message (sin broker)
+  --mode broker  publica con paho en MQTT_BROKER_URL:MQTT_BROKER_PORT (p.ej. Mosquitto local)
+
+Usa una BD SQLite temporal; nunca toca instance/iot.db.
+
+Ejemplos:
+  python bench_ingest.py --devices 300 --interval 1 --duration 30
+  python bench_ingest.py --devices 1000 --rate 0 --messages 50000     # a máxima velocidad
+  python bench_ingest.py --mode broker --devices 300 --qos 1
+"""
+import argparse, contextlib, io, json, os, random, shutil, sys, tempfile, threading, time
+from queue import Empty
+
+from config import Config, engine_options
+from app.iotelligence.dev_kinds import KIND_BY_SERIAL_PREFIX
+
+# ---------------------------------------------------------------
+# Flota sintética
+# ---------------------------------------------------------------
+_HORARIO = {"lunes": [["07:00", True], ["22:00", False]], "viernes": [["08:00", True], ["23:30", False]]}
+
+def _params_for(prefix: str, rnd: random.Random) -> dict:
+    if prefix == "TMP0": return {"temperatura": round(rnd.gauss(24, 2), 1), "humedad": round(rnd.gauss(55, 8), 1)}
+    if prefix == "CO20": return {"co2_ppm": int(rnd.gauss(650, 120))}
+    if prefix == "LUX0": return {"luz_lux": round(abs(rnd.gauss(250, 90)), 1)}
+    if prefix == "SND0": return {"db": round(rnd.gauss(45, 8), 1)}
+    if prefix == "PLG0": return {"consumo_w": round(abs(rnd.gauss(120, 60)), 1)}
+    if prefix == "FAN0": return {"velocidad": rnd.randint(0, 3)}
+    if prefix == "SHD0": return {"pos": rnd.choice([0, 25, 50, 75, 100])}
+    if prefix == "RGD0": return {"minutes_left": rnd.randint(0, 30)}
+    if prefix == "SMK0": return {"humo": rnd.random() < 0.01}
+    if prefix == "MOV0": return {"movimiento": rnd.random() < 0.2}
+    return {}
+
+def _config_for(prefix: str) -> dict:
+    kind = KIND_BY_SERIAL_PREFIX[prefix]
+    cfg = {"modo": "horario", "intervalo_envio": 1, "encendido": True}
+    if kind in ("luz", "enchufe", "camara"):
+        cfg["horarios"] = _HORARIO
+    elif kind == "persiana":
+        cfg["horarios_pos"] = {"lunes": [["07:00", 100], ["20:00", 0]]}
+    elif kind == "ventilador":
+        cfg["horarios_speed"] = {"lunes": [["12:00", 2], ["18:00", 0]]}
+    elif kind == "riego":
+        cfg["horarios_riego"] = {"lunes": [["06:00", 15]]}
+    return cfg
+
+class Fleet:
+    def __init__(self, n: int, seed: int = 7):
+        self.rnd = random.Random(seed)
+        prefixes = list(KIND_BY_SERIAL_PREFIX.keys())
+        self.devices = [(f"{prefixes[i % len(prefixes)]}BENCH{i:05d}", prefixes[i % len(prefixes)]) for i in range(n)]
+        self.seq = 0
+
+    def message(self, i: int, with_config: bool) -> tuple[str, int, dict]:
+        serial, prefix = self.devices[i % len(self.devices)]
+        self.seq += 1
+        params = _params_for(prefix, self.rnd)
+        params["seq"] = self.seq            # identifica la muestra en commit y SSE
+        data = {"serial_number": serial, "estado": "activo", "parametros": params}
+        if with_config:
+            data["configuracion"] = _config_for(prefix)
+        return serial, self.seq, data
+
+class _FakeMessage:
+    def __init__(self, topic: str, payload: bytes, qos: int):
+        self.topic, self.payload, self.qos = topic, payload, qos
+
+# ---------------------------------------------------------------
+# Medición
+# ---------------------------------------------------------------
+def _pct(vals, p):
+    if not vals:
+        return float("nan")
+    vals = sorted(vals)
+    k = min(len(vals) - 1, max(0, int(round((len(vals) - 1) * p / 100.0))))
+    return vals[k]
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}        # seq -> t_publish (perf_counter)
+        self.commit_lat = []  # ms
+        self.sse_lat = []     # ms
+        self.committed = 0
+        self.ai_backlog_max = 0
+
+    def on_commit(self, msgs):
+        now = time.perf_counter()
+        with self.lock:
+            for m in msgs:
+                t0 = self.sent.get((m.get("parametros") or {}).get("seq"))
+                if t0 is not None:
+                    self.commit_lat.append((now - t0) * 1000.0)
+            self.committed += len(msgs)
+
+    def on_sse(self, evt):
+        t0 = self.sent.get((evt.get("parametros") or {}).get("seq"))
+        if t0 is not None:
+            with self.lock:
+                self.sse_lat.append((time.perf_counter() - t0) * 1000.0)
+
+def _sse_consumer(rec: Recorder, stop: threading.Event):
+    from app.sse import subscribe, unsubscribe
+    q = subscribe()
+    try:
+        while not stop.is_set():
+            try:
+                data = q.get(timeout=0.2)
+            except Empty:
+                continue
+            # Las colas llevan frames ya codificados: "event: <nombre>\ndata: <json>\n\n"
+            if data.startswith(b"event: device_update\n"):
+                rec.on_sse(json.loads(data.split(b"\ndata: ", 1)[1]))
+    finally:
+        unsubscribe(q)
+
+def _ai_sampler(rec: Recorder, stop: threading.Event):
+    from app.iotelligence.worker import stats as ai_stats
+    while not stop.is_set():
+        rec.ai_backlog_max = max(rec.ai_backlog_max, ai_stats()["pending"])
+        time.sleep(0.1)
+
+# ---------------------------------------------------------------
+# Ejecución
+# ---------------------------------------------------------------
+def run(args, tmpdir: str) -> str:
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(tmpdir, "bench.db")
+        ARCHIVE_DIR = os.path.join(tmpdir, "archive")
+        SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+        MQTT_ENABLED = args.mode == "broker"
+        MQTT_STATE_QOS = args.qos
+        INGEST_DEDUP_ENABLED = args.dedup
+        AI_R4_STARTUP_GRACE_SECS = 3600
+
+    from app import create_app, ingest
+    from app.iotelligence.worker import stats as ai_stats
+
+    sink = io.StringIO()
+    out = sys.stdout if args.verbose else sink
+    rec = Recorder()
+    stop = threading.Event()
+    fleet = Fleet(args.devices, seed=args.seed)
+
+    with contextlib.redirect_stdout(out):
+        app = create_app(BenchConfig)
+        ingest.add_commit_listener(rec.on_commit)
+        threads = [threading.Thread(target=_sse_consumer, args=(rec, stop), daemon=True),
+                   threading.Thread(target=_ai_sampler, args=(rec, stop), daemon=True)]
+        for t in threads:
+            t.start()
+
+        if args.mode == "broker":
+            import paho.mqtt.client as paho
+            pub = paho.Client()
+            pub.connect(BenchConfig.MQTT_BROKER_URL, BenchConfig.MQTT_BROKER_PORT, 60)
+            pub.loop_start()
+            time.sleep(1.0)   # deja que el backend se suscriba
+            def send(serial, payload):
+                topic = f"dispositivos/{serial}/estado" if args.per_device_topic else "dispositivos/estado"
+                pub.publish(topic, payload, qos=args.qos)
+        else:
+            from app.mqtt_client import handle_message
+            def send(serial, payload):
+                topic = f"dispositivos/{serial}/estado" if args.per_device_topic else "dispositivos/estado"
+                handle_message(None, None, _FakeMessage(topic, payload, args.qos))
+
+        total = args.messages or int(args.devices * args.duration / max(args.interval, 1e-6))
+        rate = 0.0 if args.rate == 0 else (args.rate or args.devices / max(args.interval, 1e-6))
+        t_start = time.perf_counter()
+        for i in range(total):
+            serial, seq, data = fleet.message(i, with_config=(i < args.devices))
+            payload = json.dumps(data).encode()
+            rec.sent[seq] = time.perf_counter()
+            send(serial, payload)
+            if rate > 0:
+                target = t_start + (i + 1) / rate
+                delay = target - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        t_pub = time.perf_counter() - t_start
+
+        # Esperar a que la ingesta drene (o timeout)
+        deadline = time.perf_counter() + args.drain_timeout
+        while time.perf_counter() < deadline:
+            st = ingest.stats()
+            if st["queued"] == 0 and st["enqueued"] >= rec.committed and \
+               st["written"] + st["suppressed"] >= st["enqueued"] and st["enqueued"] > 0:
+                break
+            time.sleep(0.05)
+        t_total = time.perf_counter() - t_start
+        time.sleep(0.5)  # últimas entregas SSE
+        stop.set()
+        ai_final = ai_stats()
+        ing = ingest.stats()
+
+    lines = [
+        "=" * 60,
+        f"Ingest benchmark  mode={args.mode} devices={args.devices} messages={total} qos={args.qos} dedup={args.dedup}",
+        "=" * 60,
+        f"publicados           : {total} en {t_pub:.2f}s  ({total / t_pub:.0f} msg/s)",
+        f"comiteados (EstadoLog): {rec.committed}  suprimidos={ing['suppressed']}  descartados={total - ing['enqueued']}",
+        f"throughput sostenido : {(ing['written'] + ing['suppressed']) / t_total:.0f} msg/s (publicación→drenado {t_total:.2f}s)",
+        f"lotes                : {ing['flushes']}  último={ing['last_batch']}  commit={ing['last_commit_ms']}ms",
+        f"latencia → commit    : p50={_pct(rec.commit_lat, 50):.1f}ms  p99={_pct(rec.commit_lat, 99):.1f}ms  (n={len(rec.commit_lat)})",
+        f"latencia → SSE       : p50={_pct(rec.sse_lat, 50):.1f}ms  p99={_pct(rec.sse_lat, 99):.1f}ms  (n={len(rec.sse_lat)}, coalescido por lote)",
+        f"worker IA            : backlog máx={rec.ai_backlog_max}  final={ai_final['pending']}  descartadas={ai_final['shed']}",
+    ]
+    return "\n".join(lines)
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark de ingesta MQTT → EstadoLog/SSE")
+    ap.add_argument("--mode", choices=["direct", "broker"], default="direct")
+    ap.add_argument("--devices", type=int, default=300)
+    ap.add_argument("--interval", type=float, default=1.0, help="segundos entre reportes de cada dispositivo")
+    ap.add_argument("--duration", type=float, default=20.0, help="segundos simulados")
+    ap.add_argument("--messages", type=int, default=0, help="total fijo de mensajes (ignora duration)")
+    ap.add_argument("--rate", type=float, default=None, help="msg/s (0 = a máxima velocidad; por defecto devices/interval)")
+    ap.add_argument("--qos", type=int, choices=[0, 1], default=0)
+    ap.add_argument("--per-device-topic", action="store_true", help="publicar en dispositivos/<serial>/estado")
+    ap.add_argument("--dedup", action="store_true", help="mantener la política de supresión (storage_policy)")
+    ap.add_argument("--drain-timeout", type=float, default=60.0)
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--out", default="", help="guardar el informe (p.ej. bench_output.txt)")
+    ap.add_argument("-v", "--verbose", action="store_true", help="no silenciar los logs del backend")
+    ap.add_argument("--keep", action="store_true", help="conservar la BD y el archivo temporales")
+    args = ap.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="iot_bench_")
+    try:
+        report = run(args, tmpdir)
+    finally:
+        if args.keep:
+            print(f"[BENCH] datos en {tmpdir}")
+        else:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    print(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    os._exit(0)   # hilos daemon del backend (watchdog, carriles, MQTT)
+
+if __name__ == "__main__":
+    main()
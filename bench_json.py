@@ -0,0 +1,104 @@
+# bench_json.py
+"""
+Benchmark de las columnas JSON: tipo JSON de SQLite (texto, como antes) frente
+a PackedJSON (MessagePack comprimido, sin y con diccionario compartido).
+
+Genera `configuracion` sintéticas con varios canales `horarios*` (el blob más
+grande de Dispositivo) y, para cada tipo, en una BD SQLite temporal mide:
+  - bytes por fila en la columna (media de LENGTH) y tamaño del fichero
+  - latencia de escritura (INSERT de N filas en lotes, commit incluido)
+  - latencia de lectura (SELECT + decodificación de todas las filas)
+
+Nunca toca instance/iot.db.
+
+Ejemplos:
+  python bench_json.py
+  python bench_json.py --rows 20000 --channels 4 --batch 200
+"""
+import argparse, os, random, tempfile, time
+
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, insert, select
+from sqlalchemy.dialects.sqlite import JSON as SQLiteJSON
+
+from app import packed_json
+from app.packed_json import PackedJSON
+
+DIAS = ["lunes", "martes", "miercoles", "jueves", "viernes", "sabado", "domingo"]
+CANALES = ["horarios", "horarios_pos", "horarios_speed", "horarios_riego", "horarios_temp"]
+
+def _horario(rnd: random.Random, canal: str) -> dict:
+    out = {}
+    for dia in rnd.sample(DIAS, rnd.randint(3, 7)):
+        h1, h2 = rnd.randint(5, 11), rnd.randint(17, 23)
+        if canal == "horarios":
+            out[dia] = [[f"{h1:02d}:{rnd.choice(['00', '30'])}", True], [f"{h2:02d}:00", False]]
+        else:
+            out[dia] = [[f"{h1:02d}:00", rnd.choice([0, 25, 50, 100])], [f"{h2:02d}:30", 0]]
+    return out
+
+def _configuracion(rnd: random.Random, channels: int) -> dict:
+    cfg = {"modo": rnd.choice(["horario", "manual", "auto"]), "intervalo_envio": rnd.choice([1, 5, 10]),
+           "encendido": rnd.random() < 0.7, "umbral": round(rnd.uniform(10, 40), 1)}
+    for canal in CANALES[:channels]:
+        cfg[canal] = _horario(rnd, canal)
+    return cfg
+
+def _run(label: str, coltype, values, batch: int) -> dict:
+    fd, path = tempfile.mkstemp(prefix="bench_json_", suffix=".db")
+    os.close(fd)
+    eng = create_engine(f"sqlite:///{path}")
+    t = Table("dispositivo", MetaData(), Column("id", Integer, primary_key=True), Column("configuracion", coltype))
+    t.metadata.create_all(eng)
+    try:
+        t0 = time.perf_counter()
+        for i in range(0, len(values), batch):
+            with eng.begin() as conn:
+                conn.execute(insert(t), [{"configuracion": v} for v in values[i:i + batch]])
+        w = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        with eng.connect() as conn:
+            got = conn.execute(select(t.c.configuracion)).scalars().all()
+        r = time.perf_counter() - t0
+        assert got == values, f"{label}: lectura distinta de lo escrito"
+
+        with eng.connect() as conn:
+            avg = conn.exec_driver_sql("SELECT AVG(LENGTH(configuracion)) FROM dispositivo").scalar()
+        eng.dispose()
+        return {"tipo": label, "bytes_fila": avg, "fichero_kb": os.path.getsize(path) / 1024.0,
+                "escritura_us": w / len(values) * 1e6, "lectura_us": r / len(values) * 1e6}
+    finally:
+        eng.dispose()
+        for suf in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suf):
+                os.remove(path + suf)
+
+def main():
+    ap = argparse.ArgumentParser(description="JSON (texto) vs PackedJSON en SQLite")
+    ap.add_argument("--rows", type=int, default=5000)
+    ap.add_argument("--channels", type=int, default=3, help="canales horarios* por configuracion (1-5)")
+    ap.add_argument("--batch", type=int, default=100, help="filas por transacción")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    if packed_json.msgpack is None:
+        raise SystemExit("msgpack no está instalado")
+
+    rnd = random.Random(args.seed)
+    values = [_configuracion(rnd, max(1, min(args.channels, len(CANALES)))) for _ in range(args.rows)]
+
+    results = [_run("JSON (texto)", SQLiteJSON(), values, args.batch)]
+    results.append(_run("PackedJSON sin diccionario", PackedJSON(), values, args.batch))
+    codec, data = packed_json.train(values[:2000])
+    packed_json.register(1, codec, data)
+    codec_name = "zstd" if codec == packed_json.ZSTD else "zlib"
+    results.append(_run(f"PackedJSON + dicc. {codec_name} ({len(data) // 1024} KB)", PackedJSON(), values, args.batch))
+
+    base = results[0]["bytes_fila"]
+    print(f"\n{args.rows} filas, {args.channels} canales horarios*, lotes de {args.batch}\n")
+    print(f"{'tipo':<36} {'B/fila':>8} {'ratio':>6} {'fichero KB':>11} {'escr. us':>9} {'lect. us':>9}")
+    for r in results:
+        print(f"{r['tipo']:<36} {r['bytes_fila']:>8.1f} {base / r['bytes_fila']:>5.2f}x "
+              f"{r['fichero_kb']:>11.1f} {r['escritura_us']:>9.1f} {r['lectura_us']:>9.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# import_history.py
+"""
+Importación masiva de histórico a EstadoLog desde CSV / JSONL (ver app/bulk_import.py).
+
+Ejemplos:
+  python import_history.py app/iotelligence/data/river_models/RGD0ABC123.csv
+  python import_history.py export_estados.jsonl --run-rules
+  python import_history.py datos.csv --serial TMP0XYZ --tz local --commit-rows 100000
+"""
+import argparse, json, os, sys
+
+def main():
+    ap = argparse.ArgumentParser(description="Importa histórico (CSV/JSONL) a EstadoLog")
+    ap.add_argument("files", nargs="+", help="ficheros .csv / .jsonl")
+    ap.add_argument("--format", choices=["csv", "jsonl"], default=None, help="forzar formato (por defecto, extensión)")
+    ap.add_argument("--serial", default=None, help="serial para CSV sin columna de serial (por defecto, nombre del fichero)")
+    ap.add_argument("--tz", choices=["utc", "local"], default="utc", help="zona de los timestamps sin offset")
+    ap.add_argument("--run-rules", action="store_true", help="despachar reglas IoTelligence por cada muestra")
+    ap.add_argument("--no-create", action="store_true", help="no crear dispositivos desconocidos (se omiten sus filas)")
+    ap.add_argument("--chunk-rows", type=int, default=None)
+    ap.add_argument("--commit-rows", type=int, default=None)
+    args = ap.parse_args()
+
+    from config import Config
+    from app import create_app
+    from app.bulk_import import import_file
+
+    class ImportConfig(Config):
+        MQTT_ENABLED = False   # solo escribe histórico; no consume el broker
+
+    app = create_app(ImportConfig)
+    total = 0
+    with app.app_context():
+        for path in args.files:
+            if not os.path.isfile(path):
+                print(f"[IMPORT] ❌ no existe: {path}")
+                continue
+            res = import_file(path, fmt=args.format, serial=args.serial, tz=args.tz,
+                              run_rules=args.run_rules, create_missing=not args.no_create,
+                              chunk_rows=args.chunk_rows, commit_rows=args.commit_rows)
+            total += res["inserted"]
+            print(f"[IMPORT] ✅ {path}: {json.dumps(res, ensure_ascii=False)}")
+    print(f"[IMPORT] total insertadas={total}")
+    sys.stdout.flush()
+    os._exit(0)   # hilos daemon del backend (ingesta, watchdog)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# maintenance.py
+"""
+Tareas de mantenimiento de la BD (se ejecutan con el backend parado o en paralelo;
+no consumen MQTT).
+
+Comandos:
+  python maintenance.py backfill-metrics     # EstadoLog.parametros -> metric_sample (+ rollups)
+  python maintenance.py backfill-rollups     # reconstruye metric_rollup desde metric_sample
+  python maintenance.py archive              # mueve ya los logs vencidos a segmentos comprimidos
+  python maintenance.py pack-json            # entrena el diccionario y empaqueta configuracion (el resto, a texto)
+  python maintenance.py split-telemetry      # copia logs/métricas a TELEMETRY_DATABASE_URL (backend parado)
+  python maintenance.py vacuum               # VACUUM completo (activa auto_vacuum=INCREMENTAL en BD antiguas)
+"""
+import argparse, json, os, sys
+
+def _app():
+    from config import Config
+    from app import create_app
+
+    class MaintenanceConfig(Config):
+        MQTT_ENABLED = False
+        ARCHIVE_ENABLED = False   # el comando `archive` lo ejecuta en primer plano
+        SQLITE_MAINT_ENABLED = False
+
+    return create_app(MaintenanceConfig)
+
+def cmd_backfill_metrics(args):
+    from app import metrics
+    return metrics.backfill(chunk=args.chunk)
+
+def cmd_backfill_rollups(args):
+    from app import rollups
+    return rollups.rebuild(chunk=args.chunk)
+
+def cmd_archive(args):
+    from flask import current_app
+    from app import archive
+    if args.estado_days is not None:
+        current_app.config["ARCHIVE_ESTADO_AFTER_DAYS"] = args.estado_days
+    if args.accion_days is not None:
+        current_app.config["ARCHIVE_ACCION_AFTER_DAYS"] = args.accion_days
+    return archive.run_once(current_app)
+
+def cmd_pack_json(args):
+    from app import packed_json
+    return packed_json.migrate(chunk=args.chunk, samples=args.samples,
+                               retrain=args.retrain, vacuum=args.vacuum)
+
+def cmd_split_telemetry(args):
+    from app.db import copy_bind_tables
+    return copy_bind_tables(chunk=args.chunk, drop_source=args.drop_source)
+
+def cmd_vacuum(args):
+    from app import sqlite_maint
+    return sqlite_maint.full_vacuum()
+
+def main():
+    ap = argparse.ArgumentParser(description="Mantenimiento de la BD del backend IoT")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("backfill-metrics", help="rellenar metric_sample desde el histórico de EstadoLog")
+    p.add_argument("--chunk", type=int, default=5000)
+    p.set_defaults(fn=cmd_backfill_metrics)
+
+    p = sub.add_parser("backfill-rollups", help="reconstruir metric_rollup (1m/1h/1d) desde metric_sample")
+    p.add_argument("--chunk", type=int, default=20000)
+    p.set_defaults(fn=cmd_backfill_rollups)
+
+    p = sub.add_parser("archive", help="archivar EstadoLog/AccionLog vencidos (retención)")
+    p.add_argument("--estado-days", type=float, default=None)
+    p.add_argument("--accion-days", type=float, default=None)
+    p.set_defaults(fn=cmd_archive)
+
+    p = sub.add_parser("pack-json", help="empaquetar configuracion en MessagePack y devolver a texto las demás columnas JSON")
+    p.add_argument("--chunk", type=int, default=2000)
+    p.add_argument("--samples", type=int, default=2000, help="filas recientes por columna para entrenar")
+    p.add_argument("--retrain", action="store_true", help="nuevo diccionario y reempaquetar todo")
+    p.add_argument("--vacuum", action="store_true", help="VACUUM al terminar (devuelve el espacio al disco)")
+    p.set_defaults(fn=cmd_pack_json)
+
+    p = sub.add_parser("split-telemetry", help="mover estado_log/accion_log/métricas a la BD de telemetría")
+    p.add_argument("--chunk", type=int, default=5000)
+    p.add_argument("--drop-source", action="store_true", help="borrar las tablas de la BD principal tras copiar")
+    p.set_defaults(fn=cmd_split_telemetry)
+
+    p = sub.add_parser("vacuum", help="VACUUM completo de las BD SQLite (backend parado)")
+    p.set_defaults(fn=cmd_vacuum)
+
+    args = ap.parse_args()
+    app = _app()
+    with app.app_context():
+        res = args.fn(args)
+    print(f"[MAINT] {args.cmd}: {json.dumps(res, ensure_ascii=False, default=str)}")
+    sys.stdout.flush()
+    os._exit(0)   # hilos daemon del backend (ingesta, watchdog)
+
+if __name__ == "__main__":
+    main()